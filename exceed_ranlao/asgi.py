@@ -9,8 +9,23 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'exceed_ranlao.settings')
 
-application = get_asgi_application()
+# Same as get_asgi_application(), with a handler that can stream from the database.
+django.setup(set_prefix=False)
+
+# Django has to be set up before importing the app.
+from ranlao.handlers import StreamingASGIHandler  # noqa: E402
+from ranlao.push import websocket_application  # noqa: E402
+
+django_application = StreamingASGIHandler()
+
+
+async def application(scope, receive, send):
+    """Websockets go to the push channel, everything else goes to Django."""
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
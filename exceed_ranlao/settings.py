@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 
 from pathlib import Path
 from decouple import config, Csv
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,8 +44,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ranlao.metrics.metrics_middleware',
+    'ranlao.middlewares.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    'ranlao.middlewares.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,13 +85,68 @@ WSGI_APPLICATION = 'exceed_ranlao.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
-DATABASES = {
+# DB_PROFILE selects the database:
+# - sqlite: SQLite tuned for many workers (WAL, busy timeout, reused connections).
+# - sqlite-plain: SQLite with the default settings of Django.
+# - postgres: PostgreSQL from the DB_* variables, it needs psycopg2.
+DB_PROFILE = config('DB_PROFILE', default='sqlite')
+
+if DB_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('DB_NAME', default='ranlao'),
+            'USER': config('DB_USER', default='ranlao'),
+            'PASSWORD': config('DB_PASSWORD', default=''),
+            'HOST': config('DB_HOST', default='localhost'),
+            'PORT': config('DB_PORT', default='5432'),
+            # Seconds to keep a connection open, 0 closes it after each request.
+            'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+            # A pooler in transaction mode (like PgBouncer) cannot keep server-side cursors.
+            'DISABLE_SERVER_SIDE_CURSORS': config('DB_POOLED', default=False, cast=bool),
+        }
+    }
+elif DB_PROFILE in ('sqlite', 'sqlite-plain'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            # In-memory SQLite locks the whole table for other threads,
+            # so the concurrency tests need a database file.
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
+        }
+    }
+    if DB_PROFILE == 'sqlite':
+        DATABASES['default'].update({
+            'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+            # Seconds to wait for the lock instead of failing with "database is locked".
+            'OPTIONS': {'timeout': config('DB_BUSY_TIMEOUT', default=20, cast=int)},
+        })
+else:
+    raise ImproperlyConfigured(f"Unknown DB_PROFILE {DB_PROFILE!r}.")
+
+# Pragmas run on every new SQLite connection (see ranlao.signals).
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+} if DB_PROFILE == 'sqlite' else {}
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# Each worker has its own memory cache. Writes clear it right away
+# in the same worker, other workers see them after READ_CACHE_TIMEOUT.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
+# Seconds to keep /count/ and /log/ results.
+READ_CACHE_TIMEOUT = config('READ_CACHE_TIMEOUT', default=5, cast=int)
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -139,3 +197,70 @@ REST_FRAMEWORK = {
 }
 
 CORS_ALLOW_ALL_ORIGINS = True  # This to prevent development complication.
+
+# Measure requests (see /profile/). It adds no work to requests when it is off.
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=False, cast=bool)
+# Part of the requests to measure, from 0 to 1.
+PROFILING_SAMPLE_RATE = config('PROFILING_SAMPLE_RATE', default=1.0, cast=float)
+# Measured requests to keep in each worker.
+PROFILING_BUFFER_SIZE = config('PROFILING_BUFFER_SIZE', default=500, cast=int)
+
+# Count requests and their latency for /metrics/.
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+# Directory of the metric files shared by the workers, clear it before starting them.
+METRICS_DIR = config('METRICS_DIR', default=str(BASE_DIR / 'metrics'))
+
+# Tests write their metrics to a temporary directory instead of METRICS_DIR.
+TEST_RUNNER = 'ranlao.runner.TemporaryMetricsRunner'
+
+# Serve enter, leave, count, call and complete with the async views (use it with uvicorn).
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)
+# Threads of each worker that run database work for the async views.
+ASYNC_DB_THREADS = config('ASYNC_DB_THREADS', default=8, cast=int)
+
+# Seconds between the polls of the push channel for changes handled by other workers.
+PUSH_POLL_INTERVAL = config('PUSH_POLL_INTERVAL', default=1.0, cast=float)
+
+# Seconds to keep the table and staff status of a user.
+PROFILE_CACHE_TIMEOUT = config('PROFILE_CACHE_TIMEOUT', default=300, cast=int)
+
+# Seconds to remember a validated token of the hardware.
+TOKEN_CACHE_TTL = config('TOKEN_CACHE_TTL', default=300, cast=int)
+# File of the generation that drops the remembered tokens of every worker, each server needs its own.
+TOKEN_GENERATION_FILE = config('TOKEN_GENERATION_FILE', default=str(BASE_DIR / 'token_generation.mmap'))
+# Most tokens to remember in each worker.
+TOKEN_CACHE_SIZE = config('TOKEN_CACHE_SIZE', default=1024, cast=int)
+
+# Local hours the pub is open, used for the average in statistics.
+OPENING_HOURS = (18, 24)
+
+# Share current customers between the workers in a memory-mapped file,
+# /count/ then reads it instead of the database.
+SHARED_OCCUPANCY = config('SHARED_OCCUPANCY', default=False, cast=bool)
+# The file shared by the workers, each server needs its own.
+SHARED_OCCUPANCY_FILE = config('SHARED_OCCUPANCY_FILE', default=str(BASE_DIR / 'occupancy.mmap'))
+
+# Seconds to remember the idempotency keys of the hardware.
+IDEMPOTENCY_WINDOW = config('IDEMPOTENCY_WINDOW', default=86400, cast=int)
+# Most keys to remember in the memory of each worker.
+IDEMPOTENCY_CACHE_SIZE = config('IDEMPOTENCY_CACHE_SIZE', default=10000, cast=int)
+
+# Most events the hardware may upload to /events/ at once.
+MAX_EVENTS = config('MAX_EVENTS', default=1000, cast=int)
+# Seconds the clock of the hardware may be ahead, later events are rejected.
+EVENT_CLOCK_SKEW = config('EVENT_CLOCK_SKEW', default=60, cast=int)
+
+# Changes a second each sensor may send to /enter/ and /leave/, 0 for no limit.
+SENSOR_RATE = config('SENSOR_RATE', default=0.0, cast=float)
+# Changes a sensor may send at once before the rate applies.
+SENSOR_BURST = config('SENSOR_BURST', default=20, cast=int)
+# Over the rate, merge changes in memory and write them every COUNTING_FLUSH_INTERVAL
+# seconds instead of rejecting them with 429.
+SENSOR_COALESCE = config('SENSOR_COALESCE', default=False, cast=bool)
+
+# Buffer enter and leave in memory and write them in the background.
+BUFFERED_COUNTING = config('BUFFERED_COUNTING', default=False, cast=bool)
+# Seconds between each write of buffered changes.
+COUNTING_FLUSH_INTERVAL = config('COUNTING_FLUSH_INTERVAL', default=1.0, cast=float)
+# Write early when this many changes are buffered.
+COUNTING_FLUSH_THRESHOLD = config('COUNTING_FLUSH_THRESHOLD', default=100, cast=int)
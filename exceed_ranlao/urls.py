@@ -13,11 +13,12 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
 import ranlao.views
-from ranlao import views
+from ranlao import views, async_views
 from rest_framework.authtoken import views as token_views
 
 from ranlao.middlewares import CustomAuthToken
@@ -26,17 +27,26 @@ router = routers.DefaultRouter()
 router.register(r'table', views.TableViewSet)
 router.register(r'log', views.LogViewSets)
 
+# The busiest views have async versions for uvicorn.
+hot_views = async_views if settings.ASYNC_VIEWS else views
+
 
 urlpatterns = [
     path('', include(router.urls)),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
-    path('call/<int:table_number>', views.call_staff, name='call_staff'),
-    path('complete/<int:table_number>', views.complete_order, name='complete_order'),
+    path('call/<int:table_number>', hot_views.call_staff, name='call_staff'),
+    path('complete/<int:table_number>', hot_views.complete_order, name='complete_order'),
     path('api-auth-token/', CustomAuthToken.as_view(), name='get_token'),
-    path('enter/', views.customer_enter, name='enter'),
-    path('leave/', views.customer_leave, name='leave'),
-    path('count/', views.get_current_customers, name='count'),
+    path('enter/', hot_views.customer_enter, name='enter'),
+    path('leave/', hot_views.customer_leave, name='leave'),
+    path('events/', views.customer_events, name='events'),
+    path('count/', hot_views.get_current_customers, name='count'),
     path('stat/', views.get_statistic, name='statistic'),
+    path('stat/<str:period>/', views.get_period_statistic, name='period_statistic'),
     path('user-status/', views.get_user_status, name='user_status'),
+    path('calls/', views.get_open_calls, name='calls'),
+    path('calls/stats/', views.get_call_statistic, name='call_statistic'),
+    path('profile/', views.get_slow_requests, name='profile'),
+    path('metrics/', views.get_metrics, name='metrics'),
     path('admin/', admin.site.urls, name='admin'),
 ]
@@ -0,0 +1,182 @@
+"""
+Async versions of the busiest views for uvicorn (ASYNC_VIEWS).
+
+They run on the event loop and only hand work that needs the database
+to a bounded pool of ASYNC_DB_THREADS threads. Django 4.0 has no async
+ORM, so that is every query. Authentication and permissions are the
+same as the views in ranlao.views.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authentication import SessionAuthentication, BasicAuthentication, TokenAuthentication
+from rest_framework.request import Request
+
+from .authentication import CachedTokenAuthentication, token_cache
+from .counters import buffers_changes, cached_current_amount, record_delta
+from .idempotency import submission_key
+from .push import broker, occupancy_event, table_event
+from .tables import set_calling
+from .throttling import sensor_wait
+from .views import get_entrance, get_occupancy
+
+HARDWARE_AUTHENTICATION = [CachedTokenAuthentication, SessionAuthentication, BasicAuthentication]
+TABLE_AUTHENTICATION = [TokenAuthentication, SessionAuthentication]
+
+_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_DB_THREADS, thread_name_prefix='ranlao-db')
+
+
+def _with_connection(func, args):
+    # The pool threads keep their connection, drop it when it is broken or too old.
+    close_old_connections()
+    return func(*args)
+
+
+async def run_in_db_thread(func, *args):
+    """Run a function that needs the database in the thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, _with_connection, func, args)
+
+
+def csrf_exempt(view):
+    """Like django's csrf_exempt but keeps the view async. SessionAuthentication checks CSRF itself."""
+    view.csrf_exempt = True
+    return view
+
+
+def _error(exception: exceptions.APIException, authenticators: list) -> JsonResponse:
+    response = JsonResponse({'detail': str(exception.detail)}, status=exception.status_code)
+    if isinstance(exception, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+        # Same as DRF, the first authentication tells the client how to log in.
+        header = authenticators[0]().authenticate_header(None)
+        if header:
+            response['WWW-Authenticate'] = header
+        else:
+            response.status_code = HTTPStatus.FORBIDDEN
+    return response
+
+
+async def _authenticate(request, authenticators: list):
+    """
+    Get the user of the request or raise an APIException.
+
+    A cached hardware token does not need the database or a thread.
+    """
+    authorization = request.headers.get('Authorization', '').split()
+    if CachedTokenAuthentication in authenticators and len(authorization) == 2 and authorization[0] == 'Token':
+        credentials = token_cache.get(authorization[1])
+        if credentials is not None:
+            return credentials[0]
+    drf_request = Request(request, authenticators=[authenticator() for authenticator in authenticators])
+    user = await run_in_db_thread(lambda: drf_request.user)
+    if not user or not user.is_authenticated:
+        raise exceptions.NotAuthenticated()
+    return user
+
+
+async def _post_view(request, authenticators: list, handle, staff_only=False) -> JsonResponse:
+    """Check the method, the user and the permission, then run handle(user)."""
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'},
+                            status=HTTPStatus.METHOD_NOT_ALLOWED)
+    try:
+        user = await _authenticate(request, authenticators)
+        if staff_only and not user.is_staff:
+            raise exceptions.PermissionDenied()
+    except exceptions.APIException as e:
+        return _error(e, authenticators)
+    return await handle(user)
+
+
+async def _publish_occupancy():
+    if broker.has_subscribers:
+        broker.publish(occupancy_event(await run_in_db_thread(get_occupancy)))
+
+
+async def _count(request, amount: int, user) -> JsonResponse:
+    wait = sensor_wait(user)
+    coalesced = bool(wait) and settings.SENSOR_COALESCE
+    if wait and not coalesced:
+        throttled = exceptions.Throttled(wait)
+        response = JsonResponse({'detail': str(throttled.detail)}, status=throttled.status_code)
+        response['Retry-After'] = '%d' % throttled.wait
+        return response
+    try:
+        entrance = get_entrance(request.GET)
+        key = submission_key(request)
+    except exceptions.ValidationError as e:
+        return JsonResponse(e.detail, status=e.status_code)
+    args = (timezone.now(), amount, user.get_username(), entrance, key, coalesced)
+    if (settings.BUFFERED_COUNTING or coalesced) and key is None:
+        # Only memory is touched.
+        counted = record_delta(*args)
+    else:
+        counted = await run_in_db_thread(record_delta, *args)
+    if not counted:
+        return JsonResponse({'message': 'success', 'duplicate': True})
+    await _publish_occupancy()
+    if coalesced:
+        return JsonResponse({'message': 'success', 'merged': True}, status=HTTPStatus.ACCEPTED)
+    return JsonResponse({'message': 'success'})
+
+
+@csrf_exempt
+async def customer_enter(request):
+    """
+    Increase customer enter for this hour.
+
+    This view is only called from hardware.
+    """
+    return await _post_view(request, HARDWARE_AUTHENTICATION, lambda user: _count(request, 1, user))
+
+
+@csrf_exempt
+async def customer_leave(request):
+    """
+    Decrease customer for this hour.
+
+    This view is only called from hardware.
+    """
+    return await _post_view(request, HARDWARE_AUTHENTICATION, lambda user: _count(request, -1, user))
+
+
+async def get_current_customers(request):
+    """Get numbers of current customers."""
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'},
+                            status=HTTPStatus.METHOD_NOT_ALLOWED)
+    amount = None if buffers_changes() else cached_current_amount()
+    if amount is None:
+        amount = await run_in_db_thread(get_occupancy)
+    return JsonResponse({'amount': amount})
+
+
+async def _set_calling(table_number: int, is_calling: bool) -> JsonResponse:
+    if await run_in_db_thread(set_calling, table_number, is_calling) is None:
+        return JsonResponse({'detail': 'Not found.'}, status=HTTPStatus.NOT_FOUND)
+    broker.publish(table_event(table_number, is_calling))
+    return JsonResponse({'message': 'success'})
+
+
+@csrf_exempt
+async def call_staff(request, table_number):
+    """
+    Call the staff to come to the table
+    """
+    return await _post_view(request, TABLE_AUTHENTICATION, lambda user: _set_calling(table_number, True))
+
+
+@csrf_exempt
+async def complete_order(request, table_number):
+    """
+    Complete the order customers requested.
+
+    The table will be back to non-calling state.
+    """
+    return await _post_view(request, TABLE_AUTHENTICATION, lambda user: _set_calling(table_number, False),
+                            staff_only=True)
@@ -0,0 +1,122 @@
+import collections
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+
+_GENERATION = struct.Struct('<Q')
+
+
+class SharedGeneration:
+    """
+    Number in a memory-mapped file that all workers map, bumped to drop their caches.
+
+    Readers take no lock, writers take an exclusive file lock so no bump is lost.
+    The file is TOKEN_GENERATION_FILE, opened again when the setting changes.
+    """
+
+    def __init__(self):
+        self._opened = None
+
+    def _open(self):
+        # A forked worker must map the file again.
+        opened = (os.getpid(), settings.TOKEN_GENERATION_FILE)
+        if self._opened != opened:
+            path = settings.TOKEN_GENERATION_FILE
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._file = open(path, 'a+b')
+            if os.fstat(self._file.fileno()).st_size < _GENERATION.size:
+                self._file.truncate(_GENERATION.size)
+            self._mmap = mmap.mmap(self._file.fileno(), _GENERATION.size)
+            self._opened = opened
+
+    def read(self) -> int:
+        self._open()
+        return _GENERATION.unpack_from(self._mmap, 0)[0]
+
+    def bump(self):
+        self._open()
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            _GENERATION.pack_into(self._mmap, 0, _GENERATION.unpack_from(self._mmap, 0)[0] + 1)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+
+class TokenCache:
+    """
+    Validated tokens of this worker with a time to live and LRU eviction.
+
+    Deleting a token or changing a user (see signals) bumps a generation
+    shared by every worker of the server, which drops all their entries.
+    Changes that send no signal (a queryset update) are seen after
+    TOKEN_CACHE_TTL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.shared_generation = SharedGeneration()
+
+    @property
+    def generation(self) -> int:
+        """Read it before looking up a token, a lookup that raced with an invalidation is not kept."""
+        return self.shared_generation.read()
+
+    def get(self, key: str):
+        """Get (user, token) of the key, None if it is not cached, expired or invalidated."""
+        generation = self.generation
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, entry_generation, credentials = entry
+            if expires_at < time.monotonic() or entry_generation != generation:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return credentials
+
+    def set(self, key: str, credentials: tuple, generation: int):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + settings.TOKEN_CACHE_TTL, generation, credentials)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.TOKEN_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drop the entries of every worker, now and again after the commit of the change."""
+        self.shared_generation.bump()
+        transaction.on_commit(self.shared_generation.bump)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that remembers validated tokens.
+
+    It is meant for the hardware, which sends a request for every customer.
+    A remembered token costs a read of the shared generation instead of a
+    query. BasicAuthentication, which the hardware endpoints also accept,
+    is not cached and hashes the password on every request.
+    """
+
+    def authenticate_credentials(self, key):
+        credentials = token_cache.get(key)
+        if credentials is None:
+            generation = token_cache.generation
+            credentials = super().authenticate_credentials(key)
+            token_cache.set(key, credentials, generation)
+        return credentials
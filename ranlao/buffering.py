@@ -0,0 +1,164 @@
+import collections
+import datetime
+import logging
+import threading
+from typing import Callable
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class DeltaBuffer:
+    """
+    Write-behind accumulator of visitor changes.
+
+    Changes are merged per (zero time, entrance) in memory and a background thread writes
+    them to the database every COUNTING_FLUSH_INTERVAL seconds or when
+    COUNTING_FLUSH_THRESHOLD changes are waiting, whichever comes first.
+
+    Note: Merged changes are applied as one net change per hour,
+    so the non-negative guard applies to the net change. The enters
+    are counted apart so the entries of the day are not the net change.
+
+    A change may carry a submission, (device, idempotency key), that is
+    stored when the change is written. A submission that turns out to be
+    stored already (a retry sent to another worker) is taken out of its
+    change instead of being written.
+    """
+
+    def __init__(self, apply: Callable[[datetime.datetime, int, str, int], None],
+                 append: Callable[[list, dict], set] = None):
+        self._apply = apply
+        # Stores the submissions and writes the raw events of the changes in one
+        # transaction, returns the submissions that were stored already.
+        self._append = append
+        self._lock = threading.Lock()
+        # Serialize flushes so hours are always written in order.
+        self._flush_lock = threading.Lock()
+        # Held while a change moves from memory to the database.
+        self._apply_lock = threading.Lock()
+        # key: [net change, entries]
+        self._pending = collections.defaultdict(lambda: [0, 0])
+        self._pending_count = 0
+        self._events = []
+        # submission: (key, amount, event)
+        self._submissions = {}
+        # Changes and submissions taken by the flush but not written yet.
+        self._in_flight = {}
+        self._flushing = {}
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def add(self, key: tuple, amount: int, event=None, submission: tuple = None) -> bool:
+        """
+        Record the change of (zero time, entrance), and its raw event if any, and return immediately.
+
+        Returns False, and records nothing, if the submission is waiting in the buffer already.
+        """
+        with self._lock:
+            if submission is not None:
+                if submission in self._submissions or submission in self._flushing:
+                    return False
+                self._submissions[submission] = (key, amount, event)
+            change = self._pending[key]
+            change[0] += amount
+            change[1] += max(amount, 0)
+            if event is not None:
+                self._events.append(event)
+            self._pending_count += 1
+            if self._thread is None:
+                self._start()
+            if self._pending_count >= settings.COUNTING_FLUSH_THRESHOLD:
+                self._wakeup.set()
+        return True
+
+    def pending_amount(self) -> int:
+        """Net change that is not written to the database yet."""
+        with self._lock:
+            return sum(amount for amount, entries in [*self._pending.values(), *self._in_flight.values()])
+
+    def read_with_pending(self, read: Callable[[], int]) -> int:
+        """
+        Add pending changes to an amount read from the database.
+
+        No change is counted twice or missed while it is being flushed.
+        """
+        with self._apply_lock:
+            return read() + self.pending_amount()
+
+    def flush(self):
+        """Write all pending events and changes to the database, oldest hour first."""
+        with self._flush_lock:
+            with self._lock:
+                self._in_flight = self._pending
+                self._pending = collections.defaultdict(lambda: [0, 0])
+                self._pending_count = 0
+                events, self._events = self._events, []
+                self._flushing, self._submissions = self._submissions, {}
+            try:
+                if events:
+                    stored = self._append(events, {
+                        submission: event for submission, (key, amount, event) in self._flushing.items()
+                    })
+                    with self._lock:
+                        for submission in stored:
+                            key, amount, event = self._flushing[submission]
+                            change = self._in_flight[key]
+                            change[0] -= amount
+                            change[1] -= max(amount, 0)
+                        self._flushing = {}
+                    events = []
+                for key in sorted(self._in_flight):
+                    with self._apply_lock:
+                        amount, entries = self._in_flight[key]
+                        if amount or entries:
+                            zero_time, entrance = key
+                            self._apply(zero_time, amount, entrance, entries)
+                        with self._lock:
+                            del self._in_flight[key]
+            finally:
+                # Keep what is not written for the next flush.
+                with self._lock:
+                    for key, (amount, entries) in self._in_flight.items():
+                        change = self._pending[key]
+                        change[0] += amount
+                        change[1] += entries
+                    self._in_flight = {}
+                    self._events = events + self._events
+                    self._submissions.update(self._flushing)
+                    self._flushing = {}
+
+    def stop(self):
+        """Stop the flusher and write what is left."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._stopping = True
+        self._wakeup.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def _start(self):
+        self._stopping = False
+        self._wakeup.clear()
+        self._thread = threading.Thread(target=self._run, name='ranlao-delta-buffer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stopping:
+                self._wakeup.wait(settings.COUNTING_FLUSH_INTERVAL)
+                self._wakeup.clear()
+                if self._stopping:
+                    break
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Cannot flush visitor changes.")
+        finally:
+            connection.close()
+
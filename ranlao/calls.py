@@ -0,0 +1,130 @@
+import collections
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Table, TableCall
+
+
+class CallQueue:
+    """
+    Open calls of this worker by table number, the oldest first.
+
+    Calls of this worker are added and removed right away, the queue
+    is read again from the database after READ_CACHE_TIMEOUT seconds
+    to see the calls of other workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = collections.OrderedDict()
+        self._loaded_at = None
+        # Bumped on every change so a load that raced with it is not kept.
+        self._generation = 0
+
+    def open_calls(self) -> list:
+        """Get (table number, raised at) of the open calls, the oldest first."""
+        with self._lock:
+            fresh = self._loaded_at is not None and time.monotonic() - self._loaded_at < settings.READ_CACHE_TIMEOUT
+            if fresh:
+                return list(self._calls.items())
+            generation = self._generation
+        calls = list(
+            TableCall.objects.filter(resolved_at__isnull=True)
+            .order_by('raised_at')
+            .values_list('table__table_number', 'raised_at')
+        )
+        with self._lock:
+            if generation == self._generation:
+                self._calls = collections.OrderedDict(calls)
+                self._loaded_at = time.monotonic()
+        return calls
+
+    def opened(self, table_number: int, raised_at: datetime.datetime):
+        with self._lock:
+            self._generation += 1
+            self._calls[table_number] = raised_at
+
+    def resolved(self, table_number: int):
+        with self._lock:
+            self._generation += 1
+            self._calls.pop(table_number, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = None
+
+
+call_queue = CallQueue()
+
+
+def open_call(table_number: int, raised_at: datetime.datetime):
+    """Record the call of the table. A call that is already open is kept."""
+    table_id = Table.objects.filter(table_number=table_number).values_list('id', flat=True).first()
+    TableCall.objects.bulk_create([TableCall(table_id=table_id, raised_at=raised_at)], ignore_conflicts=True)
+    transaction.on_commit(lambda: call_queue.opened(table_number, raised_at))
+
+
+def resolve_call(table_number: int, resolved_at: datetime.datetime):
+    """Record that the staff answered the open call of the table, in one conditional UPDATE."""
+    TableCall.objects.filter(table__table_number=table_number, resolved_at__isnull=True) \
+        .update(resolved_at=resolved_at)
+    transaction.on_commit(lambda: call_queue.resolved(table_number))
+
+
+def match_call(table: Table, at: datetime.datetime):
+    """
+    Open or resolve the call of a saved table to match is_calling.
+
+    It keeps the calls right when is_calling is changed without set_calling
+    (for example in the admin). An open call is kept while the table calls.
+    """
+    if table.is_calling:
+        TableCall.objects.bulk_create([TableCall(table_id=table.pk, raised_at=at)], ignore_conflicts=True)
+    else:
+        TableCall.objects.filter(table_id=table.pk, resolved_at__isnull=True).update(resolved_at=at)
+    transaction.on_commit(call_queue.invalidate)
+
+
+def resolve_calls(table_numbers: list, resolved_at: datetime.datetime, answered: bool = True):
+    """
+    Close the open calls of the tables in one statement.
+
+    Calls that were not answered (for example at closing time) are deleted
+    so they are left out of the response times.
+    """
+    calls = TableCall.objects.filter(table__table_number__in=table_numbers, resolved_at__isnull=True)
+    if answered:
+        calls.update(resolved_at=resolved_at)
+    else:
+        calls.delete()
+    transaction.on_commit(call_queue.invalidate)
+
+
+def _percentile(durations: list, percent: float) -> float:
+    """Nearest-rank percentile of sorted durations."""
+    index = max(0, min(len(durations) - 1, round(percent / 100 * len(durations)) - 1))
+    return durations[index]
+
+
+def response_times(start: datetime.datetime, end: datetime.datetime) -> dict:
+    """Statistic in seconds of the time the staff took to answer the calls resolved from start to end."""
+    durations = sorted(
+        (resolved_at - raised_at).total_seconds()
+        for raised_at, resolved_at in TableCall.objects
+        .filter(resolved_at__gte=start, resolved_at__lt=end)
+        .values_list('raised_at', 'resolved_at')
+    )
+    if not durations:
+        return {'calls': 0, 'average': None, 'median': None, 'p90': None, 'max': None}
+    return {
+        'calls': len(durations),
+        'average': sum(durations) / len(durations),
+        'median': _percentile(durations, 50),
+        'p90': _percentile(durations, 90),
+        'max': durations[-1],
+    }
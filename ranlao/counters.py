@@ -0,0 +1,300 @@
+import atexit
+import collections
+import contextlib
+import datetime
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from .buffering import DeltaBuffer
+from .idempotency import claim, submitted
+from .metrics import timed
+from .models import Entrance, VisitorEvent, VisitorLog
+from .occupancy import SharedOccupancy
+from .rollups import record_change
+from .timeseries import amount_at, amount_before, hourly_series, iter_hourly_series, register_entrances, \
+    truncate_hour
+
+# How many hours before this hour /log/ shows.
+LOG_WINDOW = datetime.timedelta(hours=6)
+
+CURRENT_AMOUNT_KEY = 'ranlao:current_amount'
+RECENT_LOGS_KEY = 'ranlao:recent_logs'
+
+# Current customers shared by the workers when SHARED_OCCUPANCY is on.
+shared_occupancy = SharedOccupancy(settings.SHARED_OCCUPANCY_FILE)
+
+# Bumped on every write so a read that raced with it is not cached.
+_write_generation = 0
+
+
+def _bump(zero_time: datetime.datetime, entrance: str, amount: int) -> int:
+    """
+    Add amount to the logs of the entrance from the hour of zero_time on in a single UPDATE.
+
+    Entrances write to their own rows. A change of a past hour (a flush
+    after the hour turned or an upload of old events) is carried to the
+    later logs, so it is not lost when another writer created them meanwhile.
+    A negative amount is rejected as a whole (nothing is updated) when the
+    amount of the pub (the sum of the entrances) would go below zero at
+    any hour it changes, checked while the entrances are locked.
+    Returns the number of updated rows.
+    """
+    logs = VisitorLog.objects.filter(log_time__gte=zero_time, entrance=entrance)
+    with transaction.atomic():
+        if amount < 0:
+            _lock_entrances(entrance)
+            if _lowest_total(zero_time) + amount < 0:
+                return 0
+        updated = logs.update(amount=F('amount') + amount)
+    if updated:
+        _invalidate_reads()
+    return updated
+
+
+def _lock_entrances(entrance: str):
+    """
+    Make leaves wait for each other before they read the amount of the pub.
+
+    The rows of every entrance are locked until the transaction ends.
+    SQLite has no row locks, a write takes its database lock instead.
+    """
+    if connection.features.has_select_for_update:
+        list(Entrance.objects.select_for_update().order_by('pk').values_list('pk', flat=True))
+    else:
+        Entrance.objects.filter(name=entrance).update(name=F('name'))
+
+
+def _lowest_total(zero_time: datetime.datetime) -> int:
+    """Get the lowest amount of the pub from the hour of zero_time to the latest log or now."""
+    latest = VisitorLog.objects.filter(log_time__gte=zero_time).aggregate(latest=Max('log_time'))['latest']
+    end = max(zero_time, truncate_hour(timezone.now()), latest or zero_time)
+    return min(amount for log_time, amount in iter_hourly_series(zero_time, end))
+
+
+def _create_log(zero_time: datetime.datetime, entrance: str):
+    """
+    Create the log of the hour of the entrance with its last known amount.
+
+    Hours without changes have no log, they are filled when reading.
+    A log created by another worker in the meantime is left alone.
+    """
+    register_entrances(entrance)
+    VisitorLog.objects.bulk_create(
+        [VisitorLog(log_time=zero_time, entrance=entrance, amount=amount_before(zero_time, entrance))],
+        ignore_conflicts=True
+    )
+    _invalidate_reads()
+
+
+@timed('ranlao_counter_change_duration_seconds')
+def apply_delta(time: datetime.datetime, amount: int, entrance: str = '', entries: int = None):
+    """
+    Change the visitor amount of the hour of time through the entrance.
+
+    entries is the customers that came in, when amount is the net change of
+    many enters and leaves, by default the amount if it is positive.
+    The common case is one UPDATE statement. Only the first change
+    of an hour at an entrance has to create its log.
+    """
+    if entries is None:
+        entries = max(amount, 0)
+    zero_time = truncate_hour(time)
+    with _shared_lock():
+        if zero_time < truncate_hour(timezone.now()) and \
+                not VisitorLog.objects.filter(log_time=zero_time, entrance=entrance).exists():
+            # Later logs of the entrance would take the change without this hour.
+            _create_log(zero_time, entrance)
+        if not _bump(zero_time, entrance, amount):
+            if not VisitorLog.objects.filter(log_time=zero_time, entrance=entrance).exists():
+                _create_log(zero_time, entrance)
+            # Another worker may have created the log meanwhile, so try again.
+            # If it still fails, the change does not make sense (it goes below zero).
+            if not _bump(zero_time, entrance, amount):
+                return
+        record_change(zero_time, amount, entries)
+        if settings.SHARED_OCCUPANCY:
+            transaction.on_commit(lambda: _share_change(zero_time, amount))
+
+
+def apply_deltas(deltas: dict):
+    """
+    Apply the changes of many hours in a single transaction.
+
+    deltas maps (zero time, entrance) of each hour to (net change, entries),
+    so the entries of the day count every enter. Hours are applied from
+    the oldest one so new logs carry the earlier amounts forward.
+    """
+    with _shared_lock(), transaction.atomic():
+        for zero_time, entrance in sorted(deltas):
+            amount, entries = deltas[zero_time, entrance]
+            if amount or entries:
+                apply_delta(zero_time, amount, entrance, entries)
+
+
+def record_events(events: list, device: str = '', key=None) -> bool:
+    """
+    Append raw events and apply the net change of each hour in a single transaction.
+
+    events is a list of unsaved VisitorEvent. Returns False, and writes
+    nothing, if the device already sent the idempotency key.
+    """
+    deltas = collections.defaultdict(lambda: [0, 0])
+    for event in events:
+        change = deltas[truncate_hour(event.timestamp.astimezone(datetime.timezone.utc)), event.entrance]
+        change[0] += event.delta
+        change[1] += max(event.delta, 0)
+    with _shared_lock(), transaction.atomic():
+        if not claim(device, key):
+            return False
+        append_events(events)
+        apply_deltas(deltas)
+    return True
+
+
+def append_events(events: list):
+    """Store raw events as one batch, the changes they make are applied together."""
+    batch = uuid.uuid4()
+    for event in events:
+        event.batch = batch
+    VisitorEvent.objects.bulk_create(events)
+
+
+def append_submitted(events: list, submissions: dict) -> set:
+    """
+    Store the keys of buffered submissions with the raw events, in one transaction.
+
+    submissions maps (device, key) to the event of the submission. Returns
+    the submissions that were stored already, their events are left out.
+    """
+    with transaction.atomic():
+        stored = {submission for submission in submissions if not claim(*submission)}
+        left_out = {id(submissions[submission]) for submission in stored}
+        append_events([event for event in events if id(event) not in left_out])
+    return stored
+
+
+def invalidate_counts():
+    """Drop cached and shared counts after the logs were written again."""
+    _invalidate_reads()
+    if settings.SHARED_OCCUPANCY:
+        shared_occupancy.invalidate()
+
+
+def _shared_lock():
+    """
+    Hold the lock of the shared counter from a write until it is shared.
+
+    Otherwise a worker reading the database meanwhile would count it twice.
+    """
+    return shared_occupancy.locked() if settings.SHARED_OCCUPANCY else contextlib.nullcontext()
+
+
+def _share_change(zero_time: datetime.datetime, amount: int):
+    """Add a committed change to the shared counter, or read it again at a new hour."""
+    current_zero_time = truncate_hour(timezone.now())
+    if zero_time > current_zero_time:
+        return
+    with shared_occupancy.locked():
+        if zero_time < current_zero_time or not shared_occupancy.add(zero_time, amount):
+            # A change of a past hour only shows up now if later hours have no log.
+            shared_occupancy.reconcile(current_zero_time, lambda: amount_at(current_zero_time))
+
+
+def _shared_current_amount(zero_time: datetime.datetime) -> int:
+    """Read the shared counter, from the database the first time in a worker and at a new hour."""
+    amount = shared_occupancy.read(zero_time)
+    if amount is None:
+        with shared_occupancy.locked():
+            amount = shared_occupancy.read(zero_time)
+            if amount is None:
+                amount = shared_occupancy.reconcile(zero_time, lambda: amount_at(zero_time))
+    return amount
+
+
+def _invalidate_reads():
+    """Drop cached reads now and again when the transaction commits."""
+    _drop_reads()
+    transaction.on_commit(_drop_reads)
+
+
+def _drop_reads():
+    global _write_generation
+    _write_generation += 1
+    cache.delete_many([CURRENT_AMOUNT_KEY, RECENT_LOGS_KEY])
+
+
+def logs_version() -> tuple:
+    """Version of the logs written by this worker, it changes at a new hour and after every write."""
+    return truncate_hour(timezone.now()), _write_generation
+
+
+def _cached_read(key: str, zero_time: datetime.datetime, read):
+    """Read through the cache. Cached values are only valid for their hour."""
+    cached = cache.get(key)
+    if cached is not None and cached[0] == zero_time:
+        return cached[1]
+    generation = _write_generation
+    value = read()
+    if generation == _write_generation:
+        cache.set(key, (zero_time, value), settings.READ_CACHE_TIMEOUT)
+    return value
+
+
+def current_amount() -> int:
+    """Get numbers of current customers from the cache or the latest log."""
+    zero_time = truncate_hour(timezone.now())
+    if settings.SHARED_OCCUPANCY:
+        return _shared_current_amount(zero_time)
+    return _cached_read(CURRENT_AMOUNT_KEY, zero_time, lambda: amount_at(zero_time))
+
+
+def cached_current_amount():
+    """Get numbers of current customers only if it is cached, otherwise None."""
+    if settings.SHARED_OCCUPANCY:
+        return shared_occupancy.read(truncate_hour(timezone.now()))
+    cached = cache.get(CURRENT_AMOUNT_KEY)
+    if cached is not None and cached[0] == truncate_hour(timezone.now()):
+        return cached[1]
+    return None
+
+
+def recent_logs() -> list:
+    """Get (log_time, amount) of the last 6 hours and this hour, the latest first."""
+    zero_time = truncate_hour(timezone.now())
+    return _cached_read(
+        RECENT_LOGS_KEY, zero_time,
+        lambda: hourly_series(zero_time - LOG_WINDOW, zero_time)[::-1]
+    )
+
+
+delta_buffer = DeltaBuffer(apply_delta, append_submitted)
+atexit.register(delta_buffer.stop)
+
+
+def buffers_changes() -> bool:
+    """Whether changes may wait in the buffer, so reads must add them."""
+    return settings.BUFFERED_COUNTING or settings.SENSOR_COALESCE
+
+
+def record_delta(time: datetime.datetime, amount: int, device: str = '', entrance: str = '',
+                 key=None, coalesce: bool = False) -> bool:
+    """
+    Record a change from the hardware at an entrance with its raw event.
+
+    It is written to the database right away unless BUFFERED_COUNTING is on
+    or coalesce is set (a device over its rate), then it is merged in the buffer
+    and its key is stored when the buffer is written.
+    Returns False if the device already sent the idempotency key.
+    """
+    event = VisitorEvent(timestamp=time, device=device, entrance=entrance, delta=amount)
+    if settings.BUFFERED_COUNTING or coalesce:
+        if submitted(device, key):
+            return False
+        return delta_buffer.add((truncate_hour(time), entrance), amount, event,
+                                None if key is None else (device, key))
+    return record_events([event], device, key)
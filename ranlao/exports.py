@@ -0,0 +1,46 @@
+import csv
+import datetime
+import json
+
+from django.utils import timezone
+
+from .models import VisitorLog
+from .rollups import day_range
+
+EXPORT_FIELDS = ('log_time', 'entrance', 'amount')
+CONTENT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+class Echo:
+    """File-like object of csv.writer that gives the line back instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def export_logs(start: datetime.date, end: datetime.date, output: str = 'csv', entrance: str = None,
+                chunk_size: int = 2000):
+    """
+    Yield the hourly logs of the local days from start to end as lines of CSV (with a header) or NDJSON.
+
+    Logs are read in chunks of chunk_size rows (with a server-side cursor
+    where the database has one), so memory does not grow with the range.
+    Only hours that changed have a log, times are in the local time zone.
+    """
+    logs = VisitorLog.objects.filter(
+        log_time__gte=day_range(start)[0],
+        log_time__lt=day_range(end + datetime.timedelta(days=1))[0],
+    )
+    if entrance is not None:
+        logs = logs.filter(entrance=entrance)
+    rows = logs.order_by('log_time', 'entrance').values_list(*EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    if output == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(EXPORT_FIELDS)
+        for log_time, log_entrance, amount in rows:
+            yield writer.writerow((timezone.localtime(log_time).isoformat(), log_entrance, amount))
+    else:
+        for log_time, log_entrance, amount in rows:
+            yield json.dumps({
+                'log_time': timezone.localtime(log_time).isoformat(), 'entrance': log_entrance, 'amount': amount
+            }) + '\n'
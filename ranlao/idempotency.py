@@ -0,0 +1,137 @@
+import collections
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .models import SensorSequence, Submission
+
+# Longest key accepted from the hardware.
+MAX_KEY_LENGTH = 64
+# Most digits of a sequence number, it fits in a PositiveBigIntegerField.
+MAX_SEQ_DIGITS = 18
+
+
+class DedupeIndex:
+    """
+    Recent submissions of this worker, with a time window and LRU eviction.
+
+    It only saves queries for retries, the Submission table is what tells
+    duplicates apart across workers and restarts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._pruned_at = 0.0
+
+    def seen(self, key: tuple) -> bool:
+        with self._lock:
+            added_at = self._entries.get(key)
+            if added_at is None:
+                return False
+            if added_at < time.monotonic() - settings.IDEMPOTENCY_WINDOW:
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, key: tuple):
+        with self._lock:
+            self._entries[key] = time.monotonic()
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.IDEMPOTENCY_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def prune_due(self) -> bool:
+        """True at most once a minute, when old submissions should be deleted."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._pruned_at < 60:
+                return False
+            self._pruned_at = now
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pruned_at = 0.0
+
+
+dedupe_index = DedupeIndex()
+
+
+def submission_key(request):
+    """
+    Get the key of a submission, None if there is none.
+
+    It is the Idempotency-Key header, kept for IDEMPOTENCY_WINDOW seconds,
+    or the number of ?seq=. Retries of a submission must send the same key.
+
+    A device sends its changes one at a time with a number that increases,
+    so only its latest number can be retried. Any other number is a new
+    change, a smaller one is a device that counts again from its start (after
+    a reboot).
+    """
+    key = request.headers.get('Idempotency-Key')
+    if key is None and 'seq' in request.GET:
+        seq = request.GET['seq']
+        if not (seq.isdigit() and len(seq) <= MAX_SEQ_DIGITS):
+            raise ValidationError({'seq': f"Sequence number must have 1 to {MAX_SEQ_DIGITS} digits."})
+        return int(seq)
+    if key is not None and not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise ValidationError({'detail': f"Idempotency key must have 1 to {MAX_KEY_LENGTH} characters."})
+    return key
+
+
+def submitted(device: str, key) -> bool:
+    """Whether the device already submitted the key, without storing it."""
+    if key is None:
+        return False
+    if isinstance(key, int):
+        return SensorSequence.objects.filter(device=device, seq=key).exists()
+    return dedupe_index.seen((device, key)) or Submission.objects.filter(device=device, key=key).exists()
+
+
+def claim(device: str, key) -> bool:
+    """
+    Store the key of the device. False if it was already submitted.
+
+    Call it in the transaction of the write, so a write that fails
+    does not keep its key.
+    """
+    if key is None:
+        return True
+    if isinstance(key, int):
+        return _claim_sequence(device, key)
+    if dedupe_index.seen((device, key)):
+        return False
+    try:
+        with transaction.atomic():
+            Submission.objects.create(device=device, key=key, created_at=timezone.now())
+    except IntegrityError:
+        dedupe_index.add((device, key))
+        return False
+    transaction.on_commit(lambda: dedupe_index.add((device, key)))
+    if dedupe_index.prune_due():
+        Submission.objects.filter(
+            created_at__lt=timezone.now() - datetime.timedelta(seconds=settings.IDEMPOTENCY_WINDOW)
+        ).delete()
+    return True
+
+
+def _claim_sequence(device: str, seq: int) -> bool:
+    """Make seq the latest number of the device. False if it already is."""
+    if SensorSequence.objects.filter(device=device).exclude(seq=seq).update(seq=seq):
+        return True
+    try:
+        with transaction.atomic():
+            SensorSequence.objects.create(device=device, seq=seq)
+    except IntegrityError:
+        # The device has a number, and it is seq.
+        return False
+    return True
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import Client
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure /enter/ and /leave/ throughput on a throwaway database of the current DB_PROFILE. "
+        "Run it with each profile, for example DB_PROFILE=sqlite-plain python manage.py bench_counting."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help="Sensors posting at the same time.")
+        parser.add_argument('--requests', type=int, default=200, help="Requests of each sensor.")
+
+    def handle(self, *args, threads, requests, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            key = Token.objects.create(user=User.objects.create_user(username='bench-sensor')).key
+            elapsed, errors = self.run_sensors(key, threads, requests)
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        total = threads * requests
+        self.stdout.write(
+            f"{settings.DB_PROFILE}: {total} requests from {threads} sensors in {elapsed:.2f}s, "
+            f"{(total - errors) / elapsed:.0f} requests/s, {errors} failed"
+        )
+
+    def run_sensors(self, key: str, threads: int, requests: int):
+        """Post enter and leave alternately from many threads. Returns the time taken and failures."""
+        barrier = threading.Barrier(threads + 1)
+        failures = []
+
+        def sensor():
+            client = Client(HTTP_AUTHORIZATION=f'Token {key}')
+            urls = [reverse('enter'), reverse('leave')]
+            barrier.wait()
+            try:
+                for i in range(requests):
+                    try:
+                        response = client.post(urls[i % 2])
+                        if response.status_code != 200:
+                            failures.append(response.status_code)
+                    except Exception as e:
+                        failures.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=sensor) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - start, len(failures)
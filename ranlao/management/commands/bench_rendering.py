@@ -0,0 +1,76 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from ranlao.counters import recent_logs
+from ranlao.models import Table, VisitorLog
+from ranlao.rendering import recent_logs_body, render_recent_logs, render_tables, rendered_bodies, tables_body
+from ranlao.serializers import TableSerializer
+from ranlao.tables import table_version
+from ranlao.timeseries import truncate_hour
+
+
+def serializer_tables() -> bytes:
+    """Tables through TableSerializer and JSONRenderer, as /table/ was rendered before."""
+    return JSONRenderer().render(TableSerializer(Table.objects.all(), many=True).data)
+
+
+def serializer_logs() -> bytes:
+    """Logs converted row by row and encoded by JSONRenderer, as /log/ was rendered before."""
+    converted_logs = []
+    for log_time, amount in recent_logs():
+        log_time = timezone.localtime(log_time)
+        converted_logs.append({'log_time': f"{log_time.hour}:00-{log_time.hour+1}:00", 'amount': amount})
+    return JSONRenderer().render(converted_logs)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare rendering /table/ and /log/ through the serializers with the encoded bodies "
+        "on a throwaway database of the current DB_PROFILE."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tables', type=int, default=100, help="Tables in the database.")
+        parser.add_argument('--requests', type=int, default=2000, help="Renders of each path.")
+
+    def handle(self, *args, tables, requests, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            Table.objects.bulk_create(
+                [Table(table_number=number, version=number, is_calling=number % 3 == 0)
+                 for number in range(1, tables + 1)]
+            )
+            zero_time = truncate_hour(timezone.now())
+            VisitorLog.objects.bulk_create(
+                [VisitorLog(log_time=zero_time - datetime.timedelta(hours=hours), amount=hours * 3)
+                 for hours in range(7)]
+            )
+            rendered_bodies.clear()
+            paths = [
+                ('tables, serializer', serializer_tables),
+                ('tables, values', render_tables),
+                # As the view does, the version is looked up for every request.
+                ('tables, cached body', lambda: tables_body(table_version())),
+                ('logs, serializer', serializer_logs),
+                ('logs, values', render_recent_logs),
+                ('logs, cached body', recent_logs_body),
+            ]
+            for name, render in paths:
+                elapsed = self.measure(render, requests)
+                self.stdout.write(f"{name}: {elapsed / requests * 1e6:.1f}us a render, {requests / elapsed:.0f}/s")
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    @staticmethod
+    def measure(render, requests: int) -> float:
+        render()
+        start = time.perf_counter()
+        for _ in range(requests):
+            render()
+        return time.perf_counter() - start
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ranlao.exports import export_logs
+from ranlao.rollups import local_date
+from ranlao.serializers import LogExportSerializer
+
+
+class Command(BaseCommand):
+    help = "Export the hourly logs of local days as CSV or NDJSON, for example for the monthly report."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', required=True, help="First local day (YYYY-MM-DD).")
+        parser.add_argument('--end', help="Last local day (YYYY-MM-DD), default today.")
+        parser.add_argument('--format', choices=('csv', 'ndjson'), default='csv')
+        parser.add_argument('--entrance', help="Only the logs of this door, all of them by default.")
+        parser.add_argument('--output', help="File to write, default standard output.")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Logs read at once.")
+
+    def handle(self, *args, **options):
+        query = {'start': options['start'], 'output': options['format']}
+        for name in ('end', 'entrance'):
+            if options[name] is not None:
+                query[name] = options[name]
+        serializer = LogExportSerializer(data=query)
+        if not serializer.is_valid():
+            raise CommandError(serializer.errors)
+        params = serializer.validated_data
+        lines = export_logs(params['start'], params.get('end') or local_date(timezone.now()), params['output'],
+                            params.get('entrance'), options['chunk_size'])
+        if options['output'] is None:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', newline='') as file:
+            file.writelines(lines)
@@ -0,0 +1,220 @@
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from ranlao.models import Table, UserTable
+
+
+def percentile(latencies: list, percent: float) -> float:
+    """Nearest-rank percentile of sorted latencies."""
+    index = max(0, min(len(latencies) - 1, round(percent / 100 * len(latencies)) - 1))
+    return latencies[index]
+
+
+def create_accounts(sensors: int, tablets: int, created: list) -> dict:
+    """
+    Create the tables and the users of the simulated pub. Returns their tokens.
+
+    The users and tables that did not exist yet are appended to created,
+    deleting them deletes their tokens too.
+    """
+    def token_of(username, **fields):
+        user, user_created = User.objects.get_or_create(username=username, defaults=fields)
+        if user_created:
+            created.append(user)
+        return Token.objects.get_or_create(user=user)[0].key
+
+    accounts = {
+        'sensors': [token_of(f'loadtest-sensor-{i}') for i in range(sensors)],
+        'tablets': [],
+        'staff': token_of('loadtest-staff', is_staff=True),
+    }
+    for i in range(1, tablets + 1):
+        table, table_created = Table.objects.get_or_create(table_number=i)
+        if table_created:
+            created.append(table)
+        key = token_of(f'loadtest-table-{i}')
+        UserTable.objects.get_or_create(user_id=Token.objects.get(key=key).user_id, table=table)
+        accounts['tablets'].append((i, key))
+    return accounts
+
+
+class Recorder:
+    """Latencies and failures of every endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+
+    def record(self, name: str, seconds: float, ok: bool):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.failures[name] += 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate a busy night against a running server (for example uvicorn exceed_ranlao.asgi:application) "
+        "and report throughput, latency percentiles and database queries of each endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help="Server to load.")
+        parser.add_argument('--duration', type=float, default=30, help="Seconds to run.")
+        parser.add_argument('--sensors', type=int, default=2, help="Door sensors posting enter and leave.")
+        parser.add_argument('--sensor-interval', type=float, default=0.05, help="Seconds between sensor events.")
+        parser.add_argument('--tablets', type=int, default=20, help="Table tablets polling.")
+        parser.add_argument('--poll-interval', type=float, default=1, help="Seconds between tablet polls.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the random choices of the clients.")
+        parser.add_argument('--json', dest='json_path', help="Also write the report to this file.")
+        parser.add_argument('--skip-queries', action='store_true', help="Do not count queries of each endpoint.")
+        parser.add_argument(
+            '--keep-accounts', action='store_true',
+            help="Keep the loadtest-* users, their tokens and the tables created for the run.",
+        )
+
+    def handle(self, *args, **options):
+        created = []
+        try:
+            accounts = create_accounts(options['sensors'], options['tablets'], created)
+            recorder = Recorder()
+            elapsed = self.run_load(options, accounts, recorder)
+        finally:
+            if not options['keep_accounts']:
+                for instance in reversed(created):
+                    instance.delete()
+        queries = {} if options['skip_queries'] else self.count_queries()
+        report = {}
+        for name, latencies in sorted(recorder.latencies.items()):
+            latencies.sort()
+            report[name] = {
+                'requests': len(latencies),
+                'failures': recorder.failures[name],
+                'throughput': len(latencies) / elapsed,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'queries': queries.get(name),
+            }
+        self.write_report(report)
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def run_load(self, options: dict, accounts: dict, recorder: Recorder) -> float:
+        """Run every simulated client until the duration ends. Returns the time taken."""
+        base_url = options['base_url'].rstrip('/')
+        deadline = time.monotonic() + options['duration']
+        tables = [number for number, key in accounts['tablets']]
+
+        def request(name: str, method: str, path: str, key: str):
+            http_request = urllib.request.Request(
+                base_url + path, method=method, headers={'Authorization': f'Token {key}'}
+            )
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(http_request, timeout=30) as response:
+                    response.read()
+                    ok = response.status < 400
+            except (urllib.error.URLError, OSError):
+                ok = False
+            recorder.record(name, time.perf_counter() - start, ok)
+
+        def sensor(key: str, rng: random.Random):
+            while time.monotonic() < deadline:
+                if rng.random() < 0.55:
+                    request('enter', 'POST', '/enter/', key)
+                else:
+                    request('leave', 'POST', '/leave/', key)
+                time.sleep(options['sensor_interval'])
+
+        def tablet(table_number: int, key: str, rng: random.Random):
+            while time.monotonic() < deadline:
+                request('table', 'GET', '/table/', key)
+                request('count', 'GET', '/count/', key)
+                request('user_status', 'GET', '/user-status/', key)
+                if rng.random() < 0.05:
+                    request('call_staff', 'POST', f'/call/{table_number}', key)
+                time.sleep(options['poll_interval'])
+
+        def dashboard(key: str, rng: random.Random):
+            while time.monotonic() < deadline:
+                request('log', 'GET', '/log/', key)
+                request('statistic', 'GET', '/stat/', key)
+                if tables:
+                    request('complete_order', 'POST', f'/complete/{rng.choice(tables)}', key)
+                time.sleep(options['poll_interval'])
+
+        # Each client has its own random numbers so runs make the same choices.
+        seed = options['seed']
+        threads = [
+            threading.Thread(target=sensor, args=(key, random.Random(f'{seed}-sensor-{i}')))
+            for i, key in enumerate(accounts['sensors'])
+        ]
+        threads += [
+            threading.Thread(target=tablet, args=(number, key, random.Random(f'{seed}-table-{number}')))
+            for number, key in accounts['tablets']
+        ]
+        threads.append(threading.Thread(target=dashboard, args=(accounts['staff'], random.Random(f'{seed}-staff'))))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def count_queries(self) -> dict:
+        """Count database queries of each endpoint in-process on a throwaway database."""
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            accounts = create_accounts(1, 1, [])
+            table_number, table_key = accounts['tablets'][0]
+            endpoints = {
+                'enter': ('post', '/enter/', accounts['sensors'][0]),
+                'leave': ('post', '/leave/', accounts['sensors'][0]),
+                'table': ('get', '/table/', table_key),
+                'count': ('get', '/count/', table_key),
+                'user_status': ('get', '/user-status/', table_key),
+                'call_staff': ('post', f'/call/{table_number}', table_key),
+                'log': ('get', '/log/', accounts['staff']),
+                'statistic': ('get', '/stat/', accounts['staff']),
+                'complete_order': ('post', f'/complete/{table_number}', accounts['staff']),
+            }
+            queries = {}
+            for name, (method, path, key) in endpoints.items():
+                client = Client(HTTP_AUTHORIZATION=f'Token {key}')
+                # Warm up caches like a server that has been running for a while.
+                getattr(client, method)(path)
+                with CaptureQueriesContext(connection) as context:
+                    for _ in range(5):
+                        getattr(client, method)(path)
+                queries[name] = len(context.captured_queries) / 5
+            return queries
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def write_report(self, report: dict):
+        self.stdout.write(
+            f"{'endpoint':<16}{'requests':>10}{'failed':>8}{'req/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+        )
+        for name, row in report.items():
+            queries = '-' if row['queries'] is None else f"{row['queries']:.1f}"
+            self.stdout.write(
+                f"{name:<16}{row['requests']:>10}{row['failures']:>8}{row['throughput']:>9.1f}"
+                f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{queries:>9}"
+            )
@@ -0,0 +1,23 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from ranlao.projections import rebuild_projections
+
+
+class Command(BaseCommand):
+    help = (
+        "Make the hourly logs and the statistics again from the raw enter and leave events. "
+        "Run it when the pub is closed, events recorded meanwhile may be missed until the next run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=datetime.date.fromisoformat,
+                            help="First local day to rebuild (YYYY-MM-DD), default the day of the first event.")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Events read and rows written at once.")
+
+    def handle(self, *args, **options):
+        result = rebuild_projections(options['since'], options['chunk_size'])
+        self.stdout.write(
+            f"Read {result['events']} events, wrote {result['logs']} hourly logs and {result['days']} days."
+        )
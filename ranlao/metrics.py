@@ -0,0 +1,264 @@
+"""
+Prometheus metrics shared by every worker through memory-mapped files.
+
+Each process writes its own file in METRICS_DIR and /metrics sums the
+files of all processes. The file of a process that ended is removed when
+the metrics are read, so its counts drop out like the counts of a restart.
+"""
+import asyncio
+import contextlib
+import functools
+import glob
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+
+# Upper bounds of the latency histograms in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+
+METRICS = {
+    'ranlao_requests_total': ('counter', "Requests by URL name, method and status."),
+    'ranlao_request_duration_seconds': ('histogram', "Request latency by URL name."),
+    'ranlao_counter_change_duration_seconds': ('histogram', "Latency of writing an enter or leave."),
+}
+
+_USED = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+_INITIAL_SIZE = 1 << 16
+# Label of the upper bound of a bucket, the last label of its key.
+_LE = re.compile(r'(?:^|,)le="([^"]*)"}$')
+_SUFFIX_ORDER = {'_bucket': 0, '_sum': 1, '_count': 2}
+
+
+def _entries(buffer, used: int):
+    """Yield (key, position of the value) of the entries in the buffer."""
+    position = _USED.size
+    while position < used:
+        length = _LENGTH.unpack_from(buffer, position)[0]
+        key = bytes(buffer[position + _LENGTH.size:position + _LENGTH.size + length]).decode()
+        position += _entry_size(length) - _VALUE.size
+        yield key, position
+        position += _VALUE.size
+
+
+def _entry_size(length: int) -> int:
+    """Key length, key padded to 8 bytes, then the value."""
+    return (_LENGTH.size + length + 7) // 8 * 8 + _VALUE.size
+
+
+class MmapValues:
+    """
+    Float values by key in a memory-mapped file written only by this process.
+
+    An entry is written before the used size in the header covers it,
+    so readers in other processes never see half an entry.
+    """
+
+    def __init__(self, path: str):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _INITIAL_SIZE:
+            self._file.truncate(_INITIAL_SIZE)
+            size = _INITIAL_SIZE
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._used = _USED.unpack_from(self._mmap, 0)[0] or _USED.size
+        # Values written by an earlier process with the same pid are kept.
+        self._positions = dict(_entries(self._mmap, self._used))
+
+    def add(self, key: str, amount: float):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            value = _VALUE.unpack_from(self._mmap, position)[0]
+            _VALUE.pack_into(self._mmap, position, value + amount)
+
+    def _append(self, key: str) -> int:
+        encoded = key.encode()
+        size = _entry_size(len(encoded))
+        if self._used + size > len(self._mmap):
+            self._grow(self._used + size)
+        _LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        self._mmap[self._used + _LENGTH.size:self._used + _LENGTH.size + len(encoded)] = encoded
+        position = self._used + size - _VALUE.size
+        _VALUE.pack_into(self._mmap, position, 0.0)
+        self._used += size
+        _USED.pack_into(self._mmap, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def _grow(self, needed: int):
+        size = len(self._mmap)
+        while size < needed:
+            size *= 2
+        self._mmap.close()
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _get_store() -> MmapValues:
+    """The file of this process, a forked worker opens its own."""
+    global _store
+    if _store is None or _store.pid != os.getpid():
+        with _store_lock:
+            if _store is None or _store.pid != os.getpid():
+                os.makedirs(settings.METRICS_DIR, exist_ok=True)
+                _store = MmapValues(os.path.join(settings.METRICS_DIR, f'metrics_{os.getpid()}.db'))
+    return _store
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def inc(name: str, amount: float = 1, **labels):
+    """Increase a counter."""
+    _get_store().add(name + _labels(dict(sorted(labels.items()))), amount)
+
+
+def observe(name: str, seconds: float, **labels):
+    """Add a latency to a histogram."""
+    store = _get_store()
+    labels = dict(sorted(labels.items()))
+    for bound in BUCKETS:
+        if seconds <= bound:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            store.add(f'{name}_bucket' + _labels({**labels, 'le': le}), 1)
+    store.add(f'{name}_sum' + _labels(labels), seconds)
+    store.add(f'{name}_count' + _labels(labels), 1)
+
+
+def _process_ended(path: str) -> bool:
+    """Whether the process that writes the file has ended, the workers run on this host."""
+    try:
+        pid = int(os.path.basename(path)[len('metrics_'):-len('.db')])
+        os.kill(pid, 0)
+    except ValueError:
+        return False
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # The process runs as another user.
+        return False
+    return False
+
+
+def collect() -> dict:
+    """Sum the values of every running process, the files of the others are removed."""
+    values = {}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, 'metrics_*.db')):
+        if _process_ended(path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            continue
+        with open(path, 'rb') as f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # The file is empty, the process has just started.
+                continue
+        with buffer:
+            used = _USED.unpack_from(buffer, 0)[0]
+            for key, position in _entries(buffer, used):
+                values[key] = values.get(key, 0.0) + _VALUE.unpack_from(buffer, position)[0]
+    return values
+
+
+def _metric_name(key: str) -> str:
+    name = key.split('{', 1)[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sample_order(key: str) -> tuple:
+    """Sort the samples of a metric by labels, then buckets by their upper bound, the sum and the count."""
+    name, _, labels = key.partition('{')
+    metric = _metric_name(key)
+    bound = 0.0
+    match = _LE.search(labels)
+    if match:
+        # float() reads '+Inf' as infinity, the last bucket.
+        bound = float(match.group(1))
+        labels = labels[:match.start()]
+    return metric, labels.rstrip('}'), _SUFFIX_ORDER.get(name[len(metric):], 0), bound
+
+
+def render(gauges: dict) -> str:
+    """Prometheus text format of every metric and the gauges given as {name: (help, value)}."""
+    by_metric = {}
+    for key, value in sorted(collect().items(), key=lambda item: _sample_order(item[0])):
+        by_metric.setdefault(_metric_name(key), []).append((key, value))
+    lines = []
+    for name, samples in by_metric.items():
+        kind, help_text = METRICS.get(name, ('untyped', ''))
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        lines += [f'{key} {value!r}' for key, value in samples]
+    for name, (help_text, value) in gauges.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value!r}']
+    return '\n'.join(lines) + '\n'
+
+
+def timed(name: str):
+    """Decorator adding the latency of each call to the histogram name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.METRICS_ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def _record_request(request, response, seconds: float):
+    resolver_match = getattr(request, 'resolver_match', None)
+    view = resolver_match.url_name if resolver_match and resolver_match.url_name else 'unmatched'
+    inc('ranlao_requests_total', view=view, method=request.method, status=response.status_code)
+    observe('ranlao_request_duration_seconds', seconds, view=view)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Count requests and their latency by URL name. It is removed unless METRICS_ENABLED is set."""
+    if not settings.METRICS_ENABLED:
+        raise MiddlewareNotUsed
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            _record_request(request, response, time.perf_counter() - start)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            _record_request(request, response, time.perf_counter() - start)
+            return response
+
+    return middleware
@@ -1,8 +1,25 @@
+import asyncio
+import collections
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils import timezone
 from rest_framework.authtoken.views import ObtainAuthToken
-from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from ranlao.profiles import get_profile
 
-from ranlao.models import UserTable
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    # asgiref before 3.6 cannot mark an object as a coroutine function, the
+    # middlewares below then stay sync and Django runs the chain in a thread.
+    markcoroutinefunction = None
 
 
 class CustomAuthToken(ObtainAuthToken):
@@ -12,14 +29,156 @@ class CustomAuthToken(ObtainAuthToken):
                                            context={'request': request})
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
-        try:
-            table = UserTable.objects.get(user=user)
-        except UserTable.DoesNotExist:
-            table = None
-        token, created = Token.objects.get_or_create(user=user)
-        is_staff = user.is_staff
+        profile = get_profile(user, with_token=True)
         return Response({
-            'token': token.key,
-            'table': table.table.table_number if table else None,
-            'is_staff': user.is_staff,
+            'token': profile['token'],
+            'table': profile['table'],
+            'is_staff': profile['is_staff'],
         })
+
+
+class QueryTimer:
+    """Execute wrapper counting queries and their time."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+# Recent profiles of this worker, the oldest ones are dropped.
+recent_profiles = collections.deque(maxlen=settings.PROFILING_BUFFER_SIZE)
+
+
+def _add_query_timer(timer: QueryTimer):
+    connection.execute_wrappers.append(timer)
+
+
+def _remove_query_timer(timer: QueryTimer):
+    connection.execute_wrappers.remove(timer)
+
+
+class ProfilingMiddleware:
+    """
+    Measure wall time, database time, queries and rendering time of requests.
+
+    The numbers are sent in the Server-Timing header and kept in
+    recent_profiles. Only PROFILING_SAMPLE_RATE of the requests are measured.
+    It is removed from the middleware chain unless PROFILING_ENABLED is set.
+
+    Under ASGI it stays async. Queries are timed in the thread of the
+    request, where Django runs the sync views, so the queries of the
+    async views (in their own threads) are not counted.
+    """
+    sync_capable = True
+    async_capable = markcoroutinefunction is not None
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # So Django calls it as a coroutine.
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if random.random() >= settings.PROFILING_SAMPLE_RATE:
+            return self.get_response(request)
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        return self.record(request, response, timer, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        if random.random() >= settings.PROFILING_SAMPLE_RATE:
+            return await self.get_response(request)
+        timer = QueryTimer()
+        start = time.perf_counter()
+        await sync_to_async(_add_query_timer, thread_sensitive=True)(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(_remove_query_timer, thread_sensitive=True)(timer)
+        return self.record(request, response, timer, time.perf_counter() - start)
+
+    @staticmethod
+    def record(request, response, timer: QueryTimer, total: float):
+        """Keep the profile of a measured request and add its Server-Timing header."""
+        render = getattr(request, '_profiling_render_seconds', 0.0)
+        resolver_match = getattr(request, 'resolver_match', None)
+        recent_profiles.append({
+            'url_name': resolver_match.url_name if resolver_match else None,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'time': timezone.now(),
+            'total_ms': total * 1000,
+            'db_ms': timer.seconds * 1000,
+            'queries': timer.count,
+            'render_ms': render * 1000,
+        })
+        response['Server-Timing'] = (
+            f'db;dur={timer.seconds * 1000:.1f};desc="{timer.count} queries", '
+            f'render;dur={render * 1000:.1f}, '
+            f'total;dur={total * 1000:.1f}'
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        """DRF responses are rendered right after this, so time the rendering."""
+        start = time.perf_counter()
+
+        def rendered(response):
+            request._profiling_render_seconds = time.perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware that stays async under ASGI.
+
+    WhiteNoise is sync only, so Django ran the rest of the chain, async
+    views included, through a thread. Static files are looked up in memory
+    and served right away, other requests are awaited directly.
+    """
+    sync_capable = True
+    async_capable = markcoroutinefunction is not None
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+
+def slowest_profiles(limit: int) -> dict:
+    """Get the slowest recent requests of each URL name."""
+    by_name = collections.defaultdict(list)
+    for profile in list(recent_profiles):
+        by_name[profile['url_name']].append(profile)
+    return {
+        str(name): sorted(profiles, key=lambda profile: profile['total_ms'], reverse=True)[:limit]
+        for name, profiles in by_name.items()
+    }
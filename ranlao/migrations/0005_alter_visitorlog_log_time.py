@@ -0,0 +1,30 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+def remove_duplicate_logs(apps, schema_editor):
+    """Keep only the latest log of each hour so log_time can be unique."""
+    VisitorLog = apps.get_model('ranlao', 'VisitorLog')
+    seen = set()
+    for log in VisitorLog.objects.order_by('-id').only('id', 'log_time').iterator():
+        if log.log_time in seen:
+            log.delete()
+        else:
+            seen.add(log.log_time)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0004_usertable'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_logs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='visitorlog',
+            name='log_time',
+            field=models.DateTimeField(unique=True),
+        ),
+    ]
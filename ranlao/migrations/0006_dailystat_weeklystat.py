@@ -0,0 +1,36 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0005_alter_visitorlog_log_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('peak', models.IntegerField(default=0)),
+                ('total_entries', models.IntegerField(default=0)),
+                ('average', models.FloatField(default=0)),
+                ('curve', models.JSONField(default=list)),
+                ('closed', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WeeklyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('week_start', models.DateField(unique=True)),
+                ('peak', models.IntegerField(default=0)),
+                ('total_entries', models.IntegerField(default=0)),
+                ('average', models.FloatField(default=0)),
+                ('curve', models.JSONField(default=list)),
+            ],
+        ),
+    ]
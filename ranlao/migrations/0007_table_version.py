@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0006_dailystat_weeklystat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='version',
+            field=models.PositiveBigIntegerField(db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0007_table_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(db_index=True)),
+                ('device', models.CharField(blank=True, default='', max_length=150)),
+                ('delta', models.IntegerField()),
+            ],
+        ),
+    ]
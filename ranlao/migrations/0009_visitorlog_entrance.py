@@ -0,0 +1,37 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0008_visitorevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitorevent',
+            name='entrance',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='visitorlog',
+            name='entrance',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='visitorlog',
+            name='amount',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='visitorlog',
+            name='log_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddConstraint(
+            model_name='visitorlog',
+            constraint=models.UniqueConstraint(fields=('entrance', 'log_time'), name='unique_entrance_log_time'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0010_submission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableCall',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('raised_at', models.DateTimeField()),
+                ('resolved_at', models.DateTimeField(db_index=True, null=True)),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ranlao.table')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tablecall',
+            index=models.Index(condition=models.Q(('resolved_at__isnull', True)), fields=['raised_at'], name='open_call_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='tablecall',
+            constraint=models.UniqueConstraint(condition=models.Q(('resolved_at__isnull', True)), fields=('table',), name='unique_open_call'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+def add_entrances(apps, schema_editor):
+    """Add the entrances of the existing logs."""
+    Entrance = apps.get_model('ranlao', 'Entrance')
+    VisitorLog = apps.get_model('ranlao', 'VisitorLog')
+    names = VisitorLog.objects.order_by().values_list('entrance', flat=True).distinct()
+    Entrance.objects.bulk_create([Entrance(name=name) for name in names], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0011_tablecall'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Entrance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=50, unique=True)),
+            ],
+        ),
+        migrations.RunPython(add_entrances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def open_calls(apps, schema_editor):
+    """Open a call for each table that was calling before calls were stored."""
+    Table = apps.get_model('ranlao', 'Table')
+    TableCall = apps.get_model('ranlao', 'TableCall')
+    now = timezone.now()
+    open_tables = TableCall.objects.filter(resolved_at__isnull=True).values('table')
+    tables = Table.objects.filter(is_calling=True).exclude(pk__in=open_tables)
+    TableCall.objects.bulk_create([TableCall(table=table, raised_at=now) for table in tables])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0012_entrance'),
+    ]
+
+    operations = [
+        migrations.RunPython(open_calls, migrations.RunPython.noop),
+    ]
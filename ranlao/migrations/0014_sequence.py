@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+def start_table_version(apps, schema_editor):
+    """Start the versions of the tables after the latest one."""
+    Sequence = apps.get_model('ranlao', 'Sequence')
+    Table = apps.get_model('ranlao', 'Table')
+    version = Table.objects.aggregate(version=models.Max('version'))['version'] or 0
+    Sequence.objects.create(name='table_version', value=version)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0013_open_table_calls'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(start_table_version, migrations.RunPython.noop),
+    ]
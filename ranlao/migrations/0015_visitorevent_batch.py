@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0014_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitorevent',
+            name='batch',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+    ]
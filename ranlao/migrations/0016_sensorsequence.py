@@ -0,0 +1,21 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranlao', '0015_visitorevent_batch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device', models.CharField(max_length=150, unique=True)),
+                ('seq', models.PositiveBigIntegerField()),
+            ],
+        ),
+    ]
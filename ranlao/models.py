@@ -1,22 +1,163 @@
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth import get_user_model
 
 UserModel = get_user_model()
 
+# Sequence of the versions of the tables.
+TABLE_VERSION = 'table_version'
+
 
 # Create your models here.
+class Sequence(models.Model):
+    """
+    Number that only increases, taken by concurrent writers in one UPDATE.
+
+    The row stays locked until the transaction that took a number ends,
+    so numbers are committed in the order they were taken.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.PositiveBigIntegerField(null=False, default=0)
+
+    @classmethod
+    def next_value(cls, name: str) -> int:
+        """Increase the sequence and get its new value, call it inside the transaction of the write."""
+        sql = 'UPDATE %s SET value = value + 1 WHERE name = %%s RETURNING value' % \
+            connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [name])
+            row = cursor.fetchone()
+            if row is None:
+                cls.objects.bulk_create([cls(name=name)], ignore_conflicts=True)
+                cursor.execute(sql, [name])
+                row = cursor.fetchone()
+        return row[0]
+
+
 class Table(models.Model):
     """Table at the pub and its status."""
     table_number = models.IntegerField(validators=[MinValueValidator(1)], null=False, unique=True)
     # is_calling: Call the staff.
     is_calling = models.BooleanField(default=False, null=False)
+    # version: Increases on every change, the latest table has the highest one.
+    version = models.PositiveBigIntegerField(default=0, null=False, db_index=True)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            self.version = Sequence.next_value(TABLE_VERSION)
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+            super().save(*args, **kwargs)
+
+
+class TableCall(models.Model):
+    """Call of the staff from a table, open until it is resolved."""
+    table = models.ForeignKey(Table, on_delete=models.CASCADE)
+    raised_at = models.DateTimeField(null=False)
+    resolved_at = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            # A table has a single open call.
+            models.UniqueConstraint(fields=['table'], condition=models.Q(resolved_at__isnull=True),
+                                    name='unique_open_call'),
+        ]
+        indexes = [
+            models.Index(fields=['raised_at'], condition=models.Q(resolved_at__isnull=True), name='open_call_idx'),
+        ]
+
+
+class Entrance(models.Model):
+    """
+    Entrance that has logs.
+
+    The latest log of each entrance is looked up through the index of
+    VisitorLog, so reading the amount does not scan the logs.
+    """
+    # name: Same as VisitorLog.entrance.
+    name = models.CharField(max_length=50, null=False, blank=True, unique=True)
 
 
 class VisitorLog(models.Model):
-    """Log of visitor by hour."""
-    log_time = models.DateTimeField(null=False)
-    amount = models.IntegerField(validators=[MinValueValidator(0)], null=False, default=0)
+    """
+    Log of visitor by hour and entrance.
+
+    Each entrance counts the customers that came in minus the ones that went out
+    through it, so its amount may be negative. The amount of the pub is their sum.
+    """
+    log_time = models.DateTimeField(null=False, db_index=True)
+    # entrance: Door of the sensor, empty for the pubs with a single one.
+    entrance = models.CharField(max_length=50, null=False, blank=True, default='')
+    amount = models.IntegerField(null=False, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['entrance', 'log_time'], name='unique_entrance_log_time'),
+        ]
+
+
+class VisitorEvent(models.Model):
+    """
+    Enter (positive delta) or leave (negative delta) sent by the hardware.
+
+    Events are only appended. VisitorLog and the statistics are made from them
+    and can be made again with the rebuild_projections command.
+    """
+    timestamp = models.DateTimeField(null=False, db_index=True)
+    # device: Username of the hardware that sent the event.
+    device = models.CharField(max_length=150, null=False, blank=True, default='')
+    entrance = models.CharField(max_length=50, null=False, blank=True, default='')
+    delta = models.IntegerField(null=False)
+    # batch: Events applied together as one net change of each hour and entrance
+    # (an upload or a flush of the buffer), null for the events stored before batches.
+    batch = models.UUIDField(null=True, editable=False)
+
+
+class Submission(models.Model):
+    """Key of a submission of the hardware, so a retry is not counted twice."""
+    # device: Username of the hardware.
+    device = models.CharField(max_length=150, null=False)
+    key = models.CharField(max_length=64, null=False)
+    # created_at: Keys older than IDEMPOTENCY_WINDOW are deleted.
+    created_at = models.DateTimeField(null=False, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'key'], name='unique_device_key'),
+        ]
+
+
+class SensorSequence(models.Model):
+    """Latest ?seq= number of a device, a submission with the same number is a retry."""
+    # device: Username of the hardware.
+    device = models.CharField(max_length=150, null=False, unique=True)
+    seq = models.PositiveBigIntegerField(null=False)
+
+
+class DailyStat(models.Model):
+    """
+    Statistic of visitors of a local day.
+
+    Entries and peak are updated as visitors enter. The curve and average
+    are stored when the day is over, then the day is closed and never changes.
+    """
+    date = models.DateField(null=False, unique=True)
+    peak = models.IntegerField(null=False, default=0)
+    total_entries = models.IntegerField(null=False, default=0)
+    average = models.FloatField(null=False, default=0)
+    # curve: Amount of each hour of the day from 0:00.
+    curve = models.JSONField(null=False, default=list)
+    closed = models.BooleanField(null=False, default=False)
+
+
+class WeeklyStat(models.Model):
+    """Statistic of visitors of a past week from Monday, made from its days."""
+    week_start = models.DateField(null=False, unique=True)
+    peak = models.IntegerField(null=False, default=0)
+    total_entries = models.IntegerField(null=False, default=0)
+    average = models.FloatField(null=False, default=0)
+    # curve: Average amount of each hour of the day from 0:00.
+    curve = models.JSONField(null=False, default=list)
 
 
 class UserTable(models.Model):
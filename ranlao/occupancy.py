@@ -0,0 +1,108 @@
+"""
+Current customers shared by every worker through a memory-mapped file.
+
+Writers take an exclusive file lock, readers take no lock and retry
+when the sequence number shows a write in progress (a seqlock).
+"""
+import contextlib
+import datetime
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from typing import Optional
+
+# Sequence number, zero time of the hour as a timestamp, amount.
+_LAYOUT = struct.Struct('<Qqq')
+# The zero time of a counter that must be read from the database again.
+_STALE = -1
+# Reads to try before giving up on a writer, which may have died in the middle.
+_READ_ATTEMPTS = 1000
+
+
+class SharedOccupancy:
+    """
+    Amount of the current hour in a file that all workers map.
+
+    An odd sequence number means a write is in progress. A reader
+    copies the fields and keeps them if the number did not change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = None
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self.reconciled = False
+
+    def _open(self):
+        # A forked worker must map the file again.
+        if self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'a+b')
+            if os.fstat(self._file.fileno()).st_size < _LAYOUT.size:
+                self._file.truncate(_LAYOUT.size)
+            self._mmap = mmap.mmap(self._file.fileno(), _LAYOUT.size)
+            self._thread_lock = threading.RLock()
+            self._depth = 0
+            self.pid = os.getpid()
+            self.reconciled = False
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the write lock of all workers, it can be taken again by the same thread."""
+        self._open()
+        with self._thread_lock:
+            if not self._depth:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def read(self, zero_time: datetime.datetime) -> Optional[int]:
+        """Get the amount of the hour without locking, None if it is not known."""
+        self._open()
+        if not self.reconciled:
+            return None
+        for _ in range(_READ_ATTEMPTS):
+            sequence, timestamp, amount = _LAYOUT.unpack_from(self._mmap, 0)
+            if sequence % 2:
+                continue
+            if _LAYOUT.unpack_from(self._mmap, 0)[0] == sequence:
+                return amount if timestamp == zero_time.timestamp() else None
+        return None
+
+    def write(self, zero_time: Optional[datetime.datetime], amount: int):
+        """Set the amount of the hour. The caller holds the lock."""
+        sequence = _LAYOUT.unpack_from(self._mmap, 0)[0]
+        # Left odd by a writer that died in the middle.
+        sequence += sequence % 2
+        timestamp = _STALE if zero_time is None else int(zero_time.timestamp())
+        struct.pack_into('<Q', self._mmap, 0, sequence + 1)
+        struct.pack_into('<qq', self._mmap, 8, timestamp, amount)
+        struct.pack_into('<Q', self._mmap, 0, sequence + 2)
+
+    def add(self, zero_time: datetime.datetime, amount: int) -> bool:
+        """Add to the amount if it is the amount of the hour. The caller holds the lock."""
+        sequence, timestamp, current = _LAYOUT.unpack_from(self._mmap, 0)
+        if timestamp != zero_time.timestamp():
+            return False
+        self.write(zero_time, max(current + amount, 0))
+        return True
+
+    def reconcile(self, zero_time: datetime.datetime, read) -> int:
+        """Set the amount of the hour from read(). The caller holds the lock."""
+        amount = read()
+        self.write(zero_time, amount)
+        self.reconciled = True
+        return amount
+
+    def invalidate(self):
+        """Make every worker read the amount from the database again."""
+        with self.locked():
+            self.write(None, 0)
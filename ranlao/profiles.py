@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, OuterRef, Subquery
+from rest_framework.authtoken.models import Token
+
+from .models import UserModel, UserTable
+
+PROFILE_KEY = 'ranlao:profile:%d'
+
+
+def _load_profile(user_id: int) -> dict:
+    """Get staff flag, table number and token of the user in one query."""
+    table_number = UserTable.objects.filter(user=OuterRef('pk')).values('table__table_number')[:1]
+    return UserModel.objects.filter(pk=user_id) \
+        .values('is_staff', table=Subquery(table_number), token=F('auth_token__key')) \
+        .first()
+
+
+def get_profile(user, with_token=False) -> dict:
+    """
+    Get {'is_staff', 'table', 'token'} of the user from the cache.
+
+    The token is only created when with_token is set (when logging in).
+    With with_token the profile is read from the database, because the
+    token may have been deleted in another worker while it was cached.
+    """
+    if not user.is_authenticated:
+        return {'is_staff': False, 'table': None, 'token': None}
+    key = PROFILE_KEY % user.pk
+    profile = None if with_token else cache.get(key)
+    if profile is None:
+        profile = _load_profile(user.pk)
+        cache.set(key, profile, settings.PROFILE_CACHE_TIMEOUT)
+    if with_token and profile['token'] is None:
+        token, created = Token.objects.get_or_create(user=user)
+        profile = {**profile, 'token': token.key}
+        cache.set(key, profile, settings.PROFILE_CACHE_TIMEOUT)
+    return profile
+
+
+def invalidate_profiles(*user_ids: int):
+    cache.delete_many([PROFILE_KEY % user_id for user_id in user_ids])
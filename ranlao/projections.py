@@ -0,0 +1,123 @@
+import bisect
+import datetime
+
+from django.db import transaction
+
+from .counters import invalidate_counts
+from .models import DailyStat, VisitorEvent, VisitorLog, WeeklyStat
+from .rollups import day_range, local_date
+from .timeseries import ONE_HOUR, latest_logs_before, register_entrances, truncate_hour
+
+
+class ReplayedLogs:
+    """
+    Hourly logs of the entrances made again in memory by the rules of apply_delta.
+
+    A change of an hour is carried to the later logs of its entrance, and
+    a negative change is rejected as a whole when the amount of the pub
+    would go below zero at any hour it changes.
+    """
+
+    def __init__(self, before: dict):
+        # entrance: amount before the first hour
+        self.before = before
+        # (zero time, entrance): amount
+        self.logs = {}
+        # Zero times of the logs of each entrance and of all of them, sorted.
+        self._hours = {}
+        self._all_hours = []
+
+    def amount_before(self, time: datetime.datetime, entrance: str) -> int:
+        hours = self._hours.get(entrance, [])
+        index = bisect.bisect_left(hours, time)
+        return self.logs[hours[index - 1], entrance] if index else self.before.get(entrance, 0)
+
+    def total_at(self, zero_time: datetime.datetime) -> int:
+        """Amount of the pub at the hour of zero_time."""
+        return sum(self.amount_before(zero_time + ONE_HOUR, entrance)
+                   for entrance in self.before.keys() | self._hours.keys())
+
+    def apply(self, zero_time: datetime.datetime, entrance: str, amount: int) -> bool:
+        """Change the logs of the entrance from the hour of zero_time on. Returns False if it was rejected."""
+        hours = self._hours.setdefault(entrance, [])
+        if (zero_time, entrance) not in self.logs:
+            self.logs[zero_time, entrance] = self.amount_before(zero_time, entrance)
+            bisect.insort(hours, zero_time)
+            index = bisect.bisect_left(self._all_hours, zero_time)
+            if self._all_hours[index:index + 1] != [zero_time]:
+                self._all_hours.insert(index, zero_time)
+        if amount < 0:
+            later = self._all_hours[bisect.bisect_left(self._all_hours, zero_time):]
+            if min(self.total_at(hour) for hour in later) + amount < 0:
+                return False
+        for hour in hours[bisect.bisect_left(hours, zero_time):]:
+            self.logs[hour, entrance] += amount
+        return True
+
+
+def rebuild_projections(since: datetime.date = None, chunk_size: int = 2000) -> dict:
+    """
+    Make the logs and statistics from the local day since again from the raw events.
+
+    Without since, it starts on the day of the first event, so older logs
+    written before events were stored are kept. Events are read in chunks
+    in the order they were applied. The events of a batch are applied as
+    one net change of each hour and entrance, as they were while counting,
+    so the same changes are rejected and the results match.
+    Returns the numbers of events read and logs and days written.
+    """
+    events = VisitorEvent.objects.order_by('timestamp', 'pk')
+    if since is None:
+        first = events.values_list('timestamp', flat=True).first()
+        if first is None:
+            return {'events': 0, 'logs': 0, 'days': 0}
+        since = local_date(first)
+    start = day_range(since)[0]
+    replayed = ReplayedLogs(dict(latest_logs_before(start).values_list('entrance', 'amount')))
+    # date: [peak, total entries]
+    days = {}
+
+    def apply(changes: dict):
+        for (zero_time, entrance), (amount, entries) in sorted(changes.items()):
+            if not replayed.apply(zero_time, entrance, amount) or (amount <= 0 and entries <= 0):
+                continue
+            day = days.setdefault(local_date(zero_time), [0, 0])
+            day[0] = max(day[0], replayed.total_at(zero_time))
+            day[1] += entries
+
+    count = 0
+    batch = None
+    # (zero time, entrance): [net change, entries] of the batch
+    changes = {}
+    for event_batch, timestamp, entrance, delta in events.filter(timestamp__gte=start) \
+            .order_by('pk') \
+            .values_list('batch', 'timestamp', 'entrance', 'delta') \
+            .iterator(chunk_size=chunk_size):
+        if event_batch is None or event_batch != batch:
+            apply(changes)
+            changes = {}
+        batch = event_batch
+        change = changes.setdefault((truncate_hour(timestamp), entrance), [0, 0])
+        change[0] += delta
+        change[1] += max(delta, 0)
+        count += 1
+    apply(changes)
+    logs = replayed.logs
+
+    with transaction.atomic():
+        register_entrances(*{entrance for log_time, entrance in logs})
+        VisitorLog.objects.filter(log_time__gte=start).delete()
+        VisitorLog.objects.bulk_create(
+            [VisitorLog(log_time=log_time, entrance=entrance, amount=amount)
+             for (log_time, entrance), amount in logs.items()],
+            batch_size=chunk_size
+        )
+        # Curves and averages are filled again when the days are read.
+        DailyStat.objects.filter(date__gte=since).delete()
+        DailyStat.objects.bulk_create(
+            [DailyStat(date=date, peak=peak, total_entries=entries) for date, (peak, entries) in days.items()],
+            batch_size=chunk_size
+        )
+        WeeklyStat.objects.filter(week_start__gte=since - datetime.timedelta(days=since.weekday())).delete()
+        transaction.on_commit(invalidate_counts)
+    return {'events': count, 'logs': len(logs), 'days': len(days)}
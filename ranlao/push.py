@@ -0,0 +1,187 @@
+import asyncio
+import json
+import logging
+import threading
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Events waiting for a slow client before newer ones are dropped.
+MAX_QUEUED_EVENTS = 100
+
+
+class EventBroker:
+    """
+    Fan out events to the websocket clients of this worker.
+
+    publish() is safe to call from the sync views, the events are
+    handed to the event loop of each client. Changes handled by other
+    workers are found by polling the database every PUSH_POLL_INTERVAL
+    seconds while there are clients. An event is only sent when it
+    changes the state the clients were last sent, a table that is
+    renumbered or deleted is sent as removed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        # key of the event: latest event sent
+        self._sent = {}
+        self._poller = None
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Get a queue of events for a client. Call it from the event loop."""
+        queue = asyncio.Queue(MAX_QUEUED_EVENTS)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers[queue] = loop
+            if self._poller is None:
+                self._poller = loop.create_task(self._poll())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+            if not self._subscribers and self._poller is not None:
+                self._poller.cancel()
+                self._poller = None
+                self._sent.clear()
+
+    def publish(self, event: dict):
+        """Send the event to every client, unless they were already sent the same state."""
+        with self._lock:
+            if not self._subscribers:
+                # The first poll records the state when a client connects.
+                return
+            key = _event_key(event)
+            if self._sent.get(key) == event:
+                return
+            self._sent[key] = event
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(_put_event, queue, event)
+
+    async def _poll(self):
+        """
+        Publish the changes of other workers. The first poll only records the state the clients got.
+
+        A failed poll (for example a locked database) is logged and tried again at the next one.
+        """
+        version = None
+        while True:
+            try:
+                latest, table_numbers, events = await sync_to_async(_changes)(version)
+            except Exception:
+                logger.exception("Cannot poll the changes of other workers.")
+            else:
+                if version is None:
+                    with self._lock:
+                        self._sent.update((_event_key(event), event) for event in events)
+                else:
+                    with self._lock:
+                        removed = [table_number for (kind, table_number), event in self._sent.items()
+                                   if event['type'] == 'table' and table_number not in table_numbers]
+                    for event in events + [table_removed_event(table_number) for table_number in removed]:
+                        self.publish(event)
+                version = latest
+            await asyncio.sleep(settings.PUSH_POLL_INTERVAL)
+
+
+def _event_key(event: dict) -> tuple:
+    # A removed table and a table with the same number share the state the clients were sent.
+    kind = 'table' if event['type'] == 'table_removed' else event['type']
+    return kind, event.get('table_number')
+
+
+def _put_event(queue: asyncio.Queue, event: dict):
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        # The client is too slow, it will get the next events.
+        pass
+
+
+broker = EventBroker()
+
+
+def table_event(table_number: int, is_calling: bool) -> dict:
+    return {'type': 'table', 'table_number': table_number, 'is_calling': is_calling}
+
+
+def table_removed_event(table_number: int) -> dict:
+    return {'type': 'table_removed', 'table_number': table_number}
+
+
+def occupancy_event(amount: int) -> dict:
+    return {'type': 'occupancy', 'amount': amount}
+
+
+def _changes(since: Optional[int]) -> tuple:
+    """
+    Get the latest table version, the numbers of all tables and the events
+    of the tables changed after since, with the occupancy.
+
+    All tables are read to find the removed ones, there are a few hundred at most.
+    """
+    from .models import Table
+    from .views import get_occupancy
+    latest = since or 0
+    table_numbers = set()
+    events = []
+    for table_number, is_calling, version in Table.objects.order_by('version').values_list(
+            'table_number', 'is_calling', 'version'):
+        table_numbers.add(table_number)
+        if since is None or version > since:
+            events.append(table_event(table_number, is_calling))
+        latest = max(latest, version)
+    events.append(occupancy_event(get_occupancy()))
+    return latest, table_numbers, events
+
+
+def _snapshot() -> list:
+    """Events describing the current state for a new client."""
+    from .models import Table
+    from .views import get_occupancy
+    events = [table_event(*table) for table in Table.objects.values_list('table_number', 'is_calling')]
+    events.append(occupancy_event(get_occupancy()))
+    return events
+
+
+async def websocket_application(scope, receive, send):
+    """
+    Push table calls and occupancy to the client at /ws/.
+
+    The client gets the current state first, then every change.
+    """
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if scope['path'] != '/ws/':
+        await send({'type': 'websocket.close', 'code': 4004})
+        return
+    await send({'type': 'websocket.accept'})
+    queue = broker.subscribe()
+
+    async def forward():
+        for event in await sync_to_async(_snapshot)():
+            await send({'type': 'websocket.send', 'text': json.dumps(event)})
+        while True:
+            event = await queue.get()
+            await send({'type': 'websocket.send', 'text': json.dumps(event)})
+
+    forwarder = asyncio.ensure_future(forward())
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+    finally:
+        broker.unsubscribe(queue)
+        forwarder.cancel()
@@ -0,0 +1,89 @@
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .counters import logs_version, recent_logs
+from .models import Table
+
+TABLE_ROW = '{"table_number":%d,"is_calling":%s,"version":%d}'
+LOG_ROW = '{"log_time":"%d:00-%d:00","amount":%d}'
+
+
+class RenderedBodies:
+    """
+    Encoded JSON bodies of this worker by the version of their data.
+
+    A poll of data that did not change costs a dictionary lookup.
+    The least recently used bodies are dropped past MAX_BODIES, and with
+    max_age a body is rendered again after max_age seconds, to see writes
+    of other workers that do not change the version.
+    """
+
+    MAX_BODIES = 64
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key: (rendered at, body)
+        self._bodies = collections.OrderedDict()
+
+    def get(self, key: tuple, render, max_age: float = None) -> bytes:
+        with self._lock:
+            entry = self._bodies.get(key)
+            if entry is not None and (max_age is None or time.monotonic() - entry[0] < max_age):
+                self._bodies.move_to_end(key)
+                return entry[1]
+        body = render()
+        with self._lock:
+            self._bodies[key] = (time.monotonic(), body)
+            self._bodies.move_to_end(key)
+            while len(self._bodies) > self.MAX_BODIES:
+                self._bodies.popitem(last=False)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
+
+
+rendered_bodies = RenderedBodies()
+
+
+def render_tables(since: int = None, version: int = 0) -> bytes:
+    """
+    Encode the tables from their values, the same JSON as TableSerializer.
+
+    Without since it is the list of all tables, otherwise the tables
+    changed after since with the version and the number of tables.
+    """
+    tables = Table.objects.order_by('pk')
+    if since is not None:
+        tables = Table.objects.filter(version__gt=since).order_by('version')
+    rows = ','.join(
+        TABLE_ROW % (table_number, 'true' if is_calling else 'false', version)
+        for table_number, is_calling, version in tables.values_list('table_number', 'is_calling', 'version')
+    )
+    if since is None:
+        return f'[{rows}]'.encode()
+    return ('{"version":%d,"count":%d,"tables":[%s]}' % (version, Table.objects.count(), rows)).encode()
+
+
+def tables_body(version: int, since: int = None) -> bytes:
+    """Get the encoded tables (see render_tables) at the version of tables.table_version, rendered once for each."""
+    return rendered_bodies.get(('tables', version, since), lambda: render_tables(since, version))
+
+
+def render_recent_logs() -> bytes:
+    """Encode the logs of the last 6 hours as hour ranges in local time, the latest first."""
+    rows = []
+    for log_time, amount in recent_logs():
+        hour = timezone.localtime(log_time).hour
+        rows.append(LOG_ROW % (hour, hour + 1, amount))
+    return f'[{",".join(rows)}]'.encode()
+
+
+def recent_logs_body() -> bytes:
+    """Get the encoded logs of the last 6 hours, rendered again at a new hour, after a write or READ_CACHE_TIMEOUT."""
+    return rendered_bodies.get(('logs', *logs_version()), render_recent_logs, settings.READ_CACHE_TIMEOUT)
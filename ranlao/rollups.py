@@ -0,0 +1,126 @@
+import datetime
+import itertools
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import DailyStat, WeeklyStat
+from .timeseries import ONE_HOUR, hourly_series, total_before, truncate_hour
+
+
+def local_date(time: datetime.datetime) -> datetime.date:
+    """Get the date of time in the current time zone."""
+    return timezone.localtime(time).date()
+
+
+def day_range(date: datetime.date):
+    """Get the zero times of the first and the last hour of the local day."""
+    start = timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+    return start, start + datetime.timedelta(hours=23)
+
+
+def record_change(zero_time: datetime.datetime, amount: int, entries: int):
+    """
+    Add entries and raise the peak of the day after the log of the hour changed by amount.
+
+    It is a single UPDATE unless this is the first entry of the day.
+    Closed days are never changed.
+    """
+    if amount <= 0 and entries <= 0:
+        return
+    date = local_date(zero_time)
+    updates = {
+        'total_entries': F('total_entries') + entries,
+        'peak': Greatest('peak', Coalesce(total_before(zero_time + ONE_HOUR), 0)),
+    }
+    if DailyStat.objects.filter(date=date, closed=False).update(**updates):
+        return
+    DailyStat.objects.bulk_create([DailyStat(date=date)], ignore_conflicts=True)
+    DailyStat.objects.filter(date=date, closed=False).update(**updates)
+
+
+def _opening_average(curve: list) -> float:
+    """Average amount during the opening hours."""
+    opening, closing = settings.OPENING_HOURS
+    opening_curve = curve[opening:closing]
+    return sum(opening_curve) / len(opening_curve) if opening_curve else 0
+
+
+def _complete_day(date: datetime.date, stat: DailyStat = None) -> DailyStat:
+    """
+    Fill the curve and average of the day from the logs.
+
+    The curve of today stops at this hour. A past day is stored closed,
+    so it is only computed once.
+    """
+    if stat is None:
+        stat = DailyStat(date=date)
+    start, end = day_range(date)
+    end = min(end, truncate_hour(timezone.now()))
+    stat.curve = [amount for log_time, amount in hourly_series(start, end)]
+    stat.peak = max([stat.peak] + stat.curve)
+    stat.average = _opening_average(stat.curve)
+    if date < local_date(timezone.now()):
+        stat.closed = True
+        if stat.pk is None:
+            DailyStat.objects.bulk_create([stat], ignore_conflicts=True)
+        else:
+            DailyStat.objects.filter(pk=stat.pk, closed=False) \
+                .update(curve=stat.curve, peak=stat.peak, average=stat.average, closed=True)
+    return stat
+
+
+def daily_stats(start: datetime.date, end: datetime.date) -> list:
+    """Get statistic of every day from start to end, future days are left out."""
+    end = min(end, local_date(timezone.now()))
+    stored = {stat.date: stat for stat in DailyStat.objects.filter(date__gte=start, date__lte=end)}
+    stats = []
+    date = start
+    while date <= end:
+        stat = stored.get(date)
+        if stat is None or not stat.closed:
+            stat = _complete_day(date, stat)
+        stats.append(stat)
+        date += datetime.timedelta(days=1)
+    return stats
+
+
+def _average_curve(curves: list) -> list:
+    """Average of each hour over the curves that have it."""
+    average_curve = []
+    for hour in itertools.zip_longest(*curves):
+        amounts = [amount for amount in hour if amount is not None]
+        average_curve.append(sum(amounts) / len(amounts))
+    return average_curve
+
+
+def summarize(stats: list) -> dict:
+    """Combine statistic of many days."""
+    if not stats:
+        return {'peak': 0, 'total_entries': 0, 'average': 0, 'curve': []}
+    return {
+        'peak': max(stat.peak for stat in stats),
+        'total_entries': sum(stat.total_entries for stat in stats),
+        'average': sum(stat.average for stat in stats) / len(stats),
+        'curve': _average_curve([stat.curve for stat in stats]),
+    }
+
+
+def weekly_summary(week_start: datetime.date) -> dict:
+    """
+    Get statistic of the week from Monday.
+
+    A past week is stored the first time it is read and never computed again.
+    """
+    stored = WeeklyStat.objects.filter(week_start=week_start) \
+        .values('peak', 'total_entries', 'average', 'curve') \
+        .first()
+    if stored:
+        return stored
+    week_end = week_start + datetime.timedelta(days=6)
+    summary = summarize(daily_stats(week_start, week_end))
+    if week_end < local_date(timezone.now()):
+        WeeklyStat.objects.bulk_create([WeeklyStat(week_start=week_start, **summary)], ignore_conflicts=True)
+    return summary
@@ -0,0 +1,40 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from . import metrics
+from .counters import shared_occupancy
+
+
+class TemporaryMetricsRunner(DiscoverRunner):
+    """
+    Test runner that writes the metrics, the token generation and the
+    shared occupancy of the test run to a temporary directory.
+
+    These files are shared by the running workers, which must not see
+    (or be cleared of) the counts and invalidations of the tests.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._metrics_dir = tempfile.TemporaryDirectory(prefix='ranlao-metrics-')
+        self._metrics_override = override_settings(
+            METRICS_DIR=self._metrics_dir.name,
+            TOKEN_GENERATION_FILE=os.path.join(self._metrics_dir.name, 'token_generation.mmap'),
+            SHARED_OCCUPANCY_FILE=os.path.join(self._metrics_dir.name, 'occupancy.mmap'),
+        )
+        self._metrics_override.enable()
+        metrics._store = None
+        # The counters mapped the file of the settings when they were imported.
+        self._occupancy_path = shared_occupancy.path
+        shared_occupancy.path, shared_occupancy.pid = settings.SHARED_OCCUPANCY_FILE, None
+
+    def teardown_test_environment(self, **kwargs):
+        metrics._store = None
+        shared_occupancy.path, shared_occupancy.pid = self._occupancy_path, None
+        self._metrics_override.disable()
+        self._metrics_dir.cleanup()
+        super().teardown_test_environment(**kwargs)
@@ -1,14 +1,123 @@
-from rest_framework.serializers import ModelSerializer
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.serializers import ModelSerializer, Serializer, CharField, DateTimeField, IntegerField, \
+    ChoiceField, DateField, ListField, ValidationError
 from .models import Table, VisitorLog
 
 
 class TableSerializer(ModelSerializer):
     class Meta:
         model = Table
-        fields = ('table_number', 'is_calling')
+        fields = ('table_number', 'is_calling', 'version')
 
 
 class LogSerializer(ModelSerializer):
     class Meta:
         model = VisitorLog
-        fields = ('log_time', 'amount')
+        fields = ('log_time', 'entrance', 'amount')
+
+
+class EntranceSerializer(Serializer):
+    """Query of the hardware. Pubs with many doors tell which one with ?entrance=."""
+    entrance = CharField(max_length=50, required=False, allow_blank=True, default='')
+
+
+class CounterEventSerializer(Serializer):
+    """Enter (positive delta) or leave (negative delta) recorded by the hardware."""
+    timestamp = DateTimeField()
+    delta = IntegerField()
+    entrance = CharField(max_length=50, required=False, allow_blank=True)
+
+    def validate_timestamp(self, value):
+        if value > timezone.now() + datetime.timedelta(seconds=settings.EVENT_CLOCK_SKEW):
+            raise ValidationError("timestamp must not be in the future.")
+        return value
+
+
+class LogRangeSerializer(Serializer):
+    """Query of the log range. The cursor is the start of the page."""
+    start = DateTimeField()
+    end = DateTimeField(required=False)
+    granularity = ChoiceField(choices=('hour', 'day'), default='hour')
+    # entrance: Only the customers that came through this door, all of them by default.
+    entrance = CharField(max_length=50, required=False, allow_blank=True)
+    cursor = DateTimeField(required=False)
+    limit = IntegerField(min_value=1, max_value=1000, default=168)
+
+    def validate(self, attrs):
+        if 'end' in attrs and attrs['end'] < attrs['start']:
+            raise ValidationError("end must not be before start.")
+        if 'cursor' in attrs and attrs['cursor'] < attrs['start']:
+            raise ValidationError("cursor must not be before start.")
+        return attrs
+
+
+class LogExportSerializer(Serializer):
+    """Query of the log export. Days are local and end is included, by default today."""
+    start = DateField()
+    end = DateField(required=False)
+    # output: Not format, which picks the renderer of the response.
+    output = ChoiceField(choices=('csv', 'ndjson'), default='csv')
+    entrance = CharField(max_length=50, required=False, allow_blank=True)
+
+    def validate(self, attrs):
+        if 'end' in attrs and attrs['end'] < attrs['start']:
+            raise ValidationError("end must not be before start.")
+        return attrs
+
+
+class StatisticQuerySerializer(Serializer):
+    """Query of the period statistic."""
+    date = DateField(required=False)
+
+
+class TableSyncSerializer(Serializer):
+    """Query of the table list. Only tables changed after since are listed."""
+    since = IntegerField(min_value=0, required=False)
+
+
+class TableSelectionSerializer(Serializer):
+    """Tables of a bulk operation, a list of table numbers or a range from start to end."""
+    MAX_TABLES = 1000
+
+    tables = ListField(child=IntegerField(min_value=1), required=False, max_length=MAX_TABLES)
+    start = IntegerField(min_value=1, required=False)
+    end = IntegerField(min_value=1, required=False)
+
+    def validate(self, attrs):
+        if 'tables' in attrs:
+            if 'start' in attrs or 'end' in attrs:
+                raise ValidationError("Give either tables or start and end.")
+            return {'tables': list(dict.fromkeys(attrs['tables']))}
+        if 'start' not in attrs or 'end' not in attrs:
+            raise ValidationError("Give either tables or start and end.")
+        if attrs['end'] < attrs['start']:
+            raise ValidationError("end must not be before start.")
+        if attrs['end'] - attrs['start'] >= self.MAX_TABLES:
+            raise ValidationError(f"A range has at most {self.MAX_TABLES} tables.")
+        return {'tables': list(range(attrs['start'], attrs['end'] + 1))}
+
+
+class RenumberSerializer(Serializer):
+    """New number of a table."""
+    table_number = IntegerField(min_value=1)
+    new_number = IntegerField(min_value=1)
+
+
+class TableRenumberSerializer(Serializer):
+    """Tables to renumber. Old and new numbers must not repeat."""
+    changes = RenumberSerializer(many=True, allow_empty=False, max_length=TableSelectionSerializer.MAX_TABLES)
+
+    def validate_changes(self, changes):
+        old_numbers = [change['table_number'] for change in changes]
+        new_numbers = [change['new_number'] for change in changes]
+        if len(set(old_numbers)) != len(old_numbers) or len(set(new_numbers)) != len(new_numbers):
+            raise ValidationError("A table number is repeated.")
+        return {change['table_number']: change['new_number'] for change in changes}
+
+
+class ProfileQuerySerializer(Serializer):
+    """Query of the slowest requests."""
+    limit = IntegerField(min_value=1, max_value=100, default=5)
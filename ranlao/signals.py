@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+from .calls import call_queue, match_call
+from .counters import invalidate_counts
+from .models import Table, UserModel, UserTable, VisitorLog
+from .profiles import invalidate_profiles
+from .tables import next_version
+from .timeseries import register_entrances
+
+
+@receiver([post_save, post_delete], sender=Table)
+def table_changed(sender, instance, **kwargs):
+    """Tables changed outside the views (for example in the admin)."""
+    update_fields = kwargs.get('update_fields')
+    if kwargs['signal'] is post_save and (update_fields is None or 'is_calling' in update_fields):
+        match_call(instance, timezone.now())
+    if kwargs['signal'] is post_delete:
+        # Saves take a version, a deleted table must change the version of the tables too.
+        next_version()
+    call_queue.invalidate()
+    # The table number of its users may change.
+    invalidate_profiles(*UserTable.objects.filter(table_id=instance.pk).values_list('user_id', flat=True))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    token_cache.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Token)
+@receiver([post_save, post_delete], sender=UserTable)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_profiles(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=UserModel)
+def user_changed(sender, instance, **kwargs):
+    """Deactivated users or changed permissions must not stay cached."""
+    token_cache.invalidate()
+    invalidate_profiles(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=VisitorLog)
+def log_changed(sender, instance, **kwargs):
+    """Logs changed outside the counters (for example in the admin)."""
+    if kwargs['signal'] is post_save:
+        register_entrances(instance.entrance)
+    invalidate_counts()
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
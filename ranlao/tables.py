@@ -0,0 +1,127 @@
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from .calls import call_queue, open_call, resolve_call, resolve_calls
+from .models import TABLE_VERSION, Sequence, Table, UserTable
+from .profiles import invalidate_profiles
+
+def next_version() -> int:
+    """Take the next version of the tables, inside the transaction that changes them."""
+    return Sequence.next_value(TABLE_VERSION)
+
+
+def table_version() -> int:
+    """
+    Get the latest version of the tables in one lookup of its sequence.
+
+    Every change of a table takes a version, deleting one included (see
+    signals), so it is the same for every worker as soon as the change commits.
+    """
+    return Sequence.objects.filter(name=TABLE_VERSION).values_list('value', flat=True).first() or 0
+
+
+def table_etag(version: int) -> str:
+    return '"tables-%d"' % version
+
+
+def set_calling(table_number: int, is_calling: bool):
+    """
+    Change the calling status of the table in one conditional UPDATE
+    and open or resolve its call.
+
+    Returns None when there is no such table, otherwise whether it changed.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Table.objects.filter(table_number=table_number) \
+            .exclude(is_calling=is_calling) \
+            .update(is_calling=is_calling, version=next_version())
+        if updated:
+            if is_calling:
+                open_call(table_number, now)
+            else:
+                resolve_call(table_number, now)
+    if updated:
+        return True
+    if Table.objects.filter(table_number=table_number).exists():
+        return False
+    return None
+
+
+def stop_calling(table_numbers: list, answered: bool = True) -> dict:
+    """
+    Stop the calls of many tables in one UPDATE.
+
+    answered is False to reset the tables without counting their calls
+    as answered. Returns the result of each table: 'completed' (or 'reset'),
+    'not calling' or 'missing'.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        tables = Table.objects.select_for_update().filter(table_number__in=table_numbers)
+        calling = dict(tables.values_list('table_number', 'is_calling'))
+        changed = [table_number for table_number, is_calling in calling.items() if is_calling]
+        if changed:
+            Table.objects.filter(table_number__in=changed).update(is_calling=False, version=next_version())
+            resolve_calls(changed, now, answered)
+    stopped = 'completed' if answered else 'reset'
+    return {
+        table_number: 'missing' if table_number not in calling else stopped if calling[table_number]
+        else 'not calling'
+        for table_number in table_numbers
+    }
+
+
+def create_tables(table_numbers: list) -> dict:
+    """
+    Create many tables in one INSERT.
+
+    Returns the result of each table: 'created' or 'exists'. The created
+    tables are read back by their version, which no other call gets, so a
+    table inserted by a concurrent call is reported as 'exists'.
+    """
+    with transaction.atomic():
+        version = next_version()
+        Table.objects.bulk_create(
+            [Table(table_number=table_number, version=version) for table_number in table_numbers],
+            ignore_conflicts=True
+        )
+        created = set(Table.objects.filter(version=version).values_list('table_number', flat=True))
+    return {table_number: 'created' if table_number in created else 'exists' for table_number in table_numbers}
+
+
+def renumber_tables(changes: dict) -> dict:
+    """
+    Give many tables new numbers, changes maps the old number to the new one.
+
+    Tables are moved to negative numbers first so numbers can be swapped.
+    A table is left alone when it is 'missing' or its new number is a
+    'conflict' with a table that keeps its number. Returns the result of
+    each old number, 'renumbered' for the others.
+    """
+    with transaction.atomic():
+        existing = set(Table.objects.select_for_update().values_list('table_number', flat=True))
+        results = {old: 'missing' for old in changes if old not in existing}
+        moves = {old: new for old, new in changes.items() if old in existing}
+        kept = existing - moves.keys()
+        # A table left alone keeps its number, which may conflict with another move.
+        while conflicts := [old for old, new in moves.items() if new in kept]:
+            for old in conflicts:
+                results[old] = 'conflict'
+                kept.add(old)
+                del moves[old]
+        results.update(dict.fromkeys(moves, 'renumbered'))
+        results = {old: results[old] for old in changes}
+        if moves:
+            tables = Table.objects.filter(table_number__in=moves)
+            user_ids = list(UserTable.objects.filter(table__in=tables).values_list('user_id', flat=True))
+            tables.update(
+                table_number=Case(*[When(table_number=old, then=Value(-new)) for old, new in moves.items()]),
+                version=next_version(),
+            )
+            Table.objects.filter(table_number__lt=0).update(table_number=-F('table_number'))
+            # The table number of their users changes.
+            transaction.on_commit(lambda: invalidate_profiles(*user_ids))
+            transaction.on_commit(call_queue.invalidate)
+    return results
@@ -1,14 +1,60 @@
+import asyncio
+import csv
 import datetime
+import io
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
 from http import HTTPStatus
+from importlib import import_module
+from urllib.parse import urlencode
+from unittest import mock, skipUnless
 
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.http import HttpResponse
 from django.urls import reverse
 from django.utils import timezone
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import GreaterThanOrEqual
+from django.test import AsyncRequestFactory, TransactionTestCase, override_settings
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 from freezegun import freeze_time
 
 # Create your tests here.
-from ranlao.models import Table, VisitorLog
+from exceed_ranlao import asgi
+from ranlao import async_views, metrics
+from ranlao.authentication import CachedTokenAuthentication, SharedGeneration, token_cache
+from ranlao.calls import call_queue
+from ranlao.counters import apply_delta, current_amount, delta_buffer, shared_occupancy
+from ranlao.handlers import StreamingASGIHandler
+from ranlao.idempotency import claim, dedupe_index
+from ranlao.middlewares import markcoroutinefunction, ProfilingMiddleware, recent_profiles, StaticFilesMiddleware
+from ranlao.occupancy import SharedOccupancy
+from ranlao.profiles import PROFILE_KEY
+from ranlao.models import TABLE_VERSION, DailyStat, Sequence, Submission, Table, TableCall, UserTable, VisitorEvent, \
+    VisitorLog, WeeklyStat
+from ranlao.throttling import sensor_buckets, TokenBuckets
+from ranlao.push import (
+    _changes as changes, broker, EventBroker, occupancy_event, table_event, table_removed_event, websocket_application
+)
+from ranlao.rendering import rendered_bodies
+from ranlao.rollups import local_date
+from ranlao.serializers import TableSerializer
+from ranlao.tables import next_version, renumber_tables, set_calling
+from ranlao.timeseries import amount_before, hourly_series, latest_logs_before, register_entrances, total_before
 from ranlao.views import get_current_time_zero, change_log_by_time
 
 
@@ -54,11 +100,398 @@ class TableViewTest(APITestCase):
         self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
 
 
+class TableSyncTest(APITestCase):
+    """Tests for table versions and conditional polling."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        rendered_bodies.clear()
+        self.tables = [Table.objects.create(table_number=i) for i in range(1, 4)]
+        self.user = User.objects.create_user(username="bad", password="BadPassword123")
+        self.table_url = reverse('table-list')
+
+    def call(self, table_number):
+        self.client.force_authenticate(self.user)
+        self.client.post(reverse('call_staff', args=[table_number]))
+        self.client.force_authenticate(None)
+
+    def test_since_lists_changed_tables(self):
+        """Only tables changed after the version are listed."""
+        response = self.client.get(self.table_url, {'since': 0}).json()
+        self.assertEqual(len(response['tables']), 3)
+        version = response['version']
+        self.call(2)
+        response = self.client.get(self.table_url, {'since': version}).json()
+        self.assertEqual(response['tables'], [{'table_number': 2, 'is_calling': True, 'version': version + 1}])
+        self.assertEqual(response['version'], version + 1)
+        self.assertEqual(response['count'], 3)
+
+    def test_not_modified(self):
+        """Unchanged polls get 304 after one lookup of the version, without querying the tables."""
+        etag = self.client.get(self.table_url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(self.table_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        self.call(1)
+        response = self.client.get(self.table_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_delete_changes_etag(self):
+        """Deleting a table changes the ETag."""
+        etag = self.client.get(self.table_url)['ETag']
+        self.tables[0].delete()
+        response = self.client.get(self.table_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_change_by_another_worker(self):
+        """A change the cache of this worker did not see changes the ETag right away."""
+        etag = self.client.get(self.table_url)['ETag']
+        # Written as another worker would, nothing in this worker is told.
+        Table.objects.filter(table_number=1).update(is_calling=True, version=next_version())
+        response = self.client.get(self.table_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response.json()[0]['is_calling'])
+
+    def test_call_missing_table(self):
+        """Calling a table that does not exist is not found."""
+        self.client.force_authenticate(self.user)
+        response = self.client.post(reverse('call_staff', args=[99]))
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+    """Tests for remembering hardware tokens."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        token_cache.clear()
+        self.user = User.objects.create_user(username="sensor", password="BadPassword123")
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+        self.enter_url = reverse('enter')
+
+    def test_token_is_cached(self):
+        """Only the first request looks up the token."""
+        self.client.post(self.enter_url)
+        with self.assertNumQueries(0):
+            CachedTokenAuthentication().authenticate_credentials(self.token.key)
+
+    def test_deleted_token(self):
+        """A deleted token stops working right away."""
+        self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.OK)
+        self.token.delete()
+        self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_deactivated_user(self):
+        """A deactivated user stops working right away."""
+        self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.OK)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_invalidated_by_another_worker(self):
+        """A token deleted in another worker stops working on the next request."""
+        self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.OK)
+        with mock.patch.object(token_cache, 'invalidate'):
+            Token.objects.filter(pk=self.token.pk).delete()
+        with self.assertNumQueries(0):
+            CachedTokenAuthentication().authenticate_credentials(self.token.key)
+        # The other worker maps the same file.
+        SharedGeneration().bump()
+        self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_deactivated_without_signal(self):
+        """A user deactivated with a queryset update stops working after TOKEN_CACHE_TTL."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.OK)
+            User.objects.filter(pk=self.user.pk).update(is_active=False)
+            self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.OK)
+            frozen_time.tick(delta=datetime.timedelta(seconds=settings.TOKEN_CACHE_TTL + 1))
+            self.assertEqual(self.client.post(self.enter_url).status_code, HTTPStatus.UNAUTHORIZED)
+
+
+class UserProfileTest(APITestCase):
+    """Tests for login and user status from the profile cache."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.table = Table.objects.create(table_number=5)
+        self.user = User.objects.create_user(username="table05", password="TableExceed05")
+        UserTable.objects.create(user=self.user, table=self.table)
+
+    def test_login(self):
+        """Login gives the token, the table and the staff status."""
+        response = self.client.post(reverse('get_token'), {'username': 'table05', 'password': 'TableExceed05'})
+        self.assertEqual(response.data, {
+            'token': Token.objects.get(user=self.user).key,
+            'table': 5,
+            'is_staff': False,
+        })
+
+    def test_login_after_token_deleted_elsewhere(self):
+        """Login does not give a token that another worker deleted while it was cached."""
+        self.client.force_authenticate(self.user)
+        self.client.get(reverse('user_status'))
+        cache.set(PROFILE_KEY % self.user.pk, {'is_staff': False, 'table': 5, 'token': 'deleted'})
+        self.client.force_authenticate(None)
+        response = self.client.post(reverse('get_token'), {'username': 'table05', 'password': 'TableExceed05'})
+        self.assertEqual(response.data['token'], Token.objects.get(user=self.user).key)
+
+    def test_status_is_cached(self):
+        """User status is one query at first, then none."""
+        self.client.force_authenticate(self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('user_status'))
+        self.assertEqual(response.data, {'is_staff': False, 'table': 5})
+        with self.assertNumQueries(0):
+            self.client.get(reverse('user_status'))
+
+    def test_status_after_change(self):
+        """Changing the table of the user changes the status."""
+        self.client.force_authenticate(self.user)
+        self.client.get(reverse('user_status'))
+        UserTable.objects.filter(user=self.user).delete()
+        UserTable.objects.create(user=self.user, table=Table.objects.create(table_number=6))
+        self.assertEqual(self.client.get(reverse('user_status')).data['table'], 6)
+        self.table.delete()
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('user_status')).data, {'is_staff': True, 'table': 6})
+
+
+@override_settings(PROFILING_ENABLED=True)
+class ProfilingMiddlewareTest(APITestCase):
+    """Tests for measuring requests."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        recent_profiles.clear()
+        self.staff = User.objects.create_user(username="staff", password="BadPassword123", is_staff=True)
+
+    def test_server_timing(self):
+        """Measured requests have the Server-Timing header."""
+        VisitorLog.objects.create(log_time=timezone.now().replace(minute=0, second=0, microsecond=0), amount=1)
+        response = self.client.get(reverse('count'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[0-9.]+;desc="1 queries", render;dur=[0-9.]+, total')
+        self.assertEqual(recent_profiles[-1]['url_name'], 'count')
+        self.assertEqual(recent_profiles[-1]['queries'], 1)
+
+    def test_slowest_for_staff(self):
+        """Staff get the slowest requests of each URL name."""
+        for _ in range(3):
+            self.client.get(reverse('count'))
+        self.client.force_authenticate(self.staff)
+        response = self.client.get(reverse('profile'), {'limit': 2})
+        self.assertEqual(len(response.data['slowest']['count']), 2)
+        totals = [profile['total_ms'] for profile in response.data['slowest']['count']]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+
+    def test_not_for_customers(self):
+        """Other users cannot see the requests."""
+        self.client.force_authenticate(User.objects.create_user(username="bad"))
+        response = self.client.get(reverse('profile'))
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    @skipUnless(markcoroutinefunction, "Needs asgiref 3.6 to mark the middlewares as coroutine functions.")
+    def test_async_only_with_async_chain(self):
+        """The middlewares are awaited only when the rest of the chain is async."""
+        async def async_response(request):
+            return HttpResponse()
+
+        for middleware in (ProfilingMiddleware, StaticFilesMiddleware):
+            self.assertTrue(asyncio.iscoroutinefunction(middleware(async_response)))
+            self.assertFalse(asyncio.iscoroutinefunction(middleware(lambda request: HttpResponse())))
+
+    @skipUnless(markcoroutinefunction, "Needs asgiref 3.6 to mark the middlewares as coroutine functions.")
+    @override_settings(DEBUG=True)
+    def test_asgi_chain_stays_async(self):
+        """Under ASGI no middleware makes Django run the rest of the chain, async views included, in a thread."""
+        logger = logging.getLogger('django.request')
+        with self.assertLogs(logger, 'DEBUG') as logs:
+            logger.debug("Loading the middleware.")
+            StreamingASGIHandler()
+        self.assertEqual([line for line in logs.output if 'adapted' in line], [])
+
+    @override_settings(PROFILING_ENABLED=False)
+    def test_disabled(self):
+        """Nothing is measured when it is off."""
+        response = self.client.get(reverse('count'))
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(len(recent_profiles), 0)
+
+
+class PushChannelTest(APITestCase):
+    """Tests for pushing table calls and occupancy over websocket."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.table = Table.objects.create(table_number=3, is_calling=False)
+        self.user = User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+
+    async def test_push_call_and_occupancy(self):
+        """The client gets the current state, then every change."""
+        received = asyncio.Queue()
+        sent = asyncio.Queue()
+        await received.put({'type': 'websocket.connect'})
+        client = asyncio.ensure_future(
+            websocket_application({'type': 'websocket', 'path': '/ws/'}, received.get, sent.put)
+        )
+        self.assertEqual(await sent.get(), {'type': 'websocket.accept'})
+        self.assertEqual(json.loads((await sent.get())['text']), table_event(3, False))
+        self.assertEqual(json.loads((await sent.get())['text']), occupancy_event(0))
+        await sync_to_async(self.client.post)(reverse('call_staff', args=[3]))
+        self.assertEqual(json.loads((await asyncio.wait_for(sent.get(), 5))['text']), table_event(3, True))
+        await sync_to_async(self.client.post)(reverse('enter'))
+        self.assertEqual(json.loads((await asyncio.wait_for(sent.get(), 5))['text']), occupancy_event(1))
+        await received.put({'type': 'websocket.disconnect'})
+        await client
+        self.assertFalse(broker.has_subscribers)
+
+    @override_settings(PUSH_POLL_INTERVAL=0.01)
+    async def test_push_changes_of_other_workers(self):
+        """Changes written without this worker publishing them are pushed once by the poll."""
+        received = asyncio.Queue()
+        sent = asyncio.Queue()
+        await received.put({'type': 'websocket.connect'})
+        client = asyncio.ensure_future(
+            websocket_application({'type': 'websocket', 'path': '/ws/'}, received.get, sent.put)
+        )
+        for _ in range(3):
+            await sent.get()
+        # Written as another worker would, nothing is published here.
+        await sync_to_async(set_calling)(3, True)
+        self.assertEqual(json.loads((await asyncio.wait_for(sent.get(), 5))['text']), table_event(3, True))
+        await sync_to_async(VisitorLog.objects.create)(log_time=get_current_time_zero(), amount=2)
+        self.assertEqual(json.loads((await asyncio.wait_for(sent.get(), 5))['text']), occupancy_event(2))
+        await asyncio.sleep(0.05)
+        self.assertTrue(sent.empty())
+        await received.put({'type': 'websocket.disconnect'})
+        await client
+        self.assertFalse(broker.has_subscribers)
+
+    @override_settings(PUSH_POLL_INTERVAL=0.01)
+    async def test_push_renumber_of_other_workers(self):
+        """The poll removes the number of a table another worker renumbered."""
+        received = asyncio.Queue()
+        sent = asyncio.Queue()
+        await received.put({'type': 'websocket.connect'})
+        client = asyncio.ensure_future(
+            websocket_application({'type': 'websocket', 'path': '/ws/'}, received.get, sent.put)
+        )
+        for _ in range(3):
+            await sent.get()
+        await sync_to_async(renumber_tables)({3: 4})
+        events = [json.loads((await asyncio.wait_for(sent.get(), 5))['text']) for _ in range(2)]
+        self.assertEqual(events, [table_event(4, False), table_removed_event(3)])
+        await received.put({'type': 'websocket.disconnect'})
+        await client
+        self.assertFalse(broker.has_subscribers)
+
+    @override_settings(PUSH_POLL_INTERVAL=0.01)
+    async def test_poll_after_error(self):
+        """A failed poll is logged and the next one still pushes the changes."""
+        polls = []
+
+        def failing_once(since):
+            polls.append(since)
+            if len(polls) == 2:
+                raise OperationalError("database is locked")
+            return changes(since)
+
+        received = asyncio.Queue()
+        sent = asyncio.Queue()
+        await received.put({'type': 'websocket.connect'})
+        with mock.patch('ranlao.push._changes', failing_once), self.assertLogs('ranlao.push', 'ERROR'):
+            client = asyncio.ensure_future(
+                websocket_application({'type': 'websocket', 'path': '/ws/'}, received.get, sent.put)
+            )
+            try:
+                for _ in range(3):
+                    await sent.get()
+                for _ in range(500):
+                    if len(polls) >= 3:
+                        break
+                    await asyncio.sleep(0.01)
+                await sync_to_async(set_calling)(3, True)
+                self.assertEqual(json.loads((await asyncio.wait_for(sent.get(), 1))['text']), table_event(3, True))
+            finally:
+                await received.put({'type': 'websocket.disconnect'})
+                await client
+
+
+class AsyncViewTest(TransactionTestCase):
+    """Tests for the async versions of the busiest views."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        token_cache.clear()
+        self.factory = AsyncRequestFactory()
+        self.sensor_token = Token.objects.create(user=User.objects.create_user(username="sensor")).key
+        self.staff_token = Token.objects.create(user=User.objects.create_user(username="staff", is_staff=True)).key
+        Table.objects.create(table_number=1, is_calling=True)
+
+    def post(self, view, path, token=None, *args):
+        headers = {'AUTHORIZATION': f"Token {token}"} if token else {}
+        return view(self.factory.post(path, **headers), *args)
+
+    async def test_enter_leave_and_count(self):
+        """Enter and leave change the count like the sync views."""
+        for _ in range(2):
+            response = await self.post(async_views.customer_enter, '/enter/', self.sensor_token)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+        await self.post(async_views.customer_leave, '/leave/', self.sensor_token)
+        response = await async_views.get_current_customers(self.factory.get('/count/'))
+        self.assertEqual(json.loads(response.content), {'amount': 1})
+
+    async def test_retry(self):
+        """A retry with the same key is acknowledged without counting it."""
+        dedupe_index.clear()
+        for _ in range(2):
+            response = await async_views.customer_enter(self.factory.post(
+                '/enter/', AUTHORIZATION=f"Token {self.sensor_token}", IDEMPOTENCY_KEY='a1'
+            ))
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(json.loads(response.content), {'message': 'success', 'duplicate': True})
+        response = await async_views.get_current_customers(self.factory.get('/count/'))
+        self.assertEqual(json.loads(response.content), {'amount': 1})
+
+    @override_settings(SENSOR_RATE=1, SENSOR_BURST=1)
+    async def test_throttled(self):
+        """A sensor over its rate gets 429."""
+        sensor_buckets.clear()
+        await self.post(async_views.customer_enter, '/enter/', self.sensor_token)
+        response = await self.post(async_views.customer_enter, '/enter/', self.sensor_token)
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+    async def test_no_auth(self):
+        """Entering without a token fails."""
+        response = await self.post(async_views.customer_enter, '/enter/')
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+        response = await self.post(async_views.customer_enter, '/enter/', 'wrong')
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    async def test_complete_order_staff_only(self):
+        """Only staff can complete orders."""
+        response = await self.post(async_views.complete_order, '/complete/1', self.sensor_token, 1)
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        response = await self.post(async_views.complete_order, '/complete/1', self.staff_token, 1)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        table = await sync_to_async(Table.objects.get)(table_number=1)
+        self.assertFalse(table.is_calling)
+        response = await self.post(async_views.call_staff, '/call/9', self.sensor_token, 9)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
 class CountingViewTest(APITestCase):
     """Test cases for testing counting customer correctly."""
 
     def setUp(self) -> None:
         """Authenticate the hardware and setup time."""
+        cache.clear()
         self.user = User.objects.create_user(username="bad", password="BadPassword123")
         self.client.login(username="bad", password="BadPassword123")
         self.enter_url = reverse('enter')
@@ -109,6 +542,97 @@ class CountingViewTest(APITestCase):
             self.assertEqual(response.data['amount'], 0)
 
 
+class ReadViewTest(APITestCase):
+    """Reading views do not write and are served from the cache."""
+
+    def setUp(self) -> None:
+        cache.clear()
+
+    def test_count_carries_forward(self):
+        """Count uses the last known amount when this hour has no log."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 19, 30, 0)):
+            VisitorLog.objects.create(log_time=get_current_time_zero() - datetime.timedelta(hours=2), amount=4)
+            response = self.client.get(reverse('count'))
+            self.assertEqual(response.data['amount'], 4)
+            self.assertEqual(VisitorLog.objects.count(), 1)
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('count'))
+            self.assertEqual(response.data['amount'], 4)
+
+    def test_count_after_long_gap(self):
+        """Count carries forward the last log even when it is older than 6 hours."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 19, 30, 0)):
+            VisitorLog.objects.create(log_time=get_current_time_zero() - datetime.timedelta(hours=30), amount=4)
+            response = self.client.get(reverse('count'))
+            self.assertEqual(response.data['amount'], 4)
+
+    def test_log_window(self):
+        """Log lists 7 hours with missing hours filled and no rows created."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 30, 0)):
+            zero_time = get_current_time_zero()
+            VisitorLog.objects.create(log_time=zero_time - datetime.timedelta(hours=4), amount=2)
+            VisitorLog.objects.create(log_time=zero_time - datetime.timedelta(hours=1), amount=5)
+            logs = self.client.get(reverse('visitorlog-list')).json()
+            self.assertEqual([log['amount'] for log in logs], [5, 5, 2, 2, 2, 0, 0])
+            self.assertEqual(logs[0]['log_time'], "19:00-20:00")
+            self.assertEqual(VisitorLog.objects.count(), 2)
+            with self.assertNumQueries(0):
+                self.client.get(reverse('visitorlog-list'))
+
+    def test_write_invalidates(self):
+        """Cached count changes right after enter."""
+        user = User.objects.create_user(username="bad", password="BadPassword123")
+        with freeze_time(datetime.datetime(2020, 12, 18, 19, 30, 0)):
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 0)
+            self.client.force_authenticate(user)
+            self.client.post(reverse('enter'))
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 1)
+
+
+class LogRangeViewTest(APITestCase):
+    """Tests for the paginated log range."""
+
+    def setUp(self) -> None:
+        self.range_url = reverse('visitorlog-log-range')
+
+    def get_json(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response.json()
+
+    def test_hourly_pages(self):
+        """Hours are filled and the cursor walks through every page."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 30, 0)):
+            zero_time = get_current_time_zero()
+            start = zero_time - datetime.timedelta(hours=9)
+            VisitorLog.objects.create(log_time=start + datetime.timedelta(hours=1), amount=3)
+            VisitorLog.objects.create(log_time=start + datetime.timedelta(hours=5), amount=1)
+            data = self.get_json(self.range_url, {'start': start.isoformat(), 'limit': 4})
+            amounts = [log['amount'] for log in data['results']]
+            while data['next']:
+                data = self.get_json(data['next'])
+                amounts += [log['amount'] for log in data['results']]
+            self.assertEqual(amounts, [0, 3, 3, 3, 3, 1, 1, 1, 1, 1])
+
+    def test_daily_peak(self):
+        """Days show the peak amount of the day."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 30, 0)):
+            VisitorLog.objects.create(log_time=datetime.datetime(2020, 12, 16, 13, tzinfo=datetime.timezone.utc), amount=9)
+            VisitorLog.objects.create(log_time=datetime.datetime(2020, 12, 16, 15, tzinfo=datetime.timezone.utc), amount=2)
+            data = self.get_json(self.range_url, {'start': '2020-12-16T00:00:00+07:00', 'granularity': 'day'})
+            self.assertIsNone(data['next'])
+            self.assertEqual(data['results'], [
+                {'log_time': '2020-12-16', 'amount': 9},
+                {'log_time': '2020-12-17', 'amount': 2},
+                {'log_time': '2020-12-18', 'amount': 2},
+            ])
+
+    def test_invalid_range(self):
+        """End before start is rejected."""
+        response = self.client.get(self.range_url, {'start': '2020-12-18T00:00:00Z', 'end': '2020-12-17T00:00:00Z'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
 class StatisticViewTest(APITestCase):
     """
     Tests for statistic view.
@@ -136,7 +660,7 @@ class StatisticViewTest(APITestCase):
             frozen_time.tick(delta=datetime.timedelta(hours=1))
             self.client.post(self.enter_url)
             # 0 for 21.00
-            frozen_time.tick(delta=datetime.timedelta(hours=3))
+            frozen_time.tick(delta=datetime.timedelta(hours=2))
             for i in range(5):
                 self.client.post(self.leave_url)
             # There is no customer after 21.00
@@ -148,6 +672,131 @@ class StatisticViewTest(APITestCase):
             self.assertEqual(raw_stat, [4, 5, 5, 0, 0, 0])
 
 
+class CounterEventsViewTest(APITestCase):
+    """Tests for uploading many enters and leaves at once."""
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+        self.events_url = reverse('events')
+
+    def test_events_by_hour(self):
+        """Events are merged by hour and written once for each hour."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 20, 10, 0)):
+            zero_time = get_current_time_zero()
+            events = [{'timestamp': zero_time - datetime.timedelta(hours=2, minutes=-m), 'delta': 1} for m in range(4)]
+            events += [{'timestamp': zero_time + datetime.timedelta(minutes=5), 'delta': -1}]
+            response = self.client.post(self.events_url, events, format='json')
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertEqual(response.data['events'], 5)
+            series = hourly_series(zero_time - datetime.timedelta(hours=2), zero_time)
+            self.assertEqual([amount for log_time, amount in series], [4, 4, 3])
+            # One log for each hour with events.
+            self.assertEqual(VisitorLog.objects.count(), 2)
+
+    def test_entries_of_merged_events(self):
+        """Every enter of an hour counts in the entries of the day, not the net change."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 30, 0)):
+            now = timezone.now()
+            events = [{'timestamp': now, 'delta': 1}] * 50 + [{'timestamp': now, 'delta': -1}] * 45
+            self.client.post(self.events_url, events, format='json')
+            stat = DailyStat.objects.get(date=datetime.date(2020, 12, 18))
+            self.assertEqual(stat.total_entries, 50)
+            self.assertEqual(stat.peak, 5)
+
+    def test_invalid_event(self):
+        """Nothing is written when any event is invalid."""
+        response = self.client.post(self.events_url, [{'timestamp': 'now', 'delta': 1}], format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertFalse(VisitorLog.objects.exists())
+
+    def test_future_event(self):
+        """Events later than now and the allowed clock skew are rejected."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 0, 0)):
+            now = timezone.now()
+            events = [{'timestamp': now + datetime.timedelta(seconds=30), 'delta': 1}]
+            self.assertEqual(self.client.post(self.events_url, events, format='json').status_code, HTTPStatus.OK)
+            events = [{'timestamp': now + datetime.timedelta(days=365), 'delta': 1}]
+            response = self.client.post(self.events_url, events, format='json')
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertEqual(VisitorLog.objects.get().amount, 1)
+
+    @override_settings(MAX_EVENTS=3)
+    def test_too_many_events(self):
+        """A batch over MAX_EVENTS is rejected as a whole."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 0, 0)):
+            events = [{'timestamp': timezone.now(), 'delta': 1}] * 4
+            response = self.client.post(self.events_url, events, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertFalse(VisitorLog.objects.exists())
+
+    def test_events_no_auth(self):
+        """Uploading events without login fails."""
+        self.client.logout()
+        response = self.client.post(self.events_url, [], format='json')
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+
+class PeriodStatisticViewTest(APITestCase):
+    """Tests for the daily and weekly rollups."""
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username="table01", password="TableExceed01")
+        self.client.login(username="table01", password="TableExceed01")
+        self.enter_url = reverse('enter')
+        self.leave_url = reverse('leave')
+
+    def test_entries_and_peak(self):
+        """Entries and peak are updated as visitors enter."""
+        # 19:00 in Bangkok.
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 0, 0)) as frozen_time:
+            for _ in range(3):
+                self.client.post(self.enter_url)
+            frozen_time.tick(delta=datetime.timedelta(hours=1))
+            self.client.post(self.leave_url)
+            self.client.post(self.enter_url)
+            stat = DailyStat.objects.get(date=datetime.date(2020, 12, 18))
+            self.assertEqual(stat.total_entries, 4)
+            self.assertEqual(stat.peak, 3)
+            self.assertFalse(stat.closed)
+
+    def test_past_day_is_closed(self):
+        """A past day is computed once and never changes."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 0, 0)) as frozen_time:
+            for _ in range(2):
+                self.client.post(self.enter_url)
+            frozen_time.tick(delta=datetime.timedelta(days=1))
+            url = reverse('period_statistic', args=['day'])
+            response = self.client.get(url, {'date': '2020-12-18'})
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertEqual(response.data['total_entries'], 2)
+            self.assertEqual(response.data['curve'][19:], [2, 2, 2, 2, 2])
+            self.assertEqual(response.data['average'], 2 * 5 / 6)
+            self.assertTrue(DailyStat.objects.get(date=datetime.date(2020, 12, 18)).closed)
+            VisitorLog.objects.create(log_time=datetime.datetime(2020, 12, 18, 14, tzinfo=datetime.timezone.utc), amount=50)
+            response = self.client.get(url, {'date': '2020-12-18'})
+            self.assertEqual(response.data['peak'], 2)
+
+    def test_past_week_is_stored(self):
+        """A past week is stored from its days."""
+        with freeze_time(datetime.datetime(2020, 12, 16, 12, 0, 0)) as frozen_time:
+            self.client.post(self.enter_url)
+            frozen_time.tick(delta=datetime.timedelta(days=1))
+            self.client.post(self.enter_url)
+            frozen_time.tick(delta=datetime.timedelta(days=7))
+            response = self.client.get(reverse('period_statistic', args=['week']), {'date': '2020-12-16'})
+            self.assertEqual(response.data['start'], datetime.date(2020, 12, 14))
+            self.assertEqual(response.data['total_entries'], 2)
+            self.assertEqual(response.data['peak'], 2)
+            self.assertEqual(len(response.data['days']), 7)
+            self.assertTrue(WeeklyStat.objects.filter(week_start=datetime.date(2020, 12, 14)).exists())
+
+    def test_unknown_period(self):
+        """Only day, week and month exist."""
+        response = self.client.get(reverse('period_statistic', args=['year']))
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
 class ChangeLogByTimeTest(APITestCase):
     """Change this one."""
     def test_previous_log(self):
@@ -160,35 +809,1127 @@ class ChangeLogByTimeTest(APITestCase):
             self.assertEqual(current_log.amount, 31)
 
     def test_no_previous_log(self):
-        """The function works correctly when there is no previous log and it creates logs for previous 6 hours"""
+        """The function works correctly when there is no previous log and it creates only the log of the hour."""
         with freeze_time(datetime.datetime(2020, 1, 10, 1, 0, 0)):
             zero_time = get_current_time_zero()
             change_log_by_time(zero_time, 1)
-            for i in range(1, 7):
-                previous_log, created = VisitorLog.objects.get_or_create(log_time=zero_time - datetime.timedelta(hours=i))
-                if created:
-                    self.fail(f"The function does not create previous log. It is at {previous_log.log_time}")
-                self.assertEqual(previous_log.amount, 0)
-            current_log, created = VisitorLog.objects.get_or_create(log_time=zero_time)
-            if created:
-                self.fail("It should be already there.")
+            current_log = VisitorLog.objects.get()
+            self.assertEqual(current_log.log_time, zero_time)
             self.assertEqual(current_log.amount, 1)
+            series = hourly_series(zero_time - datetime.timedelta(hours=6), zero_time)
+            self.assertEqual([amount for log_time, amount in series], [0, 0, 0, 0, 0, 0, 1])
 
     def test_long_previous_log(self):
-        """The function works correctly when there is a previous log fewer than 6 hours."""
+        """The function works correctly when the previous log is long ago."""
         with freeze_time(datetime.datetime(2020, 1, 10, 1, 0, 0)):
             zero_time = get_current_time_zero()
-            previous_time = zero_time - datetime.timedelta(hours=5)
-            previous_log = VisitorLog.objects.create(log_time=previous_time, amount=7)
+            previous_time = zero_time - datetime.timedelta(hours=30)
+            VisitorLog.objects.create(log_time=previous_time, amount=7)
             change_log_by_time(zero_time, 8)
-            for i in range(5, 0, -1):
-                previous_time = zero_time - datetime.timedelta(hours=i)
-                previous_log, created = VisitorLog.objects.get_or_create(log_time=previous_time)
-                if created:
-                    self.fail("It should be created already. ")
-                self.assertEqual(previous_log.amount, 7, msg=f"Fail at hour {i} hours ago")
-            current_log, created = VisitorLog.objects.get_or_create(log_time=zero_time)
-            if created:
-                self.fail("It should be created already.")
-            self.assertEqual(current_log.amount, 7 + 8)
+            # No rows are created for the hours in between.
+            self.assertEqual(VisitorLog.objects.count(), 2)
+            series = hourly_series(previous_time, zero_time)
+            self.assertEqual(len(series), 31)
+            for log_time, amount in series[:-1]:
+                self.assertEqual(amount, 7, msg=f"Fail at {log_time}")
+            self.assertEqual(series[-1], (zero_time, 7 + 8))
+
+    def test_series_between_changes(self):
+        """The series uses the latest change of each hour and fills the rest."""
+        with freeze_time(datetime.datetime(2020, 1, 10, 1, 0, 0)):
+            zero_time = get_current_time_zero()
+            VisitorLog.objects.create(log_time=zero_time - datetime.timedelta(hours=5), amount=3)
+            VisitorLog.objects.create(log_time=zero_time - datetime.timedelta(hours=2), amount=1)
+            series = hourly_series(zero_time - datetime.timedelta(hours=4), zero_time)
+            self.assertEqual([amount for log_time, amount in series], [3, 3, 1, 1, 1])
+            self.assertEqual(series[0][0], zero_time - datetime.timedelta(hours=4))
+
+class ApplyDeltaConcurrencyTest(TransactionTestCase):
+    """The counter engine does not lose updates under concurrent sensors."""
+
+    def hammer(self, amount, times, entrances=('',)):
+        """Apply the amount from many threads at the same time, the threads take turns at the entrances."""
+        zero_time = get_current_time_zero()
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def worker(entrance):
+            try:
+                barrier.wait()
+                for _ in range(times):
+                    apply_delta(zero_time, amount, entrance)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=[entrances[i % len(entrances)]]) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return VisitorLog.objects.get(log_time=zero_time, entrance=entrances[0])
+
+    def test_no_lost_enter(self):
+        """Every enter from every thread is counted."""
+        with freeze_time(datetime.datetime(2020, 1, 10, 1, 30, 0)):
+            current_log = self.hammer(1, 25)
+            self.assertEqual(current_log.amount, 8 * 25)
+            # The log of the hour is created exactly once.
+            self.assertEqual(VisitorLog.objects.count(), 1)
+
+    def test_never_below_zero(self):
+        """Concurrent leaves stop at zero."""
+        with freeze_time(datetime.datetime(2020, 1, 10, 1, 30, 0)):
+            apply_delta(get_current_time_zero(), 10)
+            current_log = self.hammer(-1, 5)
+            self.assertEqual(current_log.amount, 0)
+
+    def test_never_below_zero_at_many_doors(self):
+        """Concurrent leaves at different doors stop when the pub is empty."""
+        with freeze_time(datetime.datetime(2020, 1, 10, 1, 30, 0)):
+            apply_delta(get_current_time_zero(), 10, 'north')
+            self.hammer(-1, 5, ('north', 'south'))
+            self.assertEqual(current_amount(), 0)
+            self.assertEqual(sum(VisitorLog.objects.values_list('amount', flat=True)), 0)
+
+
+class TableVersionConcurrencyTest(TransactionTestCase):
+    """Concurrent changes of tables never share a version."""
+
+    def test_unique_versions(self):
+        """Every save and call from many threads at the same time takes its own version."""
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def worker(table_number):
+            try:
+                table = Table(table_number=table_number)
+                barrier.wait()
+                for _ in range(10):
+                    table.save()
+                set_calling(table_number, True)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=[table_number]) for table_number in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        versions = list(Table.objects.values_list('version', flat=True))
+        self.assertEqual(len(set(versions)), 8)
+        self.assertEqual(max(versions), 8 * 11)
+        self.assertEqual(Sequence.objects.get(name=TABLE_VERSION).value, 8 * 11)
+
+
+@override_settings(BUFFERED_COUNTING=True, COUNTING_FLUSH_INTERVAL=3600, COUNTING_FLUSH_THRESHOLD=1000)
+class BufferedCountingTest(APITestCase):
+    """Tests for counting with the write-behind buffer."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        dedupe_index.clear()
+        self.user = User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+        self.enter_url = reverse('enter')
+        self.leave_url = reverse('leave')
+
+    def tearDown(self) -> None:
+        delta_buffer.stop()
+
+    def test_count_includes_pending(self):
+        """Count is exact before the buffer is written."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            for _ in range(3):
+                self.client.post(self.enter_url)
+            self.client.post(self.leave_url)
+            self.assertFalse(VisitorLog.objects.filter(amount__gt=0).exists())
+            response = self.client.get(reverse('count'))
+            self.assertEqual(response.data['amount'], 2)
+
+    def test_flush_merges_by_hour(self):
+        """Flushing writes the net change of each hour."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            for _ in range(3):
+                self.client.post(self.enter_url)
+            frozen_time.tick(delta=datetime.timedelta(hours=1))
+            self.client.post(self.leave_url)
+            delta_buffer.flush()
+            self.assertEqual(delta_buffer.pending_amount(), 0)
+            zero_time = get_current_time_zero()
+            self.assertEqual(VisitorLog.objects.get(log_time=zero_time - datetime.timedelta(hours=1)).amount, 3)
+            self.assertEqual(VisitorLog.objects.get(log_time=zero_time).amount, 2)
+            response = self.client.get(reverse('count'))
+            self.assertEqual(response.data['amount'], 2)
+
+    def test_flush_counts_entries(self):
+        """Flushing adds every buffered enter to the entries of the day."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 0, 0)):
+            for _ in range(4):
+                self.client.post(self.enter_url)
+            for _ in range(3):
+                self.client.post(self.leave_url)
+            delta_buffer.flush()
+            stat = DailyStat.objects.get(date=datetime.date(2020, 12, 18))
+            self.assertEqual(stat.total_entries, 4)
+            self.assertEqual(stat.peak, 1)
+
+    def test_key_stored_with_flush(self):
+        """The key of a buffered change is stored when the change is written, retries before it are not counted."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.client.post(self.enter_url, HTTP_IDEMPOTENCY_KEY='k1')
+            self.assertFalse(Submission.objects.exists())
+            self.assertTrue(self.client.post(self.enter_url, HTTP_IDEMPOTENCY_KEY='k1').data['duplicate'])
+            delta_buffer.flush()
+            self.assertTrue(Submission.objects.filter(key='k1').exists())
+            self.assertTrue(self.client.post(self.enter_url, HTTP_IDEMPOTENCY_KEY='k1').data['duplicate'])
+            self.assertEqual(VisitorLog.objects.get().amount, 1)
+
+    def test_retry_written_by_another_worker(self):
+        """A buffered change whose key another worker stored first is not written."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.client.post(self.enter_url, HTTP_IDEMPOTENCY_KEY='k1')
+            self.client.post(self.enter_url, HTTP_IDEMPOTENCY_KEY='k2')
+            claim('bad', 'k1')
+            dedupe_index.clear()
+            delta_buffer.flush()
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 1)
+            self.assertEqual(VisitorEvent.objects.count(), 1)
+            self.assertEqual(DailyStat.objects.get().total_entries, 1)
+
+    def test_flush_after_direct_write(self):
+        """A past hour flushed after another writer made the next log is not lost."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 59, 0)) as frozen_time:
+            for _ in range(3):
+                self.client.post(self.enter_url)
+            frozen_time.tick(delta=datetime.timedelta(minutes=2))
+            # Another worker writes its enter right away.
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now(), 1)
+            delta_buffer.flush()
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 4)
+            # A leave of the past hour is still guarded.
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now() - datetime.timedelta(hours=1), -5)
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 4)
+
+
+class MetricsTest(APITestCase):
+    """Tests for the metrics shared by the workers."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(METRICS_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        metrics._store = None
+        self.addCleanup(setattr, metrics, '_store', None)
+        self.staff = User.objects.create_user(username="staff", password="BadPassword123", is_staff=True)
+
+    def test_sums_every_worker(self):
+        """Values written by other processes are added to ours."""
+        metrics.inc('ranlao_requests_total', view='count', method='GET', status=200)
+        other = metrics.MmapValues(os.path.join(self.directory, 'metrics_1.db'))
+        other.add('ranlao_requests_total{method="GET",status="200",view="count"}', 2)
+        self.assertEqual(metrics.collect()['ranlao_requests_total{method="GET",status="200",view="count"}'], 3)
+
+    def test_file_grows_and_reopens(self):
+        """A full file grows and a new process with the same file keeps its values."""
+        path = os.path.join(self.directory, 'metrics_1.db')
+        values = metrics.MmapValues(path)
+        for i in range(5000):
+            values.add(f'ranlao_test{{key="{i}"}}', i)
+        reopened = metrics.MmapValues(path)
+        reopened.add('ranlao_test{key="4999"}', 1)
+        self.assertEqual(metrics.collect()['ranlao_test{key="4999"}'], 5000)
+
+    def test_histogram_buckets(self):
+        """An observation is counted in every bucket above it."""
+        metrics.observe('ranlao_request_duration_seconds', 0.03, view='count')
+        values = metrics.collect()
+        self.assertNotIn('ranlao_request_duration_seconds_bucket{view="count",le="0.025"}', values)
+        self.assertEqual(values['ranlao_request_duration_seconds_bucket{view="count",le="0.05"}'], 1)
+        self.assertEqual(values['ranlao_request_duration_seconds_bucket{view="count",le="+Inf"}'], 1)
+        self.assertEqual(values['ranlao_request_duration_seconds_count{view="count"}'], 1)
+
+    def test_ended_process(self):
+        """The file of a process that ended is removed instead of being summed."""
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        path = os.path.join(self.directory, f'metrics_{process.pid}.db')
+        metrics.MmapValues(path).add('ranlao_test', 1)
+        self.assertNotIn('ranlao_test', metrics.collect())
+        self.assertFalse(os.path.exists(path))
+
+    def test_bucket_order(self):
+        """Buckets are listed by their upper bound, +Inf last, then the sum and the count."""
+        for seconds in (0.003, 0.2, 3):
+            metrics.observe('ranlao_request_duration_seconds', seconds, view='count')
+        lines = [line for line in metrics.render({}).splitlines() if 'view="count"' in line]
+        bounds = [re.search(r'le="([^"]*)"', line).group(1) for line in lines if '_bucket' in line]
+        self.assertEqual(bounds, ['0.005', '0.01', '0.025', '0.05', '0.1', '0.25', '0.5', '1', '2.5', '5', '+Inf'])
+        self.assertEqual([line.split('{')[0] for line in lines[-2:]],
+                         ['ranlao_request_duration_seconds_sum', 'ranlao_request_duration_seconds_count'])
+
+    def test_endpoint(self):
+        """Staff read request counters, latency and gauges."""
+        Table.objects.create(table_number=1, is_calling=True)
+        self.client.login(username="staff", password="BadPassword123")
+        self.client.post(reverse('enter'))
+        self.client.get(reverse('count'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        text = response.content.decode()
+        self.assertIn('ranlao_requests_total{method="GET",status="200",view="count"} 1.0', text)
+        self.assertIn('ranlao_counter_change_duration_seconds_count 1.0', text)
+        self.assertIn('# TYPE ranlao_request_duration_seconds histogram', text)
+        self.assertIn('ranlao_occupancy 1', text)
+        self.assertIn('ranlao_tables_calling 1', text)
+
+    def test_endpoint_needs_staff(self):
+        """Other users cannot read the metrics."""
+        User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+
+class MetricsDirectoryTest(APITestCase):
+    """Tests for the metrics of the test run."""
+
+    def test_temporary_directory(self):
+        """Requests of the tests do not write to the metrics directory of the project."""
+        self.client.get(reverse('count'))
+        self.assertNotEqual(os.path.realpath(settings.METRICS_DIR), os.path.realpath(settings.BASE_DIR / 'metrics'))
+        self.assertTrue(os.path.exists(os.path.join(settings.METRICS_DIR, f'metrics_{os.getpid()}.db')))
+
+    def test_temporary_occupancy(self):
+        """The shared occupancy of the tests is not the file of the project."""
+        self.assertEqual(os.path.dirname(shared_occupancy.path), settings.METRICS_DIR)
+        self.assertEqual(shared_occupancy.path, settings.SHARED_OCCUPANCY_FILE)
+
+
+@override_settings(SHARED_OCCUPANCY=True)
+class SharedOccupancyTest(APITestCase):
+    """Tests for current customers shared by the workers."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'occupancy.mmap')
+        old_path = shared_occupancy.path
+        shared_occupancy.path, shared_occupancy.pid = self.path, None
+        self.addCleanup(setattr, shared_occupancy, 'path', old_path)
+        self.addCleanup(setattr, shared_occupancy, 'pid', None)
+        self.user = User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+
+    def count(self, url_name: str, times: int = 1):
+        for _ in range(times):
+            # Run what waits for the commit like a request outside the test transaction.
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse(url_name))
+
+    def test_reads_without_database(self):
+        """After the first read of a worker, counting does not query the database."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.assertEqual(current_amount(), 0)
+            self.count('enter', 3)
+            self.count('leave')
+            with self.assertNumQueries(0):
+                self.assertEqual(current_amount(), 2)
+            # Another worker maps the same file.
+            other = SharedOccupancy(self.path)
+            with other.locked():
+                other.add(get_current_time_zero(), 1)
+            with self.assertNumQueries(0):
+                self.assertEqual(current_amount(), 3)
+
+    def test_new_hour(self):
+        """The counter is read from the logs again at a new hour."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            self.count('enter', 2)
+            self.assertEqual(current_amount(), 2)
+            frozen_time.tick(delta=datetime.timedelta(hours=1))
+            self.assertIsNone(shared_occupancy.read(get_current_time_zero()))
+            self.assertEqual(current_amount(), 2)
+            self.count('leave')
+            self.assertEqual(current_amount(), 1)
+            self.assertEqual(VisitorLog.objects.get(log_time=get_current_time_zero()).amount, 1)
+
+    def test_changed_log(self):
+        """Editing a log outside the counters makes workers read it again."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.count('enter', 2)
+            self.assertEqual(current_amount(), 2)
+            VisitorLog.objects.filter(log_time=get_current_time_zero()).get().delete()
+            self.assertEqual(current_amount(), 0)
+
+    def test_dead_writer(self):
+        """A write left in the middle is recovered by the next write."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.count('enter')
+            self.assertEqual(current_amount(), 1)
+            shared_occupancy._mmap[0:8] = (41).to_bytes(8, 'little')
+            self.assertIsNone(shared_occupancy.read(get_current_time_zero()))
+            self.assertEqual(current_amount(), 1)
+            self.assertEqual(shared_occupancy.read(get_current_time_zero()), 1)
+
+
+class EventStoreTest(APITestCase):
+    """Tests for the raw events and the logs made from them."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = User.objects.create_user(username="sensor", password="BadPassword123")
+        self.client.login(username="sensor", password="BadPassword123")
+
+    def test_events_are_appended(self):
+        """Every enter and leave is stored with its device."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.client.post(reverse('enter'))
+            self.client.post(reverse('leave'))
+            self.client.post(reverse('events'), [
+                {'timestamp': '2020-12-18T17:30:00Z', 'delta': 2},
+            ], format='json')
+        events = list(VisitorEvent.objects.order_by('pk').values_list('device', 'delta'))
+        self.assertEqual(events, [('sensor', 1), ('sensor', -1), ('sensor', 2)])
+
+    @override_settings(BUFFERED_COUNTING=True, COUNTING_FLUSH_INTERVAL=3600, COUNTING_FLUSH_THRESHOLD=1000)
+    def test_buffered_events(self):
+        """Buffered events are written with their changes."""
+        self.addCleanup(delta_buffer.stop)
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            for _ in range(3):
+                self.client.post(reverse('enter'))
+            self.assertFalse(VisitorEvent.objects.exists())
+            delta_buffer.flush()
+        self.assertEqual(VisitorEvent.objects.filter(delta=1).count(), 3)
+
+    def test_rebuild(self):
+        """Logs and statistics made again from the events match the ones kept while counting."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 11, 0, 0)) as frozen_time:
+            for _ in range(3):
+                self.client.post(reverse('enter'))
+            frozen_time.tick(delta=datetime.timedelta(hours=2))
+            self.client.post(reverse('leave'))
+            self.client.post(reverse('enter'))
+            self.client.post(reverse('enter'))
+            logs = list(VisitorLog.objects.order_by('log_time').values_list('log_time', 'amount'))
+            stat = DailyStat.objects.values('peak', 'total_entries').get()
+            VisitorLog.objects.update(amount=0)
+            DailyStat.objects.all().delete()
+            call_command('rebuild_projections', stdout=io.StringIO())
+            self.assertEqual(list(VisitorLog.objects.order_by('log_time').values_list('log_time', 'amount')), logs)
+            self.assertEqual(DailyStat.objects.values('peak', 'total_entries').get(), stat)
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 4)
+
+    @override_settings(BUFFERED_COUNTING=True, COUNTING_FLUSH_INTERVAL=3600, COUNTING_FLUSH_THRESHOLD=1000)
+    def test_rebuild_merged_leave(self):
+        """A merged change that was rejected while counting is rejected again, not clamped."""
+        self.addCleanup(delta_buffer.stop)
+        with freeze_time(datetime.datetime(2020, 12, 18, 11, 0, 0)) as frozen_time:
+            for _ in range(2):
+                self.client.post(reverse('enter'))
+            delta_buffer.flush()
+            frozen_time.tick(delta=datetime.timedelta(minutes=10))
+            # One enter and four leaves are merged into -3, which would go below zero.
+            self.client.post(reverse('enter'))
+            for _ in range(4):
+                self.client.post(reverse('leave'))
+            delta_buffer.flush()
+            logs = list(VisitorLog.objects.order_by('log_time').values_list('log_time', 'amount'))
+            stat = DailyStat.objects.values('peak', 'total_entries').get()
+            self.assertEqual(stat, {'peak': 2, 'total_entries': 2})
+            call_command('rebuild_projections', stdout=io.StringIO())
+            self.assertEqual(list(VisitorLog.objects.order_by('log_time').values_list('log_time', 'amount')), logs)
+            self.assertEqual(DailyStat.objects.values('peak', 'total_entries').get(), stat)
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 2)
+
+    def test_rebuild_keeps_older_logs(self):
+        """Logs from before the first event are left alone."""
+        VisitorLog.objects.create(log_time=datetime.datetime(2020, 12, 1, 12, tzinfo=datetime.timezone.utc), amount=7)
+        VisitorEvent.objects.create(timestamp=datetime.datetime(2020, 12, 18, 12, tzinfo=datetime.timezone.utc),
+                                    delta=-2)
+        call_command('rebuild_projections', stdout=io.StringIO())
+        self.assertEqual(list(VisitorLog.objects.order_by('log_time').values_list('amount', flat=True)), [7, 5])
+
+
+class EntranceTest(APITestCase):
+    """Tests for counting at many doors."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = User.objects.create_user(username="sensor", password="BadPassword123")
+        self.client.login(username="sensor", password="BadPassword123")
+
+    def post(self, url_name: str, entrance: str):
+        return self.client.post(f"{reverse(url_name)}?entrance={entrance}")
+
+    def test_doors_write_their_own_logs(self):
+        """Each door has its own log and the count is their sum."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.post('enter', 'north')
+            self.post('enter', 'north')
+            self.post('enter', 'south')
+            self.post('leave', 'south')
+            self.post('leave', 'south')
+            zero_time = get_current_time_zero()
+            logs = dict(VisitorLog.objects.filter(log_time=zero_time).values_list('entrance', 'amount'))
+            self.assertEqual(logs, {'north': 2, 'south': -1})
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 1)
+            self.assertEqual(DailyStat.objects.get().peak, 3)
+
+    def test_late_leave_checks_every_hour(self):
+        """A late leave is rejected when the pub would go below zero at any later hour."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now(), 2, 'north')
+            frozen_time.tick(delta=datetime.timedelta(hours=1))
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now(), -2, 'south')
+            frozen_time.tick(delta=datetime.timedelta(hours=1))
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now(), 5, 'south')
+                # Nobody was in at 19:00, so a leave of 18:00 cannot be counted.
+                apply_delta(timezone.now() - datetime.timedelta(hours=2), -1, 'north')
+            zero_time = get_current_time_zero()
+            series = hourly_series(zero_time - datetime.timedelta(hours=2), zero_time)
+            self.assertEqual([amount for log_time, amount in series], [2, 0, 5])
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now() - datetime.timedelta(hours=1), -1, 'south')
+            series = hourly_series(zero_time - datetime.timedelta(hours=2), zero_time)
+            self.assertEqual([amount for log_time, amount in series], [2, 0, 5])
+
+    def test_cannot_go_below_zero(self):
+        """A leave is ignored when nobody is in, whatever the door."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.post('enter', 'north')
+            self.post('leave', 'south')
+            self.post('leave', 'south')
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 0)
+            self.assertEqual(VisitorLog.objects.get(entrance='south').amount, -1)
+
+    def test_hours_sum_doors(self):
+        """Hours without a log of a door carry its last amount."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            self.post('enter', 'north')
+            self.post('enter', 'north')
+            frozen_time.tick(delta=datetime.timedelta(hours=1))
+            self.post('enter', 'south')
+            frozen_time.tick(delta=datetime.timedelta(hours=1))
+            self.post('leave', 'north')
+            start = get_current_time_zero() - datetime.timedelta(hours=2)
+            end = get_current_time_zero()
+            self.assertEqual([amount for log_time, amount in hourly_series(start, end)], [2, 3, 2])
+            response = self.client.get(reverse('visitorlog-log-range'), {
+                'start': start.isoformat(), 'end': end.isoformat(), 'entrance': 'north',
+            })
+            amounts = [log['amount'] for log in response.json()['results']]
+            self.assertEqual(amounts, [2, 2, 1])
+
+    def test_breakdown(self):
+        """Each door lists its customers, entries and exits."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.post('enter', 'north')
+            self.post('enter', 'north')
+            self.post('leave', 'south')
+            response = self.client.get(reverse('visitorlog-entrances'))
+        self.assertEqual(response.data, [
+            {'entrance': 'north', 'amount': 2, 'entries': 2, 'exits': 0},
+            {'entrance': 'south', 'amount': -1, 'entries': 0, 'exits': 1},
+        ])
+
+    def test_rebuild_doors(self):
+        """Logs of each door are made again from the events."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.post('enter', 'north')
+            self.post('leave', 'south')
+            self.post('leave', 'south')
+            logs = set(VisitorLog.objects.values_list('entrance', 'amount'))
+            VisitorLog.objects.all().delete()
+            call_command('rebuild_projections', stdout=io.StringIO())
+        self.assertEqual(set(VisitorLog.objects.values_list('entrance', 'amount')), logs)
+
+    @skipUnless(connection.vendor == 'sqlite', "The plan is read from SQLite.")
+    def test_latest_logs_use_index(self):
+        """The amount before a time and the guard of a leave seek the latest logs in the index."""
+        zero_time = get_current_time_zero()
+        VisitorLog.objects.bulk_create([
+            VisitorLog(log_time=zero_time - datetime.timedelta(hours=hours), entrance=entrance, amount=1)
+            for hours in range(1, 50) for entrance in ('north', 'south')
+        ])
+        register_entrances('north', 'south')
+        self.assertEqual(amount_before(zero_time), 2)
+        guarded = VisitorLog.objects.filter(log_time=zero_time, entrance='north') \
+            .filter(GreaterThanOrEqual(Coalesce(total_before(zero_time), 0), Value(1)))
+        for queryset in (latest_logs_before(zero_time), guarded):
+            plan = queryset.explain()
+            # Only the entrances are scanned, under their name or their alias in a subquery.
+            entrance_tables = {'ranlao_entrance', *re.findall(r'"ranlao_entrance" (\w+)', str(queryset.query))}
+            for scanned in re.findall(r'SCAN (?:TABLE )?(\w+)', plan):
+                self.assertIn(scanned, entrance_tables, plan)
+
+    def test_invalid_entrance(self):
+        """Entrance names are at most 50 characters."""
+        response = self.post('enter', 'x' * 51)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertFalse(VisitorEvent.objects.exists())
+
+
+class IdempotencyTest(APITestCase):
+    """Tests for retries of the hardware."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        dedupe_index.clear()
+        self.user = User.objects.create_user(username="sensor", password="BadPassword123")
+        self.client.login(username="sensor", password="BadPassword123")
+
+    def enter(self, **kwargs):
+        return self.client.post(reverse('enter'), **kwargs)
+
+    def test_retry_is_not_counted(self):
+        """The same key is counted once, other keys are counted."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.assertEqual(self.enter(HTTP_IDEMPOTENCY_KEY='a1').data, {'message': 'success'})
+            self.assertEqual(self.enter(HTTP_IDEMPOTENCY_KEY='a1').data, {'message': 'success', 'duplicate': True})
+            self.enter(HTTP_IDEMPOTENCY_KEY='a2')
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 2)
+            self.assertEqual(VisitorEvent.objects.count(), 2)
+
+    def test_sequence_number(self):
+        """A sequence number in the query is a key too."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.client.post(f"{reverse('enter')}?seq=7")
+            self.client.post(f"{reverse('leave')}?seq=7")
+            self.client.post(f"{reverse('enter')}?seq=8")
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 2)
+
+    def test_sequence_after_reboot(self):
+        """Only the latest number is a retry, a device that counts again from 0 is counted."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            for seq in (5, 6, 6, 0, 1, 1):
+                self.client.post(f"{reverse('enter')}?seq={seq}")
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 4)
+        self.assertEqual(self.client.post(f"{reverse('enter')}?seq=x1").status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_after_restart(self):
+        """Keys are found in the database when the memory of the worker is empty."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.enter(HTTP_IDEMPOTENCY_KEY='a1')
+            dedupe_index.clear()
+            self.assertTrue(self.enter(HTTP_IDEMPOTENCY_KEY='a1').data['duplicate'])
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 1)
+
+    def test_keys_of_each_device(self):
+        """Devices may use the same keys."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.enter(HTTP_IDEMPOTENCY_KEY='a1')
+            User.objects.create_user(username="sensor2", password="BadPassword123")
+            self.client.login(username="sensor2", password="BadPassword123")
+            self.assertNotIn('duplicate', self.enter(HTTP_IDEMPOTENCY_KEY='a1').data)
+
+    def test_retry_of_events(self):
+        """A batch of events is counted once."""
+        events = [{'timestamp': '2020-12-18T18:00:00Z', 'delta': 3}]
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            for _ in range(2):
+                self.client.post(reverse('events'), events, format='json', HTTP_IDEMPOTENCY_KEY='b1')
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 3)
+
+    def test_invalid_key(self):
+        """Keys are at most 64 characters."""
+        response = self.enter(HTTP_IDEMPOTENCY_KEY='x' * 65)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertFalse(VisitorEvent.objects.exists())
+
+    @override_settings(IDEMPOTENCY_WINDOW=3600, IDEMPOTENCY_CACHE_SIZE=2)
+    def test_bounded(self):
+        """Memory keeps the latest keys and old keys are deleted from the database."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            for key in ('a1', 'a2', 'a3'):
+                claim('sensor', key)
+            self.assertFalse(dedupe_index.seen(('sensor', 'a1')))
+            frozen_time.tick(delta=datetime.timedelta(hours=2))
+            dedupe_index.clear()
+            claim('sensor', 'a4')
+            self.assertEqual(list(Submission.objects.values_list('key', flat=True)), ['a4'])
+
+
+@override_settings(SENSOR_RATE=1, SENSOR_BURST=2)
+class SensorThrottleTest(APITestCase):
+    """Tests for the rate of each sensor."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        sensor_buckets.clear()
+        dedupe_index.clear()
+        self.user = User.objects.create_user(username="sensor", password="BadPassword123")
+        self.client.login(username="sensor", password="BadPassword123")
+
+    def test_over_rate(self):
+        """Changes over the burst are rejected until the bucket fills up again."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            for _ in range(2):
+                self.assertEqual(self.client.post(reverse('enter')).status_code, HTTPStatus.OK)
+            response = self.client.post(reverse('enter'))
+            self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 2)
+            frozen_time.tick(delta=datetime.timedelta(seconds=1))
+            self.assertEqual(self.client.post(reverse('leave')).status_code, HTTPStatus.OK)
+
+    def test_devices_have_own_buckets(self):
+        """A bouncing sensor does not stop the others."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            for _ in range(3):
+                self.client.post(reverse('enter'))
+            User.objects.create_user(username="sensor2", password="BadPassword123")
+            self.client.login(username="sensor2", password="BadPassword123")
+            self.assertEqual(self.client.post(reverse('enter')).status_code, HTTPStatus.OK)
+
+    def test_duplicate_keeps_token(self):
+        """Retries of a written change do not use up the bucket of the device."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            # The second one finds the key in the database and gives its token back,
+            # the others find it in memory and take none.
+            for _ in range(4):
+                response = self.client.post(reverse('enter'), HTTP_IDEMPOTENCY_KEY='door-1')
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertEqual(self.client.post(reverse('enter')).status_code, HTTPStatus.OK)
+            self.assertEqual(self.client.post(reverse('enter')).status_code, HTTPStatus.TOO_MANY_REQUESTS)
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 2)
+
+    def test_least_recently_used_dropped(self):
+        """Over MAX_BUCKETS the bucket of the device idle for the longest is dropped, a throttled one stays."""
+        buckets = TokenBuckets()
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)), \
+                mock.patch.object(TokenBuckets, 'MAX_BUCKETS', 2):
+            for _ in range(3):
+                buckets.take('bouncing')
+            buckets.take('idle')
+            buckets.take('bouncing')
+            buckets.take('new')
+            self.assertEqual(list(buckets._buckets), ['bouncing', 'new'])
+            self.assertGreater(buckets.take('bouncing'), 0)
+
+    @override_settings(SENSOR_COALESCE=True, COUNTING_FLUSH_INTERVAL=3600, COUNTING_FLUSH_THRESHOLD=1000)
+    def test_coalesce(self):
+        """Changes over the rate are merged and written together."""
+        self.addCleanup(delta_buffer.stop)
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            for _ in range(2):
+                self.client.post(reverse('enter'))
+            for url_name in ('enter', 'leave', 'enter'):
+                response = self.client.post(reverse(url_name))
+                self.assertEqual(response.status_code, HTTPStatus.ACCEPTED)
+                self.assertEqual(response.data, {'message': 'success', 'merged': True})
+            self.assertEqual(VisitorLog.objects.get().amount, 2)
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 3)
+            delta_buffer.flush()
+            self.assertEqual(VisitorLog.objects.get().amount, 3)
+            self.assertEqual(VisitorEvent.objects.count(), 5)
+
+    @override_settings(SENSOR_COALESCE=True, COUNTING_FLUSH_INTERVAL=3600, COUNTING_FLUSH_THRESHOLD=1000)
+    def test_flush_after_the_hour(self):
+        """Merged changes written after the next hour has a log are carried to it."""
+        self.addCleanup(delta_buffer.stop)
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 59, 0)) as frozen_time:
+            for _ in range(5):
+                self.client.post(reverse('enter'))
+            frozen_time.tick(delta=datetime.timedelta(minutes=2))
+            self.assertEqual(self.client.post(reverse('enter')).status_code, HTTPStatus.OK)
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 6)
+            delta_buffer.flush()
+            self.assertEqual(self.client.get(reverse('count')).data['amount'], 6)
+            zero_time = get_current_time_zero()
+            self.assertEqual(VisitorLog.objects.get(log_time=zero_time - datetime.timedelta(hours=1)).amount, 5)
+            self.assertEqual(VisitorLog.objects.get(log_time=zero_time).amount, 6)
+
+
+class CallQueueTest(APITestCase):
+    """Tests for the queue of calls of the staff."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        call_queue.invalidate()
+        for table_number in (1, 2, 3):
+            Table.objects.create(table_number=table_number)
+        self.staff = User.objects.create_user(username="staff", password="BadPassword123", is_staff=True)
+        self.client.login(username="staff", password="BadPassword123")
+
+    def post(self, url_name: str, table_number: int):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse(url_name, args=[table_number]))
+
+    def open_tables(self) -> list:
+        return [call['table'] for call in self.client.get(reverse('calls')).data['calls']]
+
+    def test_oldest_first(self):
+        """Open calls are listed from the oldest one and leave the queue when resolved."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            self.post('call_staff', 2)
+            frozen_time.tick(delta=datetime.timedelta(seconds=30))
+            self.post('call_staff', 1)
+            self.assertEqual(self.open_tables(), [2, 1])
+            self.post('complete_order', 2)
+            self.post('call_staff', 2)
+            self.assertEqual(self.open_tables(), [1, 2])
+            # The queue is in memory until it is read again.
+            with self.assertNumQueries(0):
+                call_queue.open_calls()
+            call_queue.invalidate()
+            self.assertEqual(self.open_tables(), [1, 2])
+
+    def test_single_open_call(self):
+        """Calling again keeps the open call of the table."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            self.post('call_staff', 1)
+            self.post('call_staff', 1)
+            self.post('complete_order', 1)
+            self.post('complete_order', 1)
+        self.assertEqual(TableCall.objects.count(), 1)
+        self.assertIsNotNone(TableCall.objects.get().resolved_at)
+
+    def test_response_times(self):
+        """Statistic of the time taken to answer the calls of the day."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 0, 0)) as frozen_time:
+            self.post('call_staff', 1)
+            self.post('call_staff', 2)
+            frozen_time.tick(delta=datetime.timedelta(seconds=60))
+            self.post('complete_order', 1)
+            frozen_time.tick(delta=datetime.timedelta(seconds=60))
+            self.post('complete_order', 2)
+            self.post('call_staff', 3)
+            response = self.client.get(reverse('call_statistic'))
+        self.assertEqual(response.data['calls'], 2)
+        self.assertEqual(response.data['average'], 90)
+        self.assertEqual(response.data['max'], 120)
+
+    def test_staff_only(self):
+        """Tables cannot read the queue."""
+        User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+        self.assertEqual(self.client.get(reverse('calls')).status_code, HTTPStatus.FORBIDDEN)
+
+    def test_saved_outside_views(self):
+        """Saving is_calling (for example in the admin) opens and resolves the call."""
+        table = Table.objects.get(table_number=2)
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)) as frozen_time:
+            self.open_tables()
+            table.is_calling = True
+            with self.captureOnCommitCallbacks(execute=True):
+                table.save()
+            self.assertEqual(self.open_tables(), [2])
+            frozen_time.tick(delta=datetime.timedelta(seconds=60))
+            table.is_calling = False
+            with self.captureOnCommitCallbacks(execute=True):
+                table.save(update_fields=['is_calling'])
+            self.assertEqual(self.open_tables(), [])
+            self.assertEqual(self.client.get(reverse('call_statistic')).data['max'], 60)
+
+    def test_migrated_calls(self):
+        """Tables that were calling before calls were stored get an open call, once."""
+        migration = import_module('ranlao.migrations.0013_open_table_calls')
+        Table.objects.filter(table_number__in=[1, 2]).update(is_calling=True)
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            migration.open_calls(apps, None)
+            migration.open_calls(apps, None)
+            self.assertEqual(self.open_tables(), [1, 2])
+        self.assertEqual(TableCall.objects.count(), 2)
+        self.post('complete_order', 1)
+        self.assertIsNotNone(TableCall.objects.get(table__table_number=1).resolved_at)
+
+
+class BulkTableTest(APITestCase):
+    """Tests for the bulk operations on tables."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        call_queue.invalidate()
+        for table_number in range(1, 6):
+            Table.objects.create(table_number=table_number)
+        self.staff = User.objects.create_user(username="staff", password="BadPassword123", is_staff=True)
+        self.client.login(username="staff", password="BadPassword123")
+
+    def post(self, url_name: str, data: dict):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse(url_name), data, format='json')
+
+    @staticmethod
+    def results(response) -> dict:
+        return {result['table']: result['result'] for result in response.data['results']}
+
+    def test_complete_range(self):
+        """Calls of a range of tables are answered in one UPDATE."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            for table_number in (2, 3):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.post(reverse('call_staff', args=[table_number]))
+            response = self.post('table-complete-many', {'start': 2, 'end': 4})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(self.results(response), {2: 'completed', 3: 'completed', 4: 'not calling'})
+        self.assertFalse(Table.objects.filter(is_calling=True).exists())
+        self.assertEqual(TableCall.objects.filter(resolved_at__isnull=False).count(), 2)
+        self.assertEqual(call_queue.open_calls(), [])
+
+    def test_reset_is_not_counted(self):
+        """Reset calls are left out of the response times."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 0, 0)):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('call_staff', args=[1]))
+            response = self.post('table-reset-many', {'tables': [1, 9]})
+        self.assertEqual(self.results(response), {1: 'reset', 9: 'missing'})
+        self.assertFalse(Table.objects.get(table_number=1).is_calling)
+        self.assertFalse(TableCall.objects.exists())
+
+    def test_bulk_create(self):
+        """Tables are created in one INSERT and existing ones are kept."""
+        # Session, user, savepoint, version, INSERT, created tables and release.
+        with self.assertNumQueries(7), mock.patch.object(broker, 'publish') as publish:
+            response = self.post('table-bulk-create', {'start': 4, 'end': 8})
+        self.assertEqual(self.results(response), {4: 'exists', 5: 'exists', 6: 'created', 7: 'created', 8: 'created'})
+        self.assertEqual(Table.objects.count(), 8)
+        self.assertEqual([call.args[0] for call in publish.call_args_list],
+                         [table_event(6, False), table_event(7, False), table_event(8, False)])
+
+    def test_bulk_create_race(self):
+        """A table inserted by another request during the call is reported as existing."""
+        def version_and_insert():
+            Table.objects.create(table_number=7)
+            return next_version()
+
+        with mock.patch('ranlao.tables.next_version', version_and_insert):
+            response = self.post('table-bulk-create', {'tables': [6, 7]})
+        self.assertEqual(self.results(response), {6: 'created', 7: 'exists'})
+
+    def test_renumber(self):
+        """Tables can swap numbers, a move onto a table that keeps its number is a conflict."""
+        user = User.objects.create_user(username="table1", password="BadPassword123")
+        UserTable.objects.create(user=user, table=Table.objects.get(table_number=1))
+        table_1, table_2 = Table.objects.get(table_number=1), Table.objects.get(table_number=2)
+        response = self.post('table-renumber', {'changes': [
+            {'table_number': 1, 'new_number': 2},
+            {'table_number': 2, 'new_number': 1},
+            {'table_number': 3, 'new_number': 5},
+            {'table_number': 4, 'new_number': 3},
+            {'table_number': 9, 'new_number': 10},
+        ]})
+        self.assertEqual(self.results(response), {1: 'renumbered', 2: 'renumbered', 3: 'conflict', 4: 'conflict',
+                                                  9: 'missing'})
+        table_1.refresh_from_db()
+        table_2.refresh_from_db()
+        self.assertEqual((table_1.table_number, table_2.table_number), (2, 1))
+        self.assertEqual(Table.objects.filter(table_number=3).count(), 1)
+
+    def test_renumber_publishes(self):
+        """Clients get the tables at their new numbers and the numbers left free are removed."""
+        Table.objects.filter(table_number=1).update(is_calling=True)
+        with mock.patch.object(EventBroker, 'has_subscribers', True), \
+                mock.patch.object(broker, 'publish') as publish:
+            self.post('table-renumber', {'changes': [
+                {'table_number': 1, 'new_number': 2},
+                {'table_number': 2, 'new_number': 1},
+                {'table_number': 5, 'new_number': 8},
+            ]})
+        events = [call.args[0] for call in publish.call_args_list]
+        self.assertEqual(events[0], table_removed_event(5))
+        self.assertCountEqual(events[1:], [table_event(1, False), table_event(2, True), table_event(8, False)])
+
+    def test_invalid(self):
+        """Repeated numbers, missing selections and large ranges are rejected."""
+        self.assertEqual(self.post('table-bulk-create', {}).status_code, HTTPStatus.BAD_REQUEST)
+        self.assertEqual(self.post('table-complete-many', {'start': 1, 'end': 5000}).status_code,
+                         HTTPStatus.BAD_REQUEST)
+        response = self.post('table-renumber', {'changes': [
+            {'table_number': 1, 'new_number': 7}, {'table_number': 2, 'new_number': 7}
+        ]})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_staff_only(self):
+        """Tables cannot run bulk operations."""
+        User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+        self.assertEqual(self.post('table-bulk-create', {'tables': [9]}).status_code, HTTPStatus.FORBIDDEN)
+
+
+class RenderingTest(APITestCase):
+    """Tests for the encoded bodies of the table and log lists."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        rendered_bodies.clear()
+        for table_number in (1, 2, 3):
+            Table.objects.create(table_number=table_number)
+        self.staff = User.objects.create_user(username="staff", password="BadPassword123", is_staff=True)
+
+    def test_same_as_serializer(self):
+        """Tables are encoded like TableSerializer."""
+        Table.objects.filter(table_number=2).update(is_calling=True)
+        response = self.client.get(reverse('table-list'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.json(), TableSerializer(Table.objects.order_by('pk'), many=True).data)
+
+    def test_repeated_poll(self):
+        """An unchanged poll only looks up the version and the body, a change renders it again."""
+        body = self.client.get(reverse('table-list')).content
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(reverse('table-list')).content, body)
+        self.client.force_authenticate(self.staff)
+        self.client.post(reverse('call_staff', args=[1]))
+        self.assertNotEqual(self.client.get(reverse('table-list')).content, body)
+
+    def test_logs(self):
+        """Logs are shown as hour ranges in local time and change after a write."""
+        with freeze_time(datetime.datetime(2020, 12, 18, 18, 30, 0)):
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now(), 2)
+            hour = timezone.localtime().hour
+            self.assertEqual(self.client.get(reverse('visitorlog-list')).json()[0],
+                             {'log_time': f"{hour}:00-{hour + 1}:00", 'amount': 2})
+            with self.assertNumQueries(0):
+                self.client.get(reverse('visitorlog-list'))
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_delta(timezone.now(), 1)
+            self.assertEqual(self.client.get(reverse('visitorlog-list')).json()[0]['amount'], 3)
+
+
+class ExportTest(APITestCase):
+    """Tests for the export of the logs."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        with freeze_time(datetime.datetime(2020, 12, 18, 12, 0, 0)):
+            self.zero_time = get_current_time_zero()
+        for hours, entrance, amount in ((0, '', 3), (0, 'back', 1), (2, '', 5), (30, '', 7), (24 * 40, '', 9)):
+            VisitorLog.objects.create(log_time=self.zero_time - datetime.timedelta(hours=hours), entrance=entrance,
+                                      amount=amount)
+        self.staff = User.objects.create_user(username="staff", password="BadPassword123", is_staff=True)
+        self.client.login(username="staff", password="BadPassword123")
+        self.today = local_date(self.zero_time)
+
+    def export(self, **query):
+        return self.client.get(reverse('visitorlog-export'), {'start': self.today.isoformat(), **query})
+
+    def test_csv(self):
+        """The logs of the days are streamed as CSV with a header, the oldest first."""
+        response = self.export()
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ['log_time', 'entrance', 'amount'])
+        self.assertEqual([row[1:] for row in rows[1:]], [['', '5'], ['', '3'], ['back', '1']])
+        self.assertEqual(rows[-1][0], timezone.localtime(self.zero_time).isoformat())
+
+    def test_ndjson(self):
+        """Each log is a line of JSON, filtered by entrance and over many days."""
+        start = self.today - datetime.timedelta(days=60)
+        response = self.export(start=start.isoformat(), end=self.today.isoformat(), output='ndjson', entrance='')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['amount'] for line in lines], [9, 7, 5, 3])
+
+    def test_invalid(self):
+        """The end must not be before the start."""
+        end = self.today - datetime.timedelta(days=1)
+        self.assertEqual(self.export(end=end.isoformat()).status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_staff_only(self):
+        """Tables cannot export the logs."""
+        User.objects.create_user(username="bad", password="BadPassword123")
+        self.client.login(username="bad", password="BadPassword123")
+        self.assertEqual(self.export().status_code, HTTPStatus.FORBIDDEN)
+
+    def test_command(self):
+        """The command writes the same lines."""
+        out = io.StringIO()
+        call_command('export_logs', '--start', self.today.isoformat(), '--end', self.today.isoformat(),
+                     '--format', 'ndjson', '--chunk-size', '1', stdout=out)
+        self.assertEqual(out.getvalue(), b''.join(self.export(output='ndjson').streaming_content).decode())
+
+
+class LoadTestCommandTest(APITestCase):
+    """Tests for the load test command."""
+
+    def test_accounts_are_deleted(self):
+        """Users, tokens and tables made for the run are deleted, the existing ones are kept."""
+        Table.objects.create(table_number=1)
+        call_command('loadtest', '--base-url', 'http://127.0.0.1:9', '--duration', '0', '--tablets', '2',
+                     '--skip-queries', stdout=io.StringIO())
+        self.assertFalse(User.objects.filter(username__startswith='loadtest-').exists())
+        self.assertFalse(Token.objects.exists())
+        self.assertEqual(list(Table.objects.values_list('table_number', flat=True)), [1])
+
+    def test_keep_accounts(self):
+        """The accounts are kept when asked."""
+        call_command('loadtest', '--base-url', 'http://127.0.0.1:9', '--duration', '0', '--tablets', '1',
+                     '--skip-queries', '--keep-accounts', stdout=io.StringIO())
+        self.assertTrue(User.objects.filter(username='loadtest-staff', is_staff=True).exists())
+
+
+class ASGIStreamingTest(TransactionTestCase):
+    """Tests for the responses read from the database through the ASGI application of uvicorn."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        token_cache.clear()
+        self.staff_token = Token.objects.create(user=User.objects.create_user(username="staff", is_staff=True)).key
+        self.zero_time = get_current_time_zero()
+        VisitorLog.objects.bulk_create([
+            VisitorLog(log_time=self.zero_time - datetime.timedelta(hours=hours), amount=hours) for hours in range(5)
+        ])
+
+    async def get(self, path: str, query: dict, application=asgi.application) -> tuple:
+        """Get the path through the ASGI application. Returns the status and the body."""
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await application({
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': urlencode(query).encode(), 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'authorization', f"Token {self.staff_token}".encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    async def test_log_range(self):
+        """A page of the logs is read before the response is sent."""
+        start = self.zero_time - datetime.timedelta(hours=4)
+        status, body = await self.get(reverse('visitorlog-log-range'), {'start': start.isoformat(), 'limit': 3})
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertEqual([log['amount'] for log in json.loads(body)['results']], [4, 3, 2])
+
+    @override_settings(PROFILING_ENABLED=True)
+    async def test_profiled(self):
+        """The queries of sync views are measured by the async middleware."""
+        recent_profiles.clear()
+        start = self.zero_time - datetime.timedelta(hours=4)
+        status, body = await self.get(reverse('visitorlog-log-range'), {'start': start.isoformat()},
+                                      StreamingASGIHandler())
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertEqual(recent_profiles[-1]['url_name'], 'visitorlog-log-range')
+        self.assertGreater(recent_profiles[-1]['queries'], 0)
 
+    async def test_export(self):
+        """The export is streamed and reads the database in the thread of the request."""
+        start = local_date(self.zero_time - datetime.timedelta(hours=4)).isoformat()
+        status, body = await self.get(reverse('visitorlog-export'),
+                                      {'start': start, 'end': local_date(self.zero_time).isoformat(),
+                                       'output': 'ndjson'})
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertEqual([json.loads(line)['amount'] for line in body.decode().splitlines()], [4, 3, 2, 1, 0])
@@ -0,0 +1,102 @@
+import collections
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from .idempotency import dedupe_index, submission_key
+
+
+class TokenBuckets:
+    """
+    Token bucket of each device in this worker.
+
+    A bucket holds up to SENSOR_BURST tokens and gets SENSOR_RATE tokens
+    a second back. Every request takes one.
+    """
+
+    # Buckets of the devices that sent nothing for the longest are dropped
+    # when there are more buckets than this, a dropped bucket is full again.
+    MAX_BUCKETS = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+
+    def take(self, key) -> float:
+        """Take a token. Returns 0 if there was one, otherwise seconds until there is one."""
+        rate, burst = settings.SENSOR_RATE, settings.SENSOR_BURST
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def give_back(self, key):
+        """Put back the token of a request that wrote nothing."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                tokens, updated_at = bucket
+                self._buckets[key] = (min(settings.SENSOR_BURST, tokens + 1), updated_at)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+sensor_buckets = TokenBuckets()
+
+
+def sensor_wait(user) -> float:
+    """Seconds the device has to wait before its next change is written, 0 if it can be written now."""
+    if not settings.SENSOR_RATE:
+        return 0.0
+    return sensor_buckets.take(user.pk)
+
+
+def refund_token(request):
+    """Give back the token a duplicate submission took, it was not written again."""
+    if getattr(request, 'took_token', False):
+        request.took_token = False
+        sensor_buckets.give_back(request.user.pk)
+
+
+class SensorRateThrottle(BaseThrottle):
+    """
+    Limit the changes a device sends with its token bucket.
+
+    Over the limit, a change is rejected with 429, or with SENSOR_COALESCE
+    it is accepted and request.coalesced is set, so the view merges
+    it in memory with the others instead of writing it right away.
+    A retry of a submission this worker has seen takes no token, the
+    view gives back the token of a duplicate found in the database
+    (see refund_token).
+    """
+
+    def allow_request(self, request, view):
+        key = submission_key(request)
+        if key is not None and dedupe_index.seen((request.user.get_username(), key)):
+            self.wait_time = 0.0
+            return True
+        self.wait_time = sensor_wait(request.user)
+        if not self.wait_time:
+            request.took_token = bool(settings.SENSOR_RATE)
+            return True
+        if settings.SENSOR_COALESCE:
+            request.coalesced = True
+            return True
+        return False
+
+    def wait(self):
+        return self.wait_time
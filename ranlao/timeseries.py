@@ -0,0 +1,102 @@
+import datetime
+
+from django.db.models import F, Func, OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from .models import Entrance, VisitorLog
+
+ONE_HOUR = datetime.timedelta(hours=1)
+
+
+def truncate_hour(time: datetime.datetime) -> datetime.datetime:
+    """Zero other details after hours."""
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def latest_logs_before(time: datetime.datetime, entrance: str = None):
+    """
+    The latest log before time of every entrance, or of one entrance.
+
+    Each entrance seeks its latest log in the (entrance, log_time) index,
+    so the cost does not grow with the logs.
+    """
+    entrances = Entrance.objects.all()
+    if entrance is not None:
+        entrances = entrances.filter(name=entrance)
+    latest_log = VisitorLog.objects.filter(entrance=OuterRef('name'), log_time__lt=time) \
+        .order_by('-log_time') \
+        .values('pk')[:1]
+    return VisitorLog.objects.filter(pk__in=entrances.values(latest=Subquery(latest_log)))
+
+
+def register_entrances(*names: str):
+    """Add the entrances of new logs, logs written without it are not found by latest_logs_before."""
+    Entrance.objects.bulk_create([Entrance(name=name) for name in names], ignore_conflicts=True)
+
+
+def total_before(time: datetime.datetime) -> Subquery:
+    """Subquery of the amount before time, the sum of every entrance."""
+    # Func instead of Sum so the subquery has no GROUP BY.
+    return Subquery(latest_logs_before(time).annotate(total=Func(F('amount'), function='SUM')).values('total'))
+
+
+def amount_before(time: datetime.datetime, entrance: str = None) -> int:
+    """Get the amount before time summed over the entrances, zero if there is no log."""
+    return latest_logs_before(time, entrance).aggregate(total=Sum('amount'))['total'] or 0
+
+
+def iter_hourly_series(start: datetime.datetime, end: datetime.datetime, entrance: str = None):
+    """
+    Yield (log_time, amount) of every hour from start to end.
+
+    Each entrance has its own log, the amount is their sum (or the
+    amount of the given entrance). Only hours that changed have a log.
+    The other hours are filled in memory with the last known amount,
+    so this reads the logs in the range and the log of each entrance before it.
+    """
+    start = truncate_hour(start)
+    end = truncate_hour(end)
+    logs = VisitorLog.objects.filter(log_time__gte=start, log_time__lte=end)
+    if entrance is not None:
+        logs = logs.filter(entrance=entrance)
+    logs = logs.order_by('log_time').values_list('log_time', 'entrance', 'amount')
+    amounts = dict(latest_logs_before(start, entrance).values_list('entrance', 'amount'))
+    amount = sum(amounts.values())
+    log_time = start
+    for changed_time, changed_entrance, changed_amount in logs.iterator():
+        while log_time < changed_time:
+            yield log_time, amount
+            log_time += ONE_HOUR
+        amount += changed_amount - amounts.get(changed_entrance, 0)
+        amounts[changed_entrance] = changed_amount
+    while log_time <= end:
+        yield log_time, amount
+        log_time += ONE_HOUR
+
+
+def hourly_series(start: datetime.datetime, end: datetime.datetime) -> list:
+    """Get (log_time, amount) of every hour from start to end."""
+    return list(iter_hourly_series(start, end))
+
+
+def iter_daily_series(start: datetime.datetime, end: datetime.datetime, entrance: str = None):
+    """
+    Yield (date, peak amount) of every local day from start to end, of all entrances or one.
+
+    The days are in the current time zone.
+    """
+    day, peak = None, 0
+    for log_time, amount in iter_hourly_series(start, end, entrance):
+        log_date = timezone.localtime(log_time).date()
+        if log_date != day:
+            if day is not None:
+                yield day, peak
+            day, peak = log_date, amount
+        peak = max(peak, amount)
+    if day is not None:
+        yield day, peak
+
+
+def amount_at(time: datetime.datetime) -> int:
+    """Get the amount of the hour of time."""
+    return amount_before(truncate_hour(time) + ONE_HOUR)
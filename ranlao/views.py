@@ -1,56 +1,89 @@
 import datetime
 
+from django.conf import settings
+from django.db.models import Q, Sum
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.utils import timezone
 from rest_framework import viewsets
 from rest_framework.authentication import TokenAuthentication, SessionAuthentication, BasicAuthentication
-from rest_framework.decorators import api_view, permission_classes, authentication_classes
-from rest_framework.generics import get_object_or_404
+from rest_framework.decorators import action, api_view, permission_classes, authentication_classes, throttle_classes
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from http import HTTPStatus
 
-from .models import Table, VisitorLog, UserTable
-from .serializers import TableSerializer, LogSerializer
+from .authentication import CachedTokenAuthentication
+from .calls import call_queue, response_times
+from .counters import LOG_WINDOW, apply_delta, buffers_changes, current_amount, delta_buffer, record_delta, \
+    record_events
+from .models import Table, VisitorEvent, VisitorLog
+from . import metrics
+from .middlewares import slowest_profiles
+from .exports import CONTENT_TYPES, export_logs
+from .idempotency import submission_key
+from .profiles import get_profile
+from .push import broker, occupancy_event, table_event, table_removed_event
+from .rendering import recent_logs_body, tables_body
+from .rollups import daily_stats, day_range, local_date, summarize, weekly_summary
+from .serializers import TableSerializer, LogSerializer, CounterEventSerializer, LogRangeSerializer, \
+    StatisticQuerySerializer, TableSyncSerializer, ProfileQuerySerializer, EntranceSerializer, \
+    TableSelectionSerializer, TableRenumberSerializer, LogExportSerializer
+from .tables import create_tables, renumber_tables, set_calling, stop_calling, table_etag, table_version
+from .throttling import refund_token, SensorRateThrottle
+from .timeseries import ONE_HOUR, hourly_series, iter_daily_series, iter_hourly_series, latest_logs_before, \
+    truncate_hour
 
 
 def get_current_time_zero():
-    current_time = timezone.now()
-    # Set zero
-    current_time_zero = current_time.replace(minute=0, second=0, microsecond=0)
-    return current_time_zero
+    return truncate_hour(timezone.now())
 
 
-def change_log_by_time(time: datetime.datetime, amount: int):
+def get_occupancy() -> int:
+    """Numbers of current customers, including changes that are not written yet."""
+    if buffers_changes():
+        return max(delta_buffer.read_with_pending(current_amount), 0)
+    return current_amount()
+
+
+def publish_occupancy():
+    """Push the current customers to websocket clients if anyone listens."""
+    if broker.has_subscribers:
+        broker.publish(occupancy_event(get_occupancy()))
+
+
+def change_log_by_time(time: datetime.datetime, amount: int, entrance: str = ''):
     """Change log by time"""
-    # Zero other details after hours
-    zero_time = time.replace(minute=0, second=0, microsecond=0)
-    current_log, created = VisitorLog.objects.get_or_create(log_time=zero_time)
-    # If there is no current log, it is created.
-    # The amount will traceback to the previous record if there is any.
-    # It will trace up to 6 hours.
-    if created:
-        maximum_rollback = zero_time - datetime.timedelta(hours=6)
-        # Find the previous log upto 6 hours ago.
-        previous_log = VisitorLog.objects.filter(log_time__lt=zero_time, log_time__gte=maximum_rollback) \
-            .order_by('-log_time') \
-            .first()
-        if not previous_log:
-            # If there is no previous log, create one for 6 hours ago.
-            previous_log = VisitorLog.objects.create(log_time=maximum_rollback)
-        # Create all logs after previous one
-        # Set the amount to the same as previous one because there is no signal sent.
-        while previous_log.log_time < current_log.log_time:
-            log, created = VisitorLog.objects.get_or_create(log_time=previous_log.log_time + datetime.timedelta(hours=1))
-            print(f"Log at {log.log_time} is created.")
-            log.amount = previous_log.amount
-            log.save()
-            previous_log = log
-        current_log.amount = previous_log.amount
-    # Change if the change makes sense.
-    if current_log.amount + amount >= 0:
-        current_log.amount += amount
-    current_log.save()
+    apply_delta(time, amount, entrance)
+
+
+def count_submission(request, amount: int) -> Response:
+    """
+    Count an enter or leave of the hardware.
+
+    A retry with the same Idempotency-Key header or ?seq= is acknowledged
+    without counting it again. A change over the rate of the device
+    (see SensorRateThrottle) is merged with the others and acknowledged with 202.
+    """
+    coalesced = getattr(request, 'coalesced', False)
+    if not record_delta(timezone.now(), amount, request.user.get_username(),
+                        get_entrance(request.query_params), submission_key(request), coalesced):
+        refund_token(request)
+        return Response({'message': 'success', 'duplicate': True})
+    publish_occupancy()
+    if coalesced:
+        return Response({'message': 'success', 'merged': True}, status=HTTPStatus.ACCEPTED)
+    return Response({'message': 'success'})
+
+
+def get_entrance(query_params) -> str:
+    """Get the door of the hardware from the query, raises ValidationError."""
+    serializer = EntranceSerializer(data=query_params)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data['entrance']
+
+
+STAFF_AUTHENTICATION = [TokenAuthentication, SessionAuthentication]
 
 
 # Create your views here.
@@ -58,21 +91,177 @@ class TableViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Table.objects.all()
     serializer_class = TableSerializer
 
+    def list(self, request, *args, **kwargs):
+        """
+        Get tables, or only the tables changed after ?since=<version>.
+
+        The ETag is the version of the tables, so a poll with If-None-Match
+        gets 304 after one lookup of the version. The body is encoded once
+        for each version of the tables (see rendering.tables_body).
+        """
+        version = table_version()
+        etag = table_etag(version)
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=HTTPStatus.NOT_MODIFIED, headers={'ETag': etag})
+        serializer = TableSyncSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        # With since, a different count means tables were deleted, clients should get all tables.
+        body = tables_body(version, serializer.validated_data.get('since'))
+        response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    @staticmethod
+    def bulk_response(results: dict) -> Response:
+        return Response({'results': [{'table': table, 'result': result} for table, result in results.items()]})
+
+    def stop_calling(self, request, answered: bool) -> Response:
+        serializer = TableSelectionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = stop_calling(serializer.validated_data['tables'], answered)
+        for table_number, result in results.items():
+            if result in ('completed', 'reset'):
+                broker.publish(table_event(table_number, False))
+        return self.bulk_response(results)
+
+    @action(detail=False, methods=['post'], url_path='complete', authentication_classes=STAFF_AUTHENTICATION,
+            permission_classes=[IsAuthenticated, IsAdminUser])
+    def complete_many(self, request):
+        """Complete the orders of many tables, the body is {tables: [...]} or {start, end}."""
+        return self.stop_calling(request, answered=True)
+
+    @action(detail=False, methods=['post'], url_path='reset', authentication_classes=STAFF_AUTHENTICATION,
+            permission_classes=[IsAuthenticated, IsAdminUser])
+    def reset_many(self, request):
+        """
+        Stop the calls of many tables without answering them (at closing time).
+
+        The body is {tables: [...]} or {start, end}. Reset calls are left out of the response times.
+        """
+        return self.stop_calling(request, answered=False)
+
+    @action(detail=False, methods=['post'], url_path='bulk-create', authentication_classes=STAFF_AUTHENTICATION,
+            permission_classes=[IsAuthenticated, IsAdminUser])
+    def bulk_create(self, request):
+        """Create many tables, the body is {tables: [...]} or {start, end}."""
+        serializer = TableSelectionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = create_tables(serializer.validated_data['tables'])
+        for table_number, result in results.items():
+            if result == 'created':
+                broker.publish(table_event(table_number, False))
+        return self.bulk_response(results)
+
+    @action(detail=False, methods=['post'], authentication_classes=STAFF_AUTHENTICATION,
+            permission_classes=[IsAuthenticated, IsAdminUser])
+    def renumber(self, request):
+        """Give tables new numbers, the body is {changes: [{table_number, new_number}, ...]}."""
+        serializer = TableRenumberSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        changes = serializer.validated_data['changes']
+        results = renumber_tables(changes)
+        moves = {old: changes[old] for old, result in results.items() if result == 'renumbered'}
+        if moves and broker.has_subscribers:
+            # Numbers that no table took are removed for the clients.
+            for table_number in moves.keys() - moves.values():
+                broker.publish(table_removed_event(table_number))
+            for table_number, is_calling in Table.objects.filter(table_number__in=moves.values()).values_list(
+                    'table_number', 'is_calling'):
+                broker.publish(table_event(table_number, is_calling))
+        return self.bulk_response(results)
+
 
 class LogViewSets(viewsets.ReadOnlyModelViewSet):
-    max_rollback = get_current_time_zero() - datetime.timedelta(hours=6)
-    queryset = VisitorLog.objects.filter(log_time__gte=max_rollback).order_by('-log_time')
+    queryset = VisitorLog.objects.all()
     serializer_class = LogSerializer
 
+    def get_queryset(self):
+        """Logs of the last 6 hours, the window is evaluated for every request."""
+        max_rollback = get_current_time_zero() - LOG_WINDOW
+        return VisitorLog.objects.filter(log_time__gte=max_rollback).order_by('-log_time')
+
     def list(self, request, *args, **kwargs):
-        """Get queries but convert the form first."""
-        change_log_by_time(timezone.now(), 0)
-        logs = self.get_queryset()
-        converted_logs = []
-        for log in logs:
-            log_time = timezone.localtime(log.log_time)
-            converted_logs.append({'log_time': f"{log_time.hour}:00-{log_time.hour+1}:00", 'amount': log.amount})
-        return Response(converted_logs)
+        """Get logs of the last 6 hours as hour ranges, encoded once for each version of the logs."""
+        return HttpResponse(recent_logs_body(), content_type='application/json')
+
+    @action(detail=False, url_path='range')
+    def log_range(self, request):
+        """
+        Get logs from start to end by hour or by day, one page at a time.
+
+        A page starts at the cursor and holds up to limit hours or days,
+        so its cost does not grow with the table. The page is read in the
+        view (a generator reading the database cannot be sent under ASGI)
+        and comes with the cursor of the next page.
+        """
+        serializer = LogRangeSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        end = params.get('end') or timezone.now()
+        page_start = params.get('cursor') or params['start']
+        if params['granularity'] == 'day':
+            step = datetime.timedelta(days=1)
+            page_start = timezone.localtime(page_start).replace(hour=0, minute=0, second=0, microsecond=0)
+            page_end = min(page_start + step * params['limit'] - ONE_HOUR, end)
+            logs = [{'log_time': day.isoformat(), 'amount': amount}
+                    for day, amount in iter_daily_series(page_start, page_end, params.get('entrance'))]
+        else:
+            step = ONE_HOUR
+            page_start = truncate_hour(page_start)
+            page_end = min(page_start + step * (params['limit'] - 1), end)
+            logs = [{'log_time': timezone.localtime(log_time).isoformat(), 'amount': amount}
+                    for log_time, amount in iter_hourly_series(page_start, page_end, params.get('entrance'))]
+        next_start = truncate_hour(page_end) + ONE_HOUR
+        next_url = None
+        if next_start <= end:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', next_start.isoformat())
+        return Response({'next': next_url, 'results': logs})
+
+    @action(detail=False, authentication_classes=STAFF_AUTHENTICATION,
+            permission_classes=[IsAuthenticated, IsAdminUser])
+    def export(self, request):
+        """
+        Download the hourly logs of the days from start to end as CSV or NDJSON (?output=ndjson).
+
+        Rows are read in chunks and streamed, so a range of years
+        takes as much memory as a day.
+        """
+        serializer = LogExportSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        end = params.get('end') or local_date(timezone.now())
+        response = StreamingHttpResponse(
+            export_logs(params['start'], end, params['output'], params.get('entrance')),
+            content_type=CONTENT_TYPES[params['output']]
+        )
+        filename = f"visitor-logs-{params['start']}-{end}.{params['output']}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @action(detail=False)
+    def entrances(self, request):
+        """
+        Get customers of each entrance.
+
+        amount is the customers that came in minus the ones that went out
+        through the door, entries and exits are counted since the start of today.
+        """
+        amounts = dict(latest_logs_before(get_current_time_zero() + ONE_HOUR).values_list('entrance', 'amount'))
+        today = day_range(local_date(timezone.now()))[0]
+        moves = VisitorEvent.objects.filter(timestamp__gte=today).values('entrance').annotate(
+            entries=Sum('delta', filter=Q(delta__gt=0)),
+            exits=Sum('delta', filter=Q(delta__lt=0)),
+        ).order_by()
+        moves = {move['entrance']: move for move in moves}
+        return Response([
+            {
+                'entrance': entrance,
+                'amount': amounts.get(entrance, 0),
+                'entries': moves.get(entrance, {}).get('entries') or 0,
+                'exits': -(moves.get(entrance, {}).get('exits') or 0),
+            }
+            for entrance in sorted(amounts.keys() | moves.keys())
+        ])
 
 
 @api_view(['POST'])
@@ -82,9 +271,9 @@ def call_staff(request, table_number):
     """
     Call the staff to come to the table
     """
-    table = get_object_or_404(Table, table_number=table_number)
-    table.is_calling = True
-    table.save()
+    if set_calling(table_number, True) is None:
+        raise Http404
+    broker.publish(table_event(table_number, True))
     return Response({'message': 'success'}, status=HTTPStatus.OK)
 
 
@@ -97,45 +286,67 @@ def complete_order(request, table_number):
 
     The table will be back to non-calling state.
     """
-    table = get_object_or_404(Table, table_number=table_number)
-    table.is_calling = False
-    table.save()
+    if set_calling(table_number, False) is None:
+        raise Http404
+    broker.publish(table_event(table_number, False))
     return Response({'message': 'success'}, status=HTTPStatus.OK)
 
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication, SessionAuthentication, BasicAuthentication])
+@authentication_classes([CachedTokenAuthentication, SessionAuthentication, BasicAuthentication])
 @permission_classes([IsAuthenticated])
+@throttle_classes([SensorRateThrottle])
 def customer_enter(request):
     """
     Increase customer enter for this hour.
 
     This view is only called from hardware.
     """
-    change_log_by_time(timezone.now(), 1)
-    return Response({'message': 'success'})
+    return count_submission(request, 1)
 
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication, SessionAuthentication, BasicAuthentication])
+@authentication_classes([CachedTokenAuthentication, SessionAuthentication, BasicAuthentication])
 @permission_classes([IsAuthenticated])
+@throttle_classes([SensorRateThrottle])
 def customer_leave(request):
     """
     Decrease customer for this hour.
 
     This view is only called from hardware.
     """
-    change_log_by_time(timezone.now(), -1)
-    return Response({'message': 'success'})
+    return count_submission(request, -1)
+
+
+@api_view(['POST'])
+@authentication_classes([CachedTokenAuthentication, SessionAuthentication, BasicAuthentication])
+@permission_classes([IsAuthenticated])
+def customer_events(request):
+    """
+    Record many enters and leaves at once.
+
+    The body is a list of {timestamp, delta, entrance}, the entrance
+    defaults to ?entrance=. Events are merged by hour and entrance
+    and each of them is written once in a single transaction.
+
+    A retry with the same Idempotency-Key header is not counted again.
+    This view is only called from hardware.
+    """
+    serializer = CounterEventSerializer(data=request.data, many=True, max_length=settings.MAX_EVENTS)
+    serializer.is_valid(raise_exception=True)
+    device = request.user.get_username()
+    entrance = get_entrance(request.query_params)
+    events = [VisitorEvent(device=device, **{'entrance': entrance, **event}) for event in serializer.validated_data]
+    if not record_events(events, device, submission_key(request)):
+        return Response({'message': 'success', 'duplicate': True})
+    publish_occupancy()
+    return Response({'message': 'success', 'events': len(serializer.validated_data)})
 
 
 @api_view(['GET'])
 def get_current_customers(request):
     """Get numbers of current customers."""
-    change_log_by_time(timezone.now(), 0)
-    current_time_zero = get_current_time_zero()
-    current_log, created = VisitorLog.objects.get_or_create(log_time=current_time_zero)
-    return Response({'amount': current_log.amount})
+    return Response({'amount': get_occupancy()})
 
 
 @api_view(['GET'])
@@ -143,12 +354,8 @@ def get_user_status(request):
     """
     Get user status of table and is staff
     """
-    user = request.user
-    try:
-        table = UserTable.objects.get(user=user)
-    except UserTable.DoesNotExist:
-        table = None
-    return Response({'is_staff': user.is_staff, 'table': table.table.table_number if table else None})
+    profile = get_profile(request.user)
+    return Response({'is_staff': profile['is_staff'], 'table': profile['table']})
 
 
 @api_view(['GET'])
@@ -164,6 +371,107 @@ def get_statistic(request):
     # It has a weird behavior.
     start_time = current_time.replace(hour=18) - datetime.timedelta(days=1)
     end_time = current_time.replace(hour=23) - datetime.timedelta(days=1)
-    all_data = VisitorLog.objects.filter(log_time__gte=start_time, log_time__lte=end_time).order_by('log_time')
-    all_data_json = [{'date': x.log_time, 'amount': x.amount} for x in all_data]
+    all_data_json = [{'date': log_time, 'amount': amount} for log_time, amount in hourly_series(start_time, end_time)]
     return Response({'stat': all_data_json})
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def get_period_statistic(request, period):
+    """
+    Get statistic of a day, week or month from the rollups.
+
+    The period contains ?date= (default today). Weeks start on Monday.
+    Note: This is intended for table and graph
+    """
+    if period not in ('day', 'week', 'month'):
+        return Response({'message': 'period must be day, week or month'}, status=HTTPStatus.NOT_FOUND)
+    serializer = StatisticQuerySerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    date = serializer.validated_data.get('date') or local_date(timezone.now())
+    if period == 'day':
+        start = end = date
+    elif period == 'week':
+        start = date - datetime.timedelta(days=date.weekday())
+        end = start + datetime.timedelta(days=6)
+    else:
+        start = date.replace(day=1)
+        end = (start + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
+    days = daily_stats(start, end)
+    summary = weekly_summary(start) if period == 'week' else summarize(days)
+    return Response({
+        'period': period,
+        'start': start,
+        'end': end,
+        **summary,
+        'days': [
+            {'date': day.date, 'peak': day.peak, 'average': day.average, 'total_entries': day.total_entries}
+            for day in days
+        ],
+    })
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, SessionAuthentication])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def get_open_calls(request):
+    """Get the tables waiting for the staff, the oldest call first."""
+    now = timezone.now()
+    return Response({'calls': [
+        {'table': table_number, 'raised_at': raised_at, 'waiting': (now - raised_at).total_seconds()}
+        for table_number, raised_at in call_queue.open_calls()
+    ]})
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, SessionAuthentication])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def get_call_statistic(request):
+    """
+    Get the time the staff took to answer the calls of a day in seconds.
+
+    The day is ?date= (default today).
+    """
+    serializer = StatisticQuerySerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    date = serializer.validated_data.get('date') or local_date(timezone.now())
+    start = day_range(date)[0]
+    end = day_range(date + datetime.timedelta(days=1))[0]
+    return Response({'date': date, **response_times(start, end)})
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, SessionAuthentication])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def get_slow_requests(request):
+    """
+    Get the slowest recent requests of each URL name in this worker.
+
+    Requests are only measured when PROFILING_ENABLED is set.
+    """
+    serializer = ProfileQuerySerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    return Response({
+        'enabled': settings.PROFILING_ENABLED,
+        'slowest': slowest_profiles(serializer.validated_data['limit']),
+    })
+
+
+@api_view(['GET'])
+@authentication_classes([CachedTokenAuthentication, SessionAuthentication, BasicAuthentication])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def get_metrics(request):
+    """
+    Get metrics of all workers in the Prometheus text format.
+
+    Occupancy and calling tables are read when scraped.
+    """
+    open_calls = call_queue.open_calls()
+    oldest_call = (timezone.now() - open_calls[0][1]).total_seconds() if open_calls else 0.0
+    text = metrics.render({
+        'ranlao_occupancy': ("Customers in the pub.", get_occupancy()),
+        'ranlao_tables_calling': ("Tables waiting for the staff.", Table.objects.filter(is_calling=True).count()),
+        'ranlao_oldest_call_seconds': ("Seconds the oldest open call has waited.", oldest_call),
+    })
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')